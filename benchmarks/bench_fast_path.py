@@ -0,0 +1,70 @@
+"""
+Microbenchmark: parse-to-send cost per packet for static and cached answers,
+parsing every query with dnspython (message.from_wire, then the lookups by
+Message) versus reading the header and question straight from the bytes.
+
+Usage: python3 benchmarks/bench_fast_path.py [iterations]
+"""
+import logging
+import os
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from dns import message, rrset
+
+from app import DNSResolver
+from wire import fit_udp, parse_query
+
+STATIC_QUERIES = [
+    ("www.openlab.dk.", "A", False),
+    ("localapp.dev.", "MX", True),
+    ("_sip._tcp.localapp.dev.", "SRV", False),
+]
+CACHED_QUERIES = [
+    ("forwarded.example.", "A", False),
+    ("forwarded.example.", "A", True),
+]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    os.chdir(ROOT)
+    resolver = DNSResolver("config/config.ini")
+    logging.disable(logging.CRITICAL)
+
+    for qname, qtype_text, use_edns in CACHED_QUERIES:
+        request = message.make_query(qname, qtype_text, use_edns=0 if use_edns else None)
+        response = message.make_response(request)
+        response.answer.append(rrset.from_text(qname, 3600, 'IN', qtype_text, '192.0.2.1'))
+        resolver.cache_response(request, response.to_wire())
+
+    print(f"{'query':<36} {'parsed us/q':>12} {'raw us/q':>9} {'speedup':>8}")
+    for kind, queries in (("static", STATIC_QUERIES), ("cached", CACHED_QUERIES)):
+        for qname, qtype_text, use_edns in queries:
+            data = message.make_query(qname, qtype_text, use_edns=0 if use_edns else None).to_wire()
+
+            def parsed_path():
+                request = message.from_wire(data)
+                response_wire = resolver.get_static_wire(request, data)
+                if response_wire is None:
+                    response_wire = resolver.get_cached_wire(request, data)
+                return fit_udp(response_wire, request, resolver.max_udp_size)
+
+            def raw_path():
+                query = parse_query(data)
+                response_wire, _ = resolver.get_raw_wire(query)
+                return fit_udp(response_wire, query, resolver.max_udp_size)
+
+            assert parsed_path() == raw_path()
+
+            parsed = timeit.timeit(parsed_path, number=iterations) / iterations
+            raw = timeit.timeit(raw_path, number=iterations) / iterations
+            label = f"{kind} {qname} {qtype_text}{' +EDNS' if use_edns else ''}"
+            print(f"{label:<36} {parsed * 1e6:>12.2f} {raw * 1e6:>9.2f} {parsed / raw:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures what the metrics cost per query: handle_query on the sync engine
+with METRICS_LISTEN unset versus set (best of five runs), for static and cached answers sent
+over a real UDP socket.
+
+Usage: python3 benchmarks/bench_metrics.py [iterations]
+"""
+import configparser
+import logging
+import os
+import socket
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from dns import message, rrset
+
+from app import DNSResolver
+
+QUERIES = [
+    ("static", "www.openlab.dk.", "A"),
+    ("cached", "forwarded.example.", "A"),
+]
+
+
+def make_resolver(config_dir, metrics_listen):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, "config", "config.ini"))
+    config["DNS"]["ZONES_DIR"] = os.path.join(ROOT, config["DNS"].get("ZONES_DIR", "zones"))
+    config["DNS"]["METRICS_LISTEN"] = metrics_listen
+    path = os.path.join(config_dir, f"metrics-{'on' if metrics_listen else 'off'}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    resolver = DNSResolver(path)
+    resolver.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return resolver
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as config_dir:
+        resolvers = {
+            "off": make_resolver(config_dir, ""),
+            "on": make_resolver(config_dir, "127.0.0.1:9153"),
+        }
+    logging.disable(logging.CRITICAL)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.setblocking(False)
+    addr = sink.getsockname()
+
+    for resolver in resolvers.values():
+        request = message.make_query("forwarded.example.", "A")
+        response = message.make_response(request)
+        response.answer.append(rrset.from_text("forwarded.example.", 3600, 'IN', 'A', '192.0.2.1'))
+        resolver.cache_response(request, response.to_wire())
+
+    def drain():
+        try:
+            while True:
+                sink.recv(65535)
+        except BlockingIOError:
+            pass
+
+    print(f"{'query':<28} {'off us/q':>9} {'on us/q':>9} {'overhead':>9}")
+    for kind, qname, qtype_text in QUERIES:
+        data = message.make_query(qname, qtype_text).to_wire()
+        results = {}
+        for name, resolver in resolvers.items():
+            def handle():
+                resolver.handle_query(data, addr)
+                drain()
+            results[name] = min(timeit.repeat(handle, number=iterations, repeat=5)) / iterations
+        overhead = results["on"] - results["off"]
+        print(f"{kind + ' ' + qname:<28} {results['off'] * 1e6:>9.2f} {results['on'] * 1e6:>9.2f} "
+              f"{overhead * 1e6:>7.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures the rate limiter: the cost of one check() for a handful of busy
+clients and for a flood of distinct sources, the table memory, and how a
+spoofed flood from many sources affects the buckets of regular clients.
+
+Usage: python3 benchmarks/bench_rate_limit.py [sources] [table_size]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from rate_limit import RESPOND, RateLimiter
+
+
+def addresses(count, rng):
+    return [f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"
+            for _ in range(count)]
+
+
+def time_checks(limiter, sources, now):
+    started = time.perf_counter()
+    for address in sources:
+        limiter.check(address, now)
+    return (time.perf_counter() - started) / len(sources)
+
+
+def main():
+    sources = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    table_size = int(sys.argv[2]) if len(sys.argv) > 2 else 262144
+    rng = random.Random(1)
+
+    limiter = RateLimiter(100, table_size=table_size)
+    memory = limiter.keys.itemsize * len(limiter.keys) + limiter.full_at.itemsize * len(limiter.full_at)
+    print(f"table: {limiter.size} slots, {memory / 1048576:.1f} MiB")
+
+    busy = addresses(16, rng) * (sources // 16)
+    print(f"16 busy clients:          {time_checks(limiter, busy, 1000.0) * 1e6:.2f} us/check")
+
+    flood = addresses(sources, rng)
+    print(f"{sources} distinct sources: {time_checks(limiter, flood, 1000.0) * 1e6:.2f} us/check, "
+          f"{limiter.evictions} evictions")
+
+    # Regular clients at half the rate while the flood continues: how many of
+    # their queries are wrongly limited after losing their bucket to eviction
+    limiter = RateLimiter(100, table_size=table_size)
+    regular = addresses(1000, rng)
+    limited = answered = 0
+    now = 1000.0
+    for step in range(200):
+        now += 0.02
+        for address in regular:
+            if limiter.check(address, now) == RESPOND:
+                answered += 1
+            else:
+                limited += 1
+        for address in flood[step * 2000:(step + 1) * 2000]:
+            limiter.check(address, now)
+    print(f"regular clients during the flood: {answered} answered, {limited} limited")
+
+
+if __name__ == "__main__":
+    main()
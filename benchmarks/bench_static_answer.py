@@ -0,0 +1,65 @@
+"""
+Microbenchmark: answering a static record the old way (format the zone text,
+rrset.from_text, make_response, to_wire) versus rendering the answer that
+was compiled at zone load time.
+
+Usage: python3 benchmarks/bench_static_answer.py [iterations]
+"""
+import logging
+import os
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from dns import message, rrset
+
+from app import DNSResolver
+from static_answers import question_wire
+
+QUERIES = [
+    ("www.openlab.dk.", "A"),
+    ("localapp.dev.", "MX"),
+    ("_sip._tcp.localapp.dev.", "SRV"),
+    ("localapp.dev.", "TXT"),
+    ("1.0.0.127.in-addr.arpa.", "PTR"),
+]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    os.chdir(ROOT)
+    resolver = DNSResolver("config/config.ini")
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'query':<32} {'old us/q':>10} {'compiled us/q':>14} {'speedup':>8}")
+    for qname, qtype_text in QUERIES:
+        request = message.make_query(qname, qtype_text)
+        data = request.to_wire()
+        qtype = request.question[0].rdtype
+        zone_name, _ = resolver.zone_index.lookup(qname)
+        subdomain = qname[:-len(zone_name) - 1].rstrip('.') or "@"
+        raw_value = resolver._read_zone_file(f"{zone_name}.json")[qtype_text][subdomain]
+
+        def old_path():
+            response = message.make_response(request)
+            formatted = resolver._format_answer_data(qtype_text, raw_value)
+            response.answer.append(rrset.from_text(qname, 300, 'IN', qtype_text, formatted))
+            return response.to_wire()
+
+        def compiled_path():
+            answer = resolver.lookup_static(qname, qtype)
+            return answer.render(request.id, request.flags,
+                                 question_wire(data, request.question[0].name),
+                                 request.edns >= 0)
+
+        assert message.from_wire(old_path()).answer == message.from_wire(compiled_path()).answer
+
+        old = timeit.timeit(old_path, number=iterations) / iterations
+        compiled = timeit.timeit(compiled_path, number=iterations) / iterations
+        print(f"{qname + ' ' + qtype_text:<32} {old * 1e6:>10.2f} {compiled * 1e6:>14.2f} {old / compiled:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
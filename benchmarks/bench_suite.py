@@ -0,0 +1,286 @@
+"""
+Reproducible load benchmark: runs the server against generated zones and a
+local stand-in upstream, replays query mixes with a dnsperf-style client and
+writes QPS and latency percentiles as JSON.
+
+For every mix a fresh server (and fake upstream) is started, so caches start
+empty and runs do not influence each other. The query sequence is driven by
+--seed, so two runs with the same arguments send the same queries.
+
+Mixes:
+    static   90% names from the generated zones, 10% forwarded names
+    forward  90% forwarded names from a fixed pool (cacheable), 10% static
+    ptr      reverse lookups in the generated in-addr.arpa zone
+    random   unique random subdomains of a forwarded domain (always forwarded)
+
+Usage:
+    python3 benchmarks/bench_suite.py run [--mixes static,forward,ptr,random]
+        [--duration 10] [--warmup 2] [--concurrency 64] [--zones 10]
+        [--records 1000] [--engine async] [--workers 1] [--cache-size 10000]
+        [--latency 0.005] [--jitter 0] [--loss 0] [--seed 1] [--output results.json]
+    python3 benchmarks/bench_suite.py compare old.json new.json
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from dns import message
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.abspath(os.path.join(BENCHMARKS, ".."))
+sys.path.insert(0, BENCHMARKS)
+
+from load_client import run_load
+
+MIXES = ("static", "forward", "ptr", "random")
+FORWARD_POOL = 1000
+REVERSE_ZONE = "10.in-addr.arpa"
+
+SERVER = """
+import sys
+sys.path.insert(0, {src!r})
+from app import DNSResolver
+from workers import run_workers
+resolver = DNSResolver({config!r})
+if resolver.workers > 1:
+    run_workers(resolver, resolver.workers)
+else:
+    resolver.serve()
+"""
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def host_address(index):
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+
+def write_zones(directory, zones, records):
+    """
+    Writes zones zone0.bench .. zone<N-1>.bench with records A records each,
+    and a reverse zone with a PTR for every host. Returns the static names.
+    """
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    reverse = {}
+    index = 0
+    for zone in range(zones):
+        zone_name = f"zone{zone}.bench"
+        a_records = {}
+        for record in range(records):
+            a_records[f"host{record}"] = host_address(index)
+            reverse['.'.join(reversed(host_address(index).split('.')[1:]))] = f"host{record}.{zone_name}."
+            names.append(f"host{record}.{zone_name}.")
+            index += 1
+        with open(os.path.join(directory, f"{zone_name}.json"), "w") as f:
+            json.dump({"A": a_records}, f)
+    with open(os.path.join(directory, f"{REVERSE_ZONE}.json"), "w") as f:
+        json.dump({"PTR": reverse}, f)
+    return names
+
+
+def write_config(directory, args, port, upstream_port, zones_dir):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "LISTEN_IP": "127.0.0.1",
+        "LISTEN_PORT": str(port),
+        "FORWARDERS": f"127.0.0.1:{upstream_port}",
+        "LOG_LEVEL": "ERROR",
+        "ZONES_DIR": zones_dir,
+        "ENGINE": args.engine,
+        "WORKERS": str(args.workers),
+        "CACHE_SIZE": str(args.cache_size),
+        "ZONES_WATCH": "off",
+        "LISTEN_TCP": "no",
+    }
+    path = os.path.join(directory, "bench_suite.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+class QueryMix:
+    """
+    Produces the query packets of a mix. Static and forwarded picks are
+    drawn from a seeded RNG, so the sequence is the same on every run.
+    """
+    def __init__(self, mix, static_names, seed):
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.static_names = static_names
+        self.counter = 0
+
+    def _pick(self):
+        rng = self.rng
+        if self.mix == "static":
+            if rng.random() < 0.9:
+                return rng.choice(self.static_names), "A"
+            return f"fwd{rng.randrange(FORWARD_POOL)}.upstream.test.", "A"
+        if self.mix == "forward":
+            if rng.random() < 0.9:
+                return f"fwd{rng.randrange(FORWARD_POOL)}.upstream.test.", "A"
+            return rng.choice(self.static_names), "A"
+        if self.mix == "ptr":
+            index = rng.randrange(len(self.static_names))
+            return '.'.join(reversed(host_address(index).split('.'))) + ".in-addr.arpa.", "PTR"
+        self.counter += 1
+        return f"r{self.counter:x}-{rng.getrandbits(32):08x}.random.test.", "A"
+
+    def make_query(self, query_id):
+        qname, qtype = self._pick()
+        wire = message.make_query(qname, qtype).to_wire()
+        return query_id.to_bytes(2, 'big') + wire[2:]
+
+
+def wait_until_answering(port, timeout=30.0):
+    query = message.make_query("host0.zone0.bench.", "A").to_wire()
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            try:
+                sock.sendto(query, ("127.0.0.1", port))
+                sock.recv(4096)
+                return
+            except (socket.timeout, ConnectionRefusedError):
+                continue
+    raise RuntimeError("server did not start answering")
+
+
+def run_mix(mix, args, directory, static_names):
+    port = free_port()
+    upstream_port = free_port()
+    config_path = write_config(directory, args, port, upstream_port, os.path.join(directory, "zones"))
+    upstream = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS, "fake_upstream.py"), "--port", str(upstream_port),
+        "--latency", str(args.latency), "--jitter", str(args.jitter), "--loss", str(args.loss),
+        "--seed", str(args.seed),
+    ])
+    server = subprocess.Popen([sys.executable, "-c", SERVER.format(src=os.path.join(ROOT, "src"), config=config_path)])
+    try:
+        wait_until_answering(port)
+        queries = QueryMix(mix, static_names, args.seed)
+        result = run_load(("127.0.0.1", port), queries.make_query, args.duration,
+                          concurrency=args.concurrency, timeout=args.timeout, warmup=args.warmup)
+        return result.summary()
+    finally:
+        for proc in (server, upstream):
+            proc.terminate()
+        for proc in (server, upstream):
+            proc.wait()
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run(args):
+    mixes = [mix.strip() for mix in args.mixes.split(",") if mix.strip()]
+    for mix in mixes:
+        if mix not in MIXES:
+            raise SystemExit(f"Unknown mix {mix!r}, expected one of {', '.join(MIXES)}")
+
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": commit,
+            "dirty": dirty,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "params": {key: value for key, value in sorted(vars(args).items()) if key not in ("command", "output")},
+        "results": {},
+    }
+
+    print(f"{'mix':<8} {'qps':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'lost':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        static_names = write_zones(os.path.join(directory, "zones"), args.zones, args.records)
+        for mix in mixes:
+            summary = run_mix(mix, args, directory, static_names)
+            report["results"][mix] = summary
+            print(f"{mix:<8} {summary['qps']:>9.0f} {summary['p50_ms'] or 0:>8.3f} "
+                  f"{summary['p99_ms'] or 0:>8.3f} {summary['p999_ms'] or 0:>8.3f} {summary['lost']:>6}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Results written to {args.output}")
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"old: {old['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+    if old.get("params") != new.get("params"):
+        print("warning: the runs used different parameters")
+    print(f"{'mix':<8} {'metric':<8} {'old':>10} {'new':>10} {'change':>8}")
+    for mix in new["results"]:
+        if mix not in old["results"]:
+            continue
+        for metric in ("qps", "p50_ms", "p99_ms", "p999_ms"):
+            before = old["results"][mix].get(metric)
+            after = new["results"][mix].get(metric)
+            if not before or after is None:
+                continue
+            print(f"{mix:<8} {metric:<8} {before:>10.3f} {after:>10.3f} {(after - before) / before:>+7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="magicDNS load benchmark suite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("--mixes", default=",".join(MIXES))
+    run_parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per mix")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before each mix")
+    run_parser.add_argument("--concurrency", type=int, default=64, help="queries kept outstanding")
+    run_parser.add_argument("--timeout", type=float, default=2.0, help="seconds before a query counts as lost")
+    run_parser.add_argument("--zones", type=int, default=10)
+    run_parser.add_argument("--records", type=int, default=1000, help="A records per zone")
+    run_parser.add_argument("--engine", default="async", choices=("sync", "async"))
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--cache-size", type=int, default=10000)
+    run_parser.add_argument("--latency", type=float, default=0.005, help="fake upstream delay in seconds")
+    run_parser.add_argument("--jitter", type=float, default=0.0, help="extra random upstream delay")
+    run_parser.add_argument("--loss", type=float, default=0.0, help="fraction of upstream queries dropped")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
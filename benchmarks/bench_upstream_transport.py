@@ -0,0 +1,158 @@
+"""
+Compares forwarding transports against the stand-in upstream: UDP, a new
+TCP/TLS connection per query (as the TC fallback does), and the pooled,
+pipelined connections of AsyncStreamUpstream. Every query is a cache miss
+(a unique name). Reports latency percentiles, failed queries and the
+connections (handshakes) each transport needed.
+
+TLS runs need the openssl command to make a throwaway certificate.
+
+Usage: python3 benchmarks/bench_upstream_transport.py [--queries 2000]
+       [--concurrency 32] [--latency 0.005] [--loss 0.05] [--pool-size 2]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, "..", "src"))
+
+from dns import message
+
+from upstream import AsyncStreamUpstream, AsyncUpstream, tls_context
+from wire import tcp_frame
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_certificate(directory):
+    """
+    Writes a self-signed certificate for 127.0.0.1; returns (cert, key) or
+    None without openssl.
+    """
+    if shutil.which("openssl") is None:
+        return None
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+
+class PerQueryConnection:
+    """
+    Opens a new connection for every query, like AsyncUpstream.query_tcp.
+    """
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.connects = 0
+
+    async def query(self, request, data, timeout):
+        async def exchange():
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+            self.connects += 1
+            try:
+                writer.write(tcp_frame(data))
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                return await reader.readexactly(length)
+            finally:
+                writer.close()
+        return await asyncio.wait_for(exchange(), timeout)
+
+    def close(self):
+        pass
+
+
+async def run_transport(upstream, queries, concurrency, timeout):
+    latencies = []
+    failures = 0
+    names = iter(range(queries))
+
+    async def worker():
+        nonlocal failures
+        for index in names:
+            request = message.make_query(f"miss{index}-{time.monotonic_ns()}.bench.test.", "A")
+            data = request.to_wire()
+            started = time.perf_counter()
+            try:
+                await upstream.query(request, data, timeout)
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    upstream.close()
+    latencies.sort()
+
+    def at(fraction):
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+    return queries / elapsed, at(0.5), at(0.99), failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare upstream transports")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.005, help="fake upstream delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.05, help="fraction of UDP queries dropped")
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--pool-size", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = make_certificate(directory)
+        port, tls_port = free_port(), free_port()
+        command = [sys.executable, os.path.join(BENCHMARKS, "fake_upstream.py"), "--port", str(port),
+                   "--latency", str(args.latency), "--loss", str(args.loss)]
+        if certificate:
+            command += ["--tls-port", str(tls_port), "--tls-cert", certificate[0], "--tls-key", certificate[1]]
+        upstream_proc = subprocess.Popen(command)
+        try:
+            time.sleep(1.0)
+            transports = [
+                ("udp", lambda: AsyncUpstream("127.0.0.1", port)),
+                ("tcp per query", lambda: PerQueryConnection("127.0.0.1", port)),
+                ("tcp pooled", lambda: AsyncStreamUpstream("127.0.0.1", port, pool_size=args.pool_size)),
+            ]
+            if certificate:
+                context = tls_context(certificate[0])
+                transports += [
+                    ("tls per query", lambda: PerQueryConnection("127.0.0.1", tls_port, context)),
+                    ("tls pooled", lambda: AsyncStreamUpstream("127.0.0.1", tls_port, context,
+                                                               pool_size=args.pool_size)),
+                ]
+            else:
+                print("openssl not found, skipping TLS")
+
+            print(f"{args.queries} misses, concurrency {args.concurrency}, upstream latency "
+                  f"{args.latency * 1000:.1f} ms, UDP loss {args.loss:.0%}")
+            print(f"{'transport':<14} {'qps':>8} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7} {'connections':>12}")
+            for name, make in transports:
+                upstream = make()
+                qps, p50, p99, failures = asyncio.run(
+                    run_transport(upstream, args.queries, args.concurrency, args.timeout))
+                connects = getattr(upstream, "connects", "-")
+                print(f"{name:<14} {qps:>8.0f} {p50:>8.2f} {p99:>8.2f} {failures:>7} {connects:>12}")
+        finally:
+            upstream_proc.terminate()
+            upstream_proc.wait()
+
+
+if __name__ == "__main__":
+    main()
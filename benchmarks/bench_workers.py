@@ -0,0 +1,112 @@
+"""
+Load test: static-record throughput of the server with 1, 2, 4, ... workers.
+
+Starts the server with WORKERS=N on a free port, waits until it answers,
+blasts it from several client processes for a few seconds and reports
+answered queries per second.
+Throughput only scales up to the number of CPU cores available.
+
+Usage: python3 benchmarks/bench_workers.py [max_workers] [seconds] [clients]
+"""
+import configparser
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_suite import ROOT, SERVER, free_port, wait_until_answering, write_zones
+
+WINDOW = 32
+
+
+def write_config(directory, workers, engine, port):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "LISTEN_IP": "127.0.0.1",
+        "LISTEN_PORT": str(port),
+        "FORWARDERS": "127.0.0.1:9",
+        "LOG_LEVEL": "ERROR",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ENGINE": engine,
+        "WORKERS": str(workers),
+    }
+    path = os.path.join(directory, f"bench_{workers}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def build_query(query_id):
+    # host0.zone0.bench A IN, RD set
+    qname = b"\x05host0\x05zone0\x05bench\x00"
+    return query_id.to_bytes(2, "big") + b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + qname + b"\x00\x01\x00\x01"
+
+
+def client(port, seconds, result):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(0.2)
+    queries = [build_query(i) for i in range(WINDOW)]
+    answered = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for packet in queries:
+            sock.send(packet)
+        for _ in queries:
+            try:
+                sock.recv(4096)
+                answered += 1
+            except socket.timeout:
+                break
+    result.put(answered)
+
+
+def measure(directory, workers, seconds, clients):
+    port = free_port()
+    config_path = write_config(directory, workers, "sync", port)
+    server = subprocess.Popen([sys.executable, "-c", SERVER.format(src=os.path.join(ROOT, "src"), config=config_path)])
+    try:
+        try:
+            wait_until_answering(port)
+        except RuntimeError:
+            sys.exit(f"Server with {workers} workers did not answer on 127.0.0.1:{port}")
+        result = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client, args=(port, seconds, result)) for _ in range(clients)]
+        for proc in procs:
+            proc.start()
+        total = sum(result.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+        return total / seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else max(2, max_workers)
+
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+
+    print(f"{os.cpu_count()} CPUs, {clients} client processes, {seconds:.0f}s per run")
+    print(f"{'workers':>8} {'qps':>10} {'scaling':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        write_zones(os.path.join(directory, "zones"), 1, 1)
+        baseline = None
+        for workers in counts:
+            qps = measure(directory, workers, seconds, clients)
+            baseline = baseline or qps
+            print(f"{workers:>8} {qps:>10.0f} {qps / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Measures converting a large zone file to JSON and exporting it back:
+wall time and peak memory (max RSS) of each step, every one run in a fresh
+process. For comparison the zone is also loaded whole with
+dns.zone.from_file, as the converter used to do.
+
+Usage: python3 benchmarks/bench_zone_convert.py [records]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+STEPS = {
+    "dns.zone.from_file": "import dns.zone; dns.zone.from_file({zone!r}, origin=None, relativize=False)",
+    "convert (stream)": "from zone_converter import convert_zone_to_json; convert_zone_to_json({zone!r}, {json!r})",
+    "export (stream)": "from zone_exporter import export_json_to_zone; export_json_to_zone({json!r}, {out!r})",
+}
+
+
+def write_zone(path, records):
+    with open(path, "w") as f:
+        f.write("$ORIGIN bench.test.\n$TTL 3600\n")
+        f.write("@ IN SOA ns1 hostmaster 1 7200 3600 1209600 3600\n@ IN NS ns1\n")
+        for index in range(records):
+            f.write(f"host{index} IN A 10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}\n")
+            if index % 10 == 0:
+                f.write(f"alias{index} IN CNAME host{index}\n")
+
+
+def run_step(code):
+    """
+    Runs code in a fresh interpreter; returns (seconds, max RSS in MiB).
+    """
+    started = time.monotonic()
+    proc = subprocess.Popen([sys.executable, "-c", f"import sys; sys.path.insert(0, {SRC!r}); {code}"],
+                            stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(f"step failed with status {proc.returncode}")
+    return time.monotonic() - started, usage.ru_maxrss / 1024
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {name: os.path.join(directory, name) for name in ("zone", "json", "out")}
+        write_zone(paths["zone"], records)
+        print(f"{records} A records, {os.path.getsize(paths['zone']) / 1048576:.1f} MiB zone file")
+        print(f"{'step':<20} {'seconds':>8} {'max RSS MiB':>12}")
+        for name, code in STEPS.items():
+            seconds, rss = run_step(code.format(**paths))
+            print(f"{name:<20} {seconds:>8.2f} {rss:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Microbenchmark: linear zone scan (the old get_static_response loop) versus
+the reversed-label ZoneIndex, at 10, 1k and 10k loaded zones.
+
+Usage: python3 benchmarks/bench_zone_lookup.py [iterations]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from zone_index import ZoneIndex
+
+
+def make_zones(count):
+    zones = {}
+    for i in range(count):
+        zones[f"zone{i}.example"] = {"A": {"@": "127.0.0.1", "www": "127.0.0.1"}}
+    zones["127.in-addr.arpa"] = {"PTR": {"1.0.0": "localhost."}}
+    return zones
+
+
+def linear_scan(static_records, qname, qtype_text):
+    """
+    The zone matching loop from the original get_static_response.
+    """
+    matched_zone_name = None
+    for zone_name in static_records.keys():
+        normalized_zone_name = zone_name if zone_name.endswith('.') else zone_name + '.'
+        if qtype_text == 'PTR' and qname.endswith('in-addr.arpa.'):
+            if normalized_zone_name.endswith('in-addr.arpa.') and qname.endswith(normalized_zone_name):
+                if matched_zone_name is None or len(normalized_zone_name) > len(matched_zone_name):
+                    matched_zone_name = normalized_zone_name
+        elif qname.endswith(normalized_zone_name):
+            if matched_zone_name is None or len(normalized_zone_name) > len(matched_zone_name):
+                matched_zone_name = normalized_zone_name
+    if matched_zone_name:
+        zone_data = static_records[matched_zone_name.rstrip('.')]
+        subdomain = qname[:-len(matched_zone_name)].rstrip('.') or "@"
+        return zone_data.get(qtype_text, {}).get(subdomain)
+    return None
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'zones':>8} {'scan us/q':>12} {'index us/q':>12} {'speedup':>9}")
+    for count in (10, 1000, 10000):
+        zones = make_zones(count)
+        index = ZoneIndex(zones)
+        rnd = random.Random(count)
+        queries = [(f"www.zone{rnd.randrange(count)}.example.", 'A') for _ in range(64)]
+        queries += [("1.0.0.127.in-addr.arpa.", 'PTR'), ("miss.example.org.", 'A')]
+
+        # Both paths must agree before timing them
+        for qname, qtype_text in queries:
+            _, records = index.lookup(qname)
+            indexed = records.get(qtype_text) if records else None
+            assert indexed == linear_scan(zones, qname, qtype_text), qname
+
+        def run_scan():
+            for qname, qtype_text in queries:
+                linear_scan(zones, qname, qtype_text)
+
+        def run_index():
+            for qname, _ in queries:
+                index.lookup(qname)
+
+        # Keep the 10k scan affordable
+        scan_iterations = max(1, iterations * 10 // count)
+        scan = timeit.timeit(run_scan, number=scan_iterations) / (scan_iterations * len(queries))
+        indexed = timeit.timeit(run_index, number=iterations) / (iterations * len(queries))
+        print(f"{count:>8} {scan * 1e6:>12.2f} {indexed * 1e6:>12.2f} {scan / indexed:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark: startup time and memory of loading zones from JSON (parse and
+compile every record) versus opening a compiled, mmapped zone snapshot, for
+zones of 1k, 10k and 100k records.
+
+Each measurement runs in a fresh process so RSS numbers are comparable.
+
+Usage: python3 benchmarks/bench_zone_snapshot.py [record counts...]
+"""
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+MEASURE = """
+import logging, resource, sys, time
+sys.path.insert(0, {src!r})
+logging.disable(logging.CRITICAL)
+started = time.perf_counter()
+from app import DNSResolver
+resolver = DNSResolver({config!r})
+startup = time.perf_counter() - started
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+for i in range(0, {records}, max(1, {records} // 10000)):
+    assert resolver.lookup_static(f"host{{i}}.bench.example.", 1) is not None
+lookups = time.perf_counter() - started
+print(type(resolver.zone_index).__name__, startup, rss, lookups / min(10000, {records}))
+"""
+
+
+def write_zone(directory, records):
+    zone = {"A": {f"host{i}": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(records)}}
+    with open(os.path.join(directory, "bench.example.json"), "w") as f:
+        json.dump(zone, f)
+
+
+def write_config(directory, name, snapshot):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "LOG_LEVEL": "ERROR",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ZONES_SNAPSHOT": snapshot,
+    }
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def measure(config_path, records):
+    code = MEASURE.format(src=os.path.join(ROOT, "src"), config=config_path, records=records)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    kind, startup, rss, lookup = output.split()
+    return kind, float(startup), int(rss), float(lookup)
+
+
+def main():
+    counts = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    print(f"{'records':>8} {'source':>13} {'startup s':>10} {'max RSS KiB':>12} {'lookup us':>10}")
+    for records in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "zones"))
+            write_zone(os.path.join(directory, "zones"), records)
+            json_config = write_config(directory, "json.ini", "")
+            snapshot_config = write_config(directory, "snapshot.ini", os.path.join(directory, "zones.snap"))
+            # The first run with a snapshot path compiles the zones and writes it
+            measure(snapshot_config, records)
+            for config_path in (json_config, snapshot_config):
+                kind, startup, rss, lookup = measure(config_path, records)
+                label = "JSON" if kind == "ZoneIndex" else "snapshot"
+                print(f"{records:>8} {label:>13} {startup:>10.3f} {rss:>12} {lookup * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Check: answers for CNAME chains that end in the loaded zones, leave them or
+loop, on both engines, against the stand-in upstream. The sync engine
+builds the zone snapshot and the async engine starts from it.
+
+- A chain that ends in the zones is answered in full from them.
+- A chain that leaves the zones is answered with the chain followed by the
+  upstream's answer (and rcode) for its last target.
+- A chain that loops is answered with SERVFAIL.
+
+Usage: python3 benchmarks/check_cname_chains.py
+"""
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from dns import message, rcode, rdatatype
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+
+from bench_suite import ROOT, SERVER, free_port
+from check_malformed_queries import exchange_tcp, exchange_udp
+
+ZONE = {
+    "A": {"host": "192.0.2.1"},
+    "CNAME": {
+        "alias": "host",
+        "external": "www.example.net.",
+        "via": "external",
+        "gone": "x.nxdomain.test.",
+        "loop1": "loop2",
+        "loop2": "loop1",
+    },
+}
+# (name, type, rcode, [(owner, type) of the answer records])
+EXPECTED = [
+    ("alias.chains.test.", "A", rcode.NOERROR,
+     [("alias.chains.test.", "CNAME"), ("host.chains.test.", "A")]),
+    ("external.chains.test.", "A", rcode.NOERROR,
+     [("external.chains.test.", "CNAME"), ("www.example.net.", "A")]),
+    ("via.chains.test.", "AAAA", rcode.NOERROR,
+     [("via.chains.test.", "CNAME"), ("external.chains.test.", "CNAME"), ("www.example.net.", "AAAA")]),
+    ("external.chains.test.", "CNAME", rcode.NOERROR, [("external.chains.test.", "CNAME")]),
+    ("gone.chains.test.", "A", rcode.NXDOMAIN, [("gone.chains.test.", "CNAME")]),
+    ("loop1.chains.test.", "A", rcode.SERVFAIL, []),
+]
+
+
+def write_config(directory, engine, port, upstream_port):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "LISTEN_IP": "127.0.0.1",
+        "LISTEN_PORT": str(port),
+        "FORWARDERS": f"127.0.0.1:{upstream_port}",
+        "LOG_LEVEL": "ERROR",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ZONES_SNAPSHOT": os.path.join(directory, "zones.snap"),
+        "ENGINE": engine,
+        "ZONES_WATCH": "off",
+        "LISTEN_TCP": "yes",
+    }
+    path = os.path.join(directory, f"{engine}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def wait_until_answering(port, timeout=30.0):
+    query = message.make_query("host.chains.test.", "A").to_wire()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if exchange_udp(port, query) is not None:
+            return
+    raise RuntimeError("server did not start answering")
+
+
+def check_engine(engine, directory, upstream_port):
+    port = free_port()
+    config_path = write_config(directory, engine, port, upstream_port)
+    server = subprocess.Popen([sys.executable, "-c", SERVER.format(src=os.path.join(ROOT, "src"),
+                                                                    config=config_path)])
+    try:
+        wait_until_answering(port)
+        for qname, qtype, expected_rcode, expected_answer in EXPECTED:
+            for transport, exchange in (("udp", exchange_udp), ("tcp", exchange_tcp)):
+                reply = exchange(port, message.make_query(qname, qtype).to_wire())
+                assert reply is not None, f"{engine}/{transport}: no reply for {qname} {qtype}"
+                response = message.from_wire(reply)
+                answer = [(rrset.name.to_text(), rdatatype.to_text(rrset.rdtype)) for rrset in response.answer]
+                assert response.rcode() == expected_rcode and answer == expected_answer, \
+                    f"{engine}/{transport}: {qname} {qtype} got {rcode.to_text(response.rcode())} {answer}"
+            print(f"{engine:<6} {qname} {qtype}: {rcode.to_text(expected_rcode)}, {len(expected_answer)} records")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "zones"))
+        with open(os.path.join(directory, "zones", "chains.test.json"), "w") as f:
+            json.dump(ZONE, f)
+        upstream_port = free_port()
+        upstream = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, "fake_upstream.py"),
+                                     "--port", str(upstream_port), "--latency", "0.001"],
+                                    stdout=subprocess.DEVNULL)
+        try:
+            for engine in ("sync", "async"):
+                check_engine(engine, directory, upstream_port)
+        finally:
+            upstream.terminate()
+            upstream.wait()
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Check: identical queries forwarded at the same time on the async engine
+share one upstream lookup, against a slow stand-in upstream running
+in-process (so its query count can be read).
+
+1. N identical queries sent together make one upstream query, every client
+   gets its own query ID back, and N - 1 are counted in
+   magicdns_coalesced_total.
+2. The same question with and without EDNS makes one upstream query each,
+   and every reply has an OPT record exactly when its query had one.
+
+Usage: python3 benchmarks/check_coalescing.py
+"""
+import asyncio
+import configparser
+import os
+import random
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, "..", "src"))
+
+from dns import message
+
+from app import DNSResolver
+from async_server import AsyncDNSServer
+from bench_suite import free_port
+from fake_upstream import FakeUpstream
+
+QUERIES = 20
+# Long enough for all queries to arrive while the first one is forwarded
+UPSTREAM_LATENCY = 0.3
+
+
+async def start_upstream():
+    """
+    Starts a slow stand-in upstream on a free port; returns (forwarder, upstream).
+    """
+    port = free_port()
+    upstream = FakeUpstream(UPSTREAM_LATENCY, 0.0, 0.0, 60, random.Random(1))
+    await asyncio.get_running_loop().create_datagram_endpoint(lambda: upstream, local_addr=("127.0.0.1", port))
+    return f"127.0.0.1:{port}", upstream
+
+
+def make_server(directory, forwarder):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "FORWARDERS": forwarder,
+        "FORWARD_TIMEOUT": "2",
+        "LOG_LEVEL": "CRITICAL",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ENGINE": "async",
+    }
+    path = os.path.join(directory, "check.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return AsyncDNSServer(DNSResolver(path))
+
+
+async def forward_all(server, requests):
+    """
+    Forwards all requests at once; returns their replies as dns.message.
+    """
+    results = await asyncio.gather(*(server.forward(request, request.to_wire()) for request in requests))
+    return [message.from_wire(response_wire) for response_wire, _ in results]
+
+
+def coalesced_total(resolver):
+    for name, _, _, samples in resolver.metric_families():
+        if name == "magicdns_coalesced_total":
+            return samples[0][1]
+    raise AssertionError("magicdns_coalesced_total not exported")
+
+
+async def check_identical(server, upstream):
+    received = upstream.received
+    requests = [message.make_query("same.coalesce.test.", "A") for _ in range(QUERIES)]
+    replies = await forward_all(server, requests)
+    assert upstream.received == received + 1, f"{upstream.received - received} upstream queries for one question"
+    for request, reply in zip(requests, replies):
+        assert reply.id == request.id and reply.answer, "waiter got a wrong reply"
+    assert coalesced_total(server.resolver) == QUERIES - 1
+    print(f"{QUERIES} identical queries: 1 upstream query, {QUERIES - 1} coalesced")
+
+
+async def check_edns(server, upstream):
+    received = upstream.received
+    requests = [message.make_query("edns.coalesce.test.", "A", use_edns=0 if index % 2 else False)
+                for index in range(QUERIES)]
+    replies = await forward_all(server, requests)
+    assert upstream.received == received + 2, \
+        f"{upstream.received - received} upstream queries for one question with and without EDNS"
+    for request, reply in zip(requests, replies):
+        assert (reply.edns >= 0) == (request.edns >= 0), \
+            f"query with EDNS {request.edns} got a reply with EDNS {reply.edns}"
+    print(f"{QUERIES} queries with and without EDNS: 2 upstream queries, OPT only where asked for")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "zones"))
+        forwarder, upstream = await start_upstream()
+        server = make_server(directory, forwarder)
+        try:
+            await check_identical(server, upstream)
+            await check_edns(server, upstream)
+        finally:
+            server.close()
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""
+Check: packets the server cannot answer normally get a clean reply or are
+dropped, on both engines and over UDP and TCP, and never leave a traceback
+in the server log.
+
+Sends a query without a question (QDCOUNT=0), which must get FORMERR (or
+no reply), then a normal static query, which must still be answered.
+
+Usage: python3 benchmarks/check_malformed_queries.py
+"""
+import configparser
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+
+from dns import message, rcode
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+
+from bench_suite import ROOT, SERVER, free_port, wait_until_answering, write_zones
+
+ENGINES = ("sync", "async")
+
+
+def write_config(directory, engine, port):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "LISTEN_IP": "127.0.0.1",
+        "LISTEN_PORT": str(port),
+        # Nothing listens there; no query in this check is forwarded
+        "FORWARDERS": f"127.0.0.1:{free_port()}",
+        "FORWARD_TIMEOUT": "0.5",
+        "LOG_LEVEL": "WARNING",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ENGINE": engine,
+        "ZONES_WATCH": "off",
+        "LISTEN_TCP": "yes",
+    }
+    path = os.path.join(directory, f"{engine}.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def exchange_udp(port, wire):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1.0)
+        sock.sendto(wire, ("127.0.0.1", port))
+        try:
+            return sock.recv(65535)
+        except socket.timeout:
+            return None
+
+
+def exchange_tcp(port, wire):
+    with socket.create_connection(("127.0.0.1", port), timeout=1.0) as sock:
+        sock.sendall(struct.pack('!H', len(wire)) + wire)
+        try:
+            header = sock.recv(2)
+            if len(header) < 2:
+                return None
+            length = struct.unpack('!H', header)[0]
+            data = b''
+            while len(data) < length:
+                chunk = sock.recv(length - len(data))
+                if not chunk:
+                    return None
+                data += chunk
+            return data
+        except socket.timeout:
+            return None
+
+
+def check_engine(engine, directory):
+    port = free_port()
+    config_path = write_config(directory, engine, port)
+    log_path = os.path.join(directory, f"{engine}.log")
+    with open(log_path, "w") as log:
+        server = subprocess.Popen([sys.executable, "-c", SERVER.format(src=os.path.join(ROOT, "src"),
+                                                                        config=config_path)],
+                                  stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_until_answering(port)
+        empty = message.Message(id=0x1234)
+        static = message.make_query("host0.zone0.bench.", "A")
+        for transport, exchange in (("udp", exchange_udp), ("tcp", exchange_tcp)):
+            empty_reply = exchange(port, empty.to_wire())
+            if empty_reply is not None:
+                response = message.from_wire(empty_reply)
+                assert response.id == empty.id, f"{engine}/{transport}: wrong ID in reply to an empty query"
+                assert response.rcode() == rcode.FORMERR, \
+                    f"{engine}/{transport}: expected FORMERR, got {rcode.to_text(response.rcode())}"
+            reply = exchange(port, static.to_wire())
+            assert reply is not None, f"{engine}/{transport}: no answer after an empty query"
+            assert message.from_wire(reply).answer, f"{engine}/{transport}: static query not answered"
+            print(f"{engine:<6} {transport}: {'FORMERR' if empty_reply else 'dropped'}, still answering")
+    finally:
+        server.terminate()
+        server.wait()
+    with open(log_path) as log:
+        output = log.read()
+    assert "Traceback" not in output and "Exception" not in output, f"{engine}: errors in the log:\n{output}"
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        write_zones(os.path.join(directory, "zones"), 1, 1)
+        for engine in ENGINES:
+            check_engine(engine, directory)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Check: forwarder racing and selection on the async engine, against
+stand-in upstreams running in-process (so their query counts can be read).
+
+1. A forwarder that drops every query is listed before a fast one. The
+   first query is answered in about the hedge delay, not FORWARD_TIMEOUT,
+   and later queries go to the fast forwarder first. The dead forwarder's
+   failure is forgotten after FORWARDER_HOLDDOWN seconds.
+2. The dead forwarder is listed before a slow one. After
+   FORWARDER_FAILURE_THRESHOLD failures it is held back and gets no
+   queries; once the hold-down is over, the next query probes it again.
+
+Usage: python3 benchmarks/check_upstream_selection.py
+"""
+import asyncio
+import configparser
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+sys.path.insert(0, os.path.join(BENCHMARKS, "..", "src"))
+
+from dns import message
+
+from app import DNSResolver
+from async_server import AsyncDNSServer
+from bench_suite import free_port
+from fake_upstream import FakeUpstream
+
+FORWARD_TIMEOUT = 0.5
+FAILURE_THRESHOLD = 3
+HOLDDOWN = 1.5
+# Scheduling slack allowed on top of an expected delay
+SLACK = 0.1
+
+
+async def start_upstream(latency, loss):
+    """
+    Starts a stand-in upstream on a free port; returns (forwarder, upstream).
+    """
+    port = free_port()
+    upstream = FakeUpstream(latency, 0.0, loss, 60, random.Random(1))
+    await asyncio.get_running_loop().create_datagram_endpoint(lambda: upstream, local_addr=("127.0.0.1", port))
+    return f"127.0.0.1:{port}", upstream
+
+
+def make_server(directory, forwarders):
+    config = configparser.ConfigParser()
+    config["DNS"] = {
+        "FORWARDERS": ",".join(forwarders),
+        "FORWARD_TIMEOUT": str(FORWARD_TIMEOUT),
+        "QUERY_TIMEOUT": "3",
+        "FORWARDER_FAILURE_THRESHOLD": str(FAILURE_THRESHOLD),
+        "FORWARDER_HOLDDOWN": str(HOLDDOWN),
+        "LOG_LEVEL": "CRITICAL",
+        "ZONES_DIR": os.path.join(directory, "zones"),
+        "ENGINE": "async",
+    }
+    path = os.path.join(directory, "check.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return AsyncDNSServer(DNSResolver(path))
+
+
+async def timed_query(server, name):
+    request = message.make_query(name, "A")
+    started = time.monotonic()
+    reply = await server.query_upstreams(request, request.to_wire())
+    assert reply is not None, f"no reply for {name}"
+    return time.monotonic() - started
+
+
+async def check_hedging(directory):
+    lossy, lossy_upstream = await start_upstream(0.005, 1.0)
+    fast, _ = await start_upstream(0.005, 0.0)
+    server = make_server(directory, [lossy, fast])
+    selector = server.selector
+    try:
+        assert selector.ordered()[0] == lossy
+        hedge = selector.hedge_delay(lossy)
+        elapsed = await timed_query(server, "first.hedge.test.")
+        print(f"first query: {elapsed * 1000:.0f} ms (hedge delay {hedge * 1000:.0f} ms, "
+              f"FORWARD_TIMEOUT {FORWARD_TIMEOUT * 1000:.0f} ms)")
+        assert elapsed < hedge + SLACK, "first query waited for the lossy forwarder"
+
+        # Let the lossy forwarder's attempt time out and count as a failure
+        await asyncio.sleep(FORWARD_TIMEOUT + SLACK)
+        assert selector.states[lossy].failures == 1
+        received = lossy_upstream.received
+        for index in range(5):
+            assert selector.ordered()[0] == fast, "fast forwarder not tried first"
+            elapsed = await timed_query(server, f"q{index}.hedge.test.")
+            assert elapsed < selector.hedge_delay(fast) + SLACK
+        assert lossy_upstream.received == received, "lossy forwarder still asked"
+        print("later queries: fast forwarder first, lossy one not asked")
+
+        await asyncio.sleep(HOLDDOWN)
+        selector.ordered()
+        assert selector.states[lossy].failures == 0, "failure not forgotten after the hold-down"
+        print(f"lossy forwarder's failure forgotten after {HOLDDOWN} s")
+    finally:
+        server.close()
+
+
+async def check_holddown(directory):
+    dead, dead_upstream = await start_upstream(0.005, 1.0)
+    slow, _ = await start_upstream(0.2, 0.0)
+    server = make_server(directory, [dead, slow])
+    selector = server.selector
+    try:
+        for index in range(FAILURE_THRESHOLD):
+            assert selector.ordered()[0] == dead, "dead forwarder held back too early"
+            await timed_query(server, f"fail{index}.holddown.test.")
+            await asyncio.sleep(FORWARD_TIMEOUT + SLACK)
+        state = selector.states[dead]
+        assert state.failures == FAILURE_THRESHOLD and state.held_until > time.monotonic()
+        print(f"dead forwarder held back after {state.failures} failures")
+
+        received = dead_upstream.received
+        for index in range(3):
+            assert selector.ordered()[0] == slow, "held back forwarder tried first"
+            await timed_query(server, f"held{index}.holddown.test.")
+        assert dead_upstream.received == received, "held back forwarder still asked"
+
+        await asyncio.sleep(HOLDDOWN)
+        assert selector.ordered()[0] == dead, "dead forwarder not probed after the hold-down"
+        await timed_query(server, "probe.holddown.test.")
+        assert dead_upstream.received == received + 1
+        print(f"dead forwarder probed again after {HOLDDOWN} s")
+    finally:
+        server.close()
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "zones"))
+        await check_hedging(directory)
+        await check_holddown(directory)
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+"""
+Stand-in upstream resolver for benchmarks: answers every query after a fixed
+latency (plus optional jitter), drops a fraction of them, and never touches
+the network beyond localhost.
+
+A and AAAA queries get one synthetic address, PTR queries a synthetic name,
+anything else an empty NOERROR. Names under nxdomain.<tld> (such as
+x.nxdomain.test) get NXDOMAIN with an SOA, so negative caching can be
+exercised too. Replies that do not fit in 512 bytes (or the query's EDNS
+size) are truncated, and the same answers are served over TCP on the same
+port, and over TLS on --tls-port if a certificate is given. Queries
+pipelined on one connection are answered concurrently, each after its own
+delay.
+
+Usage: python3 benchmarks/fake_upstream.py [--port 5390] [--latency 0.01]
+       [--jitter 0] [--loss 0] [--ttl 60] [--seed 1]
+       [--tls-port 5391 --tls-cert cert.pem --tls-key key.pem]
+"""
+import argparse
+import asyncio
+import random
+import ssl
+import struct
+import zlib
+
+from dns import message, rcode, rdatatype, rrset
+
+FLAG_TC = 0x0200
+
+
+def build_reply(request, ttl):
+    """
+    Returns the synthetic reply to a parsed query in wire format.
+    """
+    response = message.make_response(request)
+    question = request.question[0]
+    labels = question.name.labels
+    if len(labels) > 2 and labels[-3].lower() == b"nxdomain":
+        response.set_rcode(rcode.NXDOMAIN)
+        response.authority.append(rrset.from_text(
+            question.name.parent(), ttl, 'IN', 'SOA', f"ns.invalid. hostmaster.invalid. 1 3600 600 86400 {ttl}"
+        ))
+        return response.to_wire(max_size=65535)
+
+    # Stable per-name data, so repeated runs get the same answers
+    digest = zlib.crc32(question.name.to_text().lower().encode())
+    if question.rdtype == rdatatype.A:
+        value = f"10.{digest >> 16 & 255}.{digest >> 8 & 255}.{digest & 255}"
+    elif question.rdtype == rdatatype.AAAA:
+        value = f"fd00::{digest >> 16:x}:{digest & 0xFFFF:x}"
+    elif question.rdtype == rdatatype.PTR:
+        value = f"host-{digest:x}.upstream.invalid."
+    else:
+        value = None
+    if value is not None:
+        response.answer.append(rrset.from_text(question.name, ttl, 'IN', question.rdtype, value))
+    return response.to_wire(max_size=65535)
+
+
+def parse(data):
+    try:
+        return message.from_wire(data)
+    except Exception:
+        return None
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    def __init__(self, latency, jitter, loss, ttl, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.ttl = ttl
+        self.rng = rng
+        self.transport = None
+        self.received = 0
+        self.dropped = 0
+        self.connections = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def delay(self):
+        return self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        request = parse(data)
+        if request is None:
+            return
+        reply = build_reply(request, self.ttl)
+        # Truncate to what the client accepts: 512 bytes, or its EDNS buffer size
+        if len(reply) > (max(request.payload, 512) if request.edns >= 0 else 512):
+            question_end = 12 + len(request.question[0].name.to_wire()) + 4
+            flags = struct.unpack_from('!H', reply, 2)[0] | FLAG_TC
+            reply = reply[:2] + struct.pack('!HHHHH', flags, 1, 0, 0, 0) + reply[12:question_end]
+        asyncio.get_running_loop().call_later(self.delay(), self.transport.sendto, reply, addr)
+
+    async def handle_tcp(self, reader, writer):
+        self.connections += 1
+        replies = set()
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                data = await reader.readexactly(length)
+                request = parse(data)
+                if request is None:
+                    break
+                reply = asyncio.ensure_future(self._reply_tcp(request, writer))
+                replies.add(reply)
+                reply.add_done_callback(replies.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            if replies:
+                await asyncio.wait(replies)
+            writer.close()
+
+    async def _reply_tcp(self, request, writer):
+        await asyncio.sleep(self.delay())
+        if not writer.is_closing():
+            reply = build_reply(request, self.ttl)
+            writer.write(len(reply).to_bytes(2, 'big') + reply)
+
+
+async def serve(host, port, latency, jitter=0.0, loss=0.0, ttl=60, seed=1, tls_port=None, tls_cert=None,
+                tls_key=None):
+    """
+    Runs the fake upstream on host:port (UDP and TCP), and with a
+    certificate on host:tls_port (TLS), until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    upstream = FakeUpstream(latency, jitter, loss, ttl, random.Random(seed))
+    transport, _ = await loop.create_datagram_endpoint(lambda: upstream, local_addr=(host, port))
+    servers = [await asyncio.start_server(upstream.handle_tcp, host, port)]
+    if tls_port and tls_cert:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(tls_cert, tls_key)
+        servers.append(await asyncio.start_server(upstream.handle_tcp, host, tls_port, ssl=context))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(f"fake upstream: {upstream.received} UDP queries, {upstream.connections} TCP/TLS connections",
+              flush=True)
+        for server in servers:
+            server.close()
+        transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in upstream DNS server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5390)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds before each reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random delay, up to this many seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of UDP queries dropped")
+    parser.add_argument("--ttl", type=int, default=60, help="TTL of the synthetic answers")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tls-port", type=int, help="also serve DNS over TLS on this port")
+    parser.add_argument("--tls-cert", help="certificate (PEM) for --tls-port")
+    parser.add_argument("--tls-key", help="private key (PEM) for --tls-cert, if not in the same file")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.latency, args.jitter, args.loss, args.ttl, args.seed,
+                          args.tls_port, args.tls_cert, args.tls_key))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
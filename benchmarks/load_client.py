@@ -0,0 +1,157 @@
+"""
+dnsperf-style UDP load generator for the benchmark suite.
+
+Keeps a fixed number of queries outstanding on one socket (closed loop):
+every reply or timeout immediately sends the next query. Latencies are
+measured per query from send to reply.
+"""
+import asyncio
+import time
+
+
+class LoadResult:
+    """
+    Outcome of one load run. latencies are in seconds, one per answered query.
+    """
+    def __init__(self, duration, sent, latencies, lost, rcodes):
+        self.duration = duration
+        self.sent = sent
+        self.latencies = latencies
+        self.lost = lost
+        self.rcodes = rcodes
+
+    @property
+    def answered(self):
+        return len(self.latencies)
+
+    def summary(self):
+        """
+        Returns the result as a JSON-serialisable dict; latencies in ms.
+        """
+        ordered = sorted(self.latencies)
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 4)
+
+        def at(fraction):
+            return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] if ordered else None
+
+        return {
+            "duration_s": round(self.duration, 3),
+            "sent": self.sent,
+            "answered": self.answered,
+            "lost": self.lost,
+            "qps": round(self.answered / self.duration, 1) if self.duration else 0.0,
+            "p50_ms": ms(at(0.5)),
+            "p99_ms": ms(at(0.99)),
+            "p999_ms": ms(at(0.999)),
+            "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else None,
+            "max_ms": ms(ordered[-1]) if ordered else None,
+            "rcodes": {str(code): count for code, count in sorted(self.rcodes.items())},
+        }
+
+
+class _LoadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.reply_received(data)
+
+    def error_received(self, exc):
+        pass
+
+
+class LoadClient:
+    """
+    Sends queries produced by make_query(query_id) -> wire bytes to target,
+    keeping concurrency of them outstanding. A query without a reply after
+    timeout seconds counts as lost.
+    """
+    def __init__(self, target, make_query, concurrency=64, timeout=2.0, clock=time.perf_counter):
+        self.target = target
+        self.make_query = make_query
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.clock = clock
+        self.transport = None
+        self.outstanding = {}  # {query_id: send time}
+        self.next_id = 0
+        self.recording = False
+        self.stopping = False
+        self.sent = 0
+        self.latencies = []
+        self.lost = 0
+        self.rcodes = {}
+
+    def _send(self):
+        if self.stopping:
+            return
+        while True:
+            self.next_id = (self.next_id + 1) & 0xFFFF
+            if self.next_id not in self.outstanding:
+                break
+        query_id = self.next_id
+        self.outstanding[query_id] = self.clock()
+        self.transport.sendto(self.make_query(query_id))
+        if self.recording:
+            self.sent += 1
+
+    def reply_received(self, data):
+        if len(data) < 12:
+            return
+        query_id = int.from_bytes(data[:2], 'big')
+        sent_at = self.outstanding.pop(query_id, None)
+        if sent_at is None:
+            return
+        if self.recording:
+            self.latencies.append(self.clock() - sent_at)
+            response_rcode = data[3] & 0x0F
+            self.rcodes[response_rcode] = self.rcodes.get(response_rcode, 0) + 1
+        self._send()
+
+    def _expire(self):
+        deadline = self.clock() - self.timeout
+        expired = [query_id for query_id, sent_at in self.outstanding.items() if sent_at < deadline]
+        for query_id in expired:
+            del self.outstanding[query_id]
+            if self.recording:
+                self.lost += 1
+            self._send()
+
+    async def run(self, duration, warmup=0.0):
+        """
+        Runs the load for warmup + duration seconds and returns a LoadResult
+        for the last duration seconds.
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _LoadProtocol(self), remote_addr=self.target
+        )
+        try:
+            for _ in range(self.concurrency):
+                self._send()
+            if warmup:
+                await self._tick_until(self.clock() + warmup)
+            self.recording = True
+            started = self.clock()
+            await self._tick_until(started + duration)
+            elapsed = self.clock() - started
+            self.recording = False
+            self.stopping = True
+        finally:
+            self.transport.close()
+        return LoadResult(elapsed, self.sent, self.latencies, self.lost, self.rcodes)
+
+    async def _tick_until(self, end):
+        while self.clock() < end:
+            await asyncio.sleep(min(0.05, max(end - self.clock(), 0)))
+            self._expire()
+
+
+def run_load(target, make_query, duration, concurrency=64, timeout=2.0, warmup=0.0):
+    """
+    Convenience wrapper: runs a LoadClient in a fresh event loop.
+    """
+    client = LoadClient(target, make_query, concurrency, timeout)
+    return asyncio.run(client.run(duration, warmup))
@@ -8,10 +8,13 @@ LOG_FILE="server.log"
 
 # Function to display usage
 usage() {
-    echo "Usage: $0 [start|convert-zone <zone_file_path> <output_json_path>|export-zone <json_file_path> <output_zone_path>]"
+    echo "Usage: $0 [start|convert-zone <zone_file_path> <output_json_path>|export-zone <json_file_path> <output_zone_path>|convert-zones <zone_dir> <output_dir> [jobs]|export-zones <json_dir> <output_dir> [jobs]|build-snapshot [config_file]]"
     echo "  start: Starts the DNS server."
     echo "  convert-zone: Converts a standard zone file to magicDNS JSON format."
     echo "  export-zone: Converts a magicDNS JSON zone file to standard zone file format."
+    echo "  convert-zones: Converts every zone file in a directory, in parallel (jobs defaults to one per CPU)."
+    echo "  export-zones: Exports every JSON zone file in a directory, in parallel."
+    echo "  build-snapshot: Compiles the zones into the ZONES_SNAPSHOT file set in config_file (default config/config.ini)."
     exit 1
 }
 
@@ -51,6 +54,27 @@ case "$1" in
         echo "Exporting JSON zone file '$JSON_FILE' to standard zone file '$OUTPUT_ZONE'..."
         python3 src/zone_exporter.py "$JSON_FILE" "$OUTPUT_ZONE"
         ;;
+    convert-zones)
+        if [ "$#" -lt 3 ] || [ "$#" -gt 4 ]; then
+            echo "Error: Missing arguments for convert-zones."
+            usage
+        fi
+        echo "Converting zone files in '$2' to JSON in '$3'..."
+        python3 src/zone_converter.py --batch "$2" "$3" $4
+        ;;
+    export-zones)
+        if [ "$#" -lt 3 ] || [ "$#" -gt 4 ]; then
+            echo "Error: Missing arguments for export-zones."
+            usage
+        fi
+        echo "Exporting JSON zone files in '$2' to zone files in '$3'..."
+        python3 src/zone_exporter.py --batch "$2" "$3" $4
+        ;;
+    build-snapshot)
+        CONFIG="${2:-config/config.ini}"
+        echo "Building zone snapshot from '$CONFIG'..."
+        python3 src/zone_converter.py --snapshot "$CONFIG"
+        ;;
     *)
         echo "Error: Unknown command '$1'."
         usage
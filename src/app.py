@@ -1,11 +1,30 @@
+import asyncio
 import socket
 import logging
+import threading
+import time
 import json
 import configparser
-from dns import query, message, rcode, rrset, rdatatype
+import queue
+from dns import query, message, rcode, rdatatype, flags
 
 import os
 
+from async_server import AsyncDNSServer
+from metrics import Metrics, MetricsServer, copy_items
+from query_log import QueryLog, SOURCE_CACHE, SOURCE_STALE, SOURCE_STATIC, SOURCE_UPSTREAM
+from rate_limit import RESPOND, SLIP, RateLimiter
+from response_cache import ResponseCache, cache_key, prefetch_query, raw_cache_key
+from static_answers import CHAIN_EXTERNAL, CHAIN_KEY, chain_target, compile_answer, flatten_cname, question_wire
+from tcp_server import TCPListener
+from upstream import (DNS_PORT, DOT_PORT, TRANSPORT_TCP, TRANSPORT_TLS, TRANSPORT_UDP, AsyncStreamUpstream, AsyncUpstream,
+                      StreamPool, UpstreamSelector, parse_forwarder, tls_context)
+from wire import FLAG_QR, fit_udp, parse_query, truncated_reply
+from workers import run_workers
+from zone_index import ZoneIndex
+from zone_reload import ZoneWatcher
+from zone_snapshot import ZoneSnapshot, write_snapshot
+
 # --- Configuration ---
 CONFIG_FILE = "config/config.ini"
 
@@ -18,13 +37,89 @@ class DNSResolver:
         self.config.read(config_file)
         self.listen_ip = self.config.get("DNS", "LISTEN_IP", fallback="127.0.0.1")
         self.listen_port = self.config.getint("DNS", "LISTEN_PORT", fallback=5353)
-        self.forwarders = self.config.get("DNS", "FORWARDERS", fallback="8.8.8.8").split(',')
+        self.forwarders = [f.strip() for f in self.config.get("DNS", "FORWARDERS", fallback="8.8.8.8").split(',')]
+        self.engine = self.config.get("DNS", "ENGINE", fallback="sync")
+        self.forward_timeout = self.config.getfloat("DNS", "FORWARD_TIMEOUT", fallback=5)
+        self.workers = self.config.getint("DNS", "WORKERS", fallback=1)
+        self.forward_transport = self.config.get("DNS", "FORWARD_TRANSPORT", fallback=TRANSPORT_UDP).strip().lower()
+        if self.forward_transport not in (TRANSPORT_UDP, TRANSPORT_TCP, TRANSPORT_TLS):
+            logging.getLogger(__name__).warning(f"Unknown FORWARD_TRANSPORT {self.forward_transport!r}, using udp")
+            self.forward_transport = TRANSPORT_UDP
+        self.forward_pool_size = self.config.getint("DNS", "FORWARD_POOL_SIZE", fallback=2)
+        self.forward_idle_timeout = self.config.getfloat("DNS", "FORWARD_IDLE_TIMEOUT", fallback=30)
+        self.forward_tls_name = self.config.get("DNS", "FORWARD_TLS_NAME", fallback="").strip() or None
+        self.forward_ssl_context = None
+        if self.forward_transport == TRANSPORT_TLS:
+            self.forward_ssl_context = tls_context(
+                self.config.get("DNS", "FORWARD_TLS_CA", fallback="").strip(),
+                self.config.get("DNS", "FORWARD_TLS_CERT", fallback="").strip(),
+                self.config.get("DNS", "FORWARD_TLS_KEY", fallback="").strip(),
+            )
+        # Sync engine: persistent connections when forwarding over TCP or TLS
+        self.stream_pool = None
+        if self.forward_transport != TRANSPORT_UDP:
+            self.stream_pool = StreamPool(self.forward_ssl_context, self.forward_tls_name,
+                                          self.forward_pool_size, self.forward_idle_timeout)
+        self.async_upstreams = {}
+        # Async engine: forwarded queries that joined an identical lookup already in flight
+        self.coalesced_queries = 0
+        query_log_path = self.config.get("DNS", "QUERY_LOG", fallback="").strip()
+        self.query_log = None
+        if query_log_path:
+            self.query_log = QueryLog(
+                query_log_path,
+                sample_rate=self.config.getfloat("DNS", "QUERY_LOG_SAMPLE", fallback=1.0),
+                queue_size=self.config.getint("DNS", "QUERY_LOG_QUEUE", fallback=10000),
+            )
+        self.metrics_listen = self.config.get("DNS", "METRICS_LISTEN", fallback="").strip()
+        self.metrics = Metrics() if self.metrics_listen else None
+        # Set by run_workers in each worker; offsets the metrics port
+        self.worker_index = 0
+        rate_limit = self.config.getfloat("DNS", "RATE_LIMIT", fallback=0)
+        self.rate_limiter = None
+        if rate_limit > 0:
+            self.rate_limiter = RateLimiter(
+                rate_limit,
+                burst=self.config.getint("DNS", "RATE_LIMIT_BURST", fallback=0),
+                slip=self.config.getint("DNS", "RATE_LIMIT_SLIP", fallback=2),
+                ipv4_prefix=self.config.getint("DNS", "RATE_LIMIT_IPV4_PREFIX", fallback=32),
+                ipv6_prefix=self.config.getint("DNS", "RATE_LIMIT_IPV6_PREFIX", fallback=64),
+                table_size=self.config.getint("DNS", "RATE_LIMIT_TABLE_SIZE", fallback=262144),
+            )
+        self.max_udp_size = self.config.getint("DNS", "EDNS_UDP_SIZE", fallback=1232)
+        self.listen_tcp = self.config.getboolean("DNS", "LISTEN_TCP", fallback=True)
+        self.tcp_max_connections = self.config.getint("DNS", "TCP_MAX_CONNECTIONS", fallback=100)
+        self.tcp_idle_timeout = self.config.getfloat("DNS", "TCP_IDLE_TIMEOUT", fallback=10)
         self.log_level = self.config.get("DNS", "LOG_LEVEL", fallback="INFO")
         self.zones_dir = self.config.get("DNS", "ZONES_DIR", fallback="zones")
+        self.zones_snapshot = self.config.get("DNS", "ZONES_SNAPSHOT", fallback="")
         logging.basicConfig(level=self.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
         self.logger = logging.getLogger(__name__)
 
-        self.static_records = self.load_zones()
+        self.upstream_selector = UpstreamSelector(
+            self.forwarders,
+            failure_threshold=self.config.getint("DNS", "FORWARDER_FAILURE_THRESHOLD", fallback=3),
+            holddown=self.config.getfloat("DNS", "FORWARDER_HOLDDOWN", fallback=60),
+            hedge_min_delay=self.config.getfloat("DNS", "HEDGE_MIN_DELAY", fallback=0.02),
+            hedge_max_delay=self.forward_timeout,
+        )
+
+        self.reload_lock = threading.Lock()
+        # The sync engine answers UDP and TCP queries one at a time
+        self.query_lock = threading.Lock()
+        self.zone_index = self.load_zone_index()
+        self.response_cache = ResponseCache(
+            max_entries=self.config.getint("DNS", "CACHE_SIZE", fallback=10000),
+            max_bytes=self.config.getint("DNS", "CACHE_MAX_BYTES", fallback=0),
+            max_ttl=self.config.getint("DNS", "CACHE_MAX_TTL", fallback=86400),
+            negative_max_ttl=self.config.getint("DNS", "CACHE_NEGATIVE_MAX_TTL", fallback=3600),
+            serve_stale=self.config.getint("DNS", "CACHE_SERVE_STALE", fallback=86400),
+            prefetch_hits=self.config.getint("DNS", "CACHE_PREFETCH_HITS", fallback=3),
+            prefetch_window=self.config.getfloat("DNS", "CACHE_PREFETCH_WINDOW", fallback=0.1),
+        )
+        # Async engine: seconds to wait for the forwarders before answering stale
+        self.stale_answer_timeout = self.config.getfloat("DNS", "STALE_ANSWER_TIMEOUT", fallback=1.8)
+        self.prefetch_queue = queue.Queue(maxsize=1000)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def load_zones(self):
@@ -32,131 +127,686 @@ class DNSResolver:
         Loads all zone files from the zones directory.
         """
         zones = {}
+        self.zone_files = {}
         if not os.path.isdir(self.zones_dir):
             self.logger.warning(f"Zones directory not found: {self.zones_dir}")
             return zones
 
-        for filename in os.listdir(self.zones_dir):
+        self.zone_files = self._zone_file_stamps()
+        for filename in self.zone_files:
+            zone_data = self._read_zone_file(filename)
+            if zone_data is not None:
+                zones[filename[:-5]] = zone_data
+        return zones
+
+    def load_zone_index(self):
+        """
+        Returns the index static answers are served from: the ZONES_SNAPSHOT
+        file if it was built from the current zone files, otherwise the zones
+        in ZONES_DIR compiled into a ZoneIndex (and served from the snapshot
+        written from it).
+        """
+        self.zone_files = {}
+        if self.zones_snapshot:
+            snapshot = self._open_snapshot()
+            if snapshot is not None:
+                # Zone data is only read from JSON again on the next reload
+                self.zone_files = snapshot.stamps
+                self.logger.info(f"Loaded {snapshot.zone_count} zones from snapshot {self.zones_snapshot}")
+                return snapshot
+
+        zone_index = ZoneIndex(self.load_zones(), compile=self.compile_record, flatten=flatten_cname)
+        if self.zones_snapshot:
+            return self.snapshot_of(zone_index, self.zone_files)
+        return zone_index
+
+    def _open_snapshot(self):
+        """
+        Opens the zone snapshot if it exists and matches the zone files.
+        """
+        if not os.path.exists(self.zones_snapshot):
+            return None
+        try:
+            snapshot = ZoneSnapshot(self.zones_snapshot)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning(f"Ignoring unreadable zone snapshot {self.zones_snapshot}: {e}")
+            return None
+        if snapshot.stamps != self._zone_file_stamps():
+            self.logger.info(f"Zone snapshot {self.zones_snapshot} is out of date, rebuilding it")
+            snapshot.close()
+            return None
+        return snapshot
+
+    def snapshot_of(self, zone_index, stamps):
+        """
+        Writes the compiled zones to ZONES_SNAPSHOT and returns the snapshot
+        mapped from it, so the compiled records are not kept in memory and
+        worker processes share the snapshot's pages. Returns zone_index if the
+        snapshot cannot be written or read back.
+        """
+        try:
+            write_snapshot(self.zones_snapshot, zone_index, stamps)
+            self.logger.info(f"Wrote zone snapshot {self.zones_snapshot}")
+            snapshot = ZoneSnapshot(self.zones_snapshot)
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f"Failed to write zone snapshot {self.zones_snapshot}: {e}")
+            return zone_index
+        if snapshot.stamps != stamps:
+            # Another worker has already replaced it after a newer change
+            snapshot.close()
+            return zone_index
+        return snapshot
+
+    def _zone_file_stamps(self):
+        """
+        Returns {filename: (mtime, size, inode)} for the zone files, used to
+        tell which files changed since they were last read.
+        """
+        stamps = {}
+        try:
+            filenames = os.listdir(self.zones_dir)
+        except OSError as e:
+            self.logger.error(f"Cannot list zones directory {self.zones_dir}: {e}")
+            return dict(self.zone_files)
+        for filename in filenames:
             if filename.endswith(".json"):
-                zone_name = filename[:-5]
                 try:
-                    with open(os.path.join(self.zones_dir, filename), 'r') as f:
-                        zone_data = json.load(f)
-                        zones[zone_name] = zone_data
-                        self.logger.info(f"Loaded zone: {zone_name}")
-                except json.JSONDecodeError:
-                    self.logger.error(f"Error decoding JSON from {filename}")
-        return zones
+                    st = os.stat(os.path.join(self.zones_dir, filename))
+                except OSError:
+                    continue
+                stamps[filename] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return stamps
+
+    def _read_zone_file(self, filename):
+        """
+        Reads one zone file. Returns the zone data, or None if it is unreadable
+        or not a JSON object.
+        """
+        zone_name = filename[:-5]
+        try:
+            with open(os.path.join(self.zones_dir, filename), 'r') as f:
+                zone_data = json.load(f)
+        except json.JSONDecodeError:
+            self.logger.error(f"Error decoding JSON from {filename}")
+            return None
+        except OSError as e:
+            self.logger.error(f"Error reading {filename}: {e}")
+            return None
+        if not isinstance(zone_data, dict):
+            self.logger.error(f"Ignoring {filename}: expected a JSON object of record types")
+            return None
+        self.logger.info(f"Loaded zone: {zone_name}")
+        return zone_data
+
+    def reload_zones(self):
+        """
+        Re-reads the zone files that were added, changed or removed since the
+        last load and swaps in a new zone index built from them.
+
+        Unchanged zones keep their compiled records. The new index is built
+        completely before it replaces the old one in a single assignment, so a
+        query never sees a half-loaded zone. A file that fails to parse keeps
+        serving its previous good version. With ZONES_SNAPSHOT the new index
+        is written to the snapshot and served from it. Returns True if
+        anything changed.
+        """
+        with self.reload_lock:
+            stamps = self._zone_file_stamps()
+            changed = {}
+            for filename, stamp in stamps.items():
+                if self.zone_files.get(filename) != stamp:
+                    zone_data = self._read_zone_file(filename)
+                    if zone_data is not None:
+                        changed[filename[:-5]] = zone_data
+            removed = [filename[:-5] for filename in self.zone_files if filename not in stamps]
+            if not changed and not removed:
+                self.zone_files = stamps
+                return False
+
+            for zone_name in removed:
+                self.logger.info(f"Removed zone: {zone_name}")
+            if isinstance(self.zone_index, ZoneSnapshot):
+                zone_index = self._index_from_snapshot(stamps, changed)
+            else:
+                zone_index = self.zone_index.updated(changed, removed)
+            if self.zones_snapshot:
+                zone_index = self.snapshot_of(zone_index, stamps)
+
+            # Only now, so that a failed build is retried on the next check.
+            # A replaced snapshot is not closed here: lookups running on other
+            # threads may still use it, and it is unmapped with its last reference.
+            self.zone_files = stamps
+            self.zone_index = zone_index
+            self.logger.info(f"Zones reloaded: {len(changed)} changed, {len(removed)} removed, "
+                             f"{zone_index.zone_count} loaded")
+            return True
+
+    def _index_from_snapshot(self, stamps, changed):
+        """
+        Builds a ZoneIndex from the snapshot being served, with the zones in
+        changed compiled again. Every other zone reuses the snapshot's
+        compiled records, so only the changed files are parsed, like
+        ZoneIndex.updated. A zone whose file fails to parse keeps the records
+        the snapshot has for it.
+        """
+        snapshot_zones = self.zone_index.all_zone_records()
+        zone_index = ZoneIndex(compile=self.compile_record, flatten=flatten_cname)
+        for filename, stamp in stamps.items():
+            zone_name = filename[:-5]
+            zone_data = changed.get(zone_name)
+            if zone_data is not None:
+                zone_index.add_zone(zone_name, zone_data)
+                continue
+            snapshot_records = snapshot_zones.get(zone_name)
+            if snapshot_records is None:
+                continue
+            compiled = {}
+            for subdomain, records in snapshot_records.items():
+                # Only the alias itself: its chain is flattened again below
+                compiled[subdomain] = {'CNAME': records['CNAME']} if 'CNAME' in records else records
+            zone_index.insert_zone(zone_name, compiled)
+            if self.zone_files.get(filename) != stamp:
+                self.logger.warning(f"Keeping the snapshot's records for zone {zone_name}")
+        zone_index.flatten_aliases()
+        return zone_index
+
+    def bind_socket(self):
+        """
+        Binds the listening socket. With several workers every process binds
+        the same address with SO_REUSEPORT and the kernel spreads queries
+        across them.
+        """
+        if self.workers > 1:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((self.listen_ip, self.listen_port))
+        return self.sock
+
+    def bind_tcp_socket(self):
+        """
+        Binds and returns the TCP listening socket.
+        """
+        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1:
+            tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            tcp_sock.bind((self.listen_ip, self.listen_port))
+            tcp_sock.listen(128)
+        except OSError:
+            tcp_sock.close()
+            raise
+        return tcp_sock
+
+    def serve(self):
+        """
+        Runs the server on the configured engine.
+        """
+        self.zone_watcher = ZoneWatcher(
+            self.reload_zones, self.zones_dir,
+            mode=self.config.get("DNS", "ZONES_WATCH", fallback="auto"),
+            interval=self.config.getfloat("DNS", "ZONES_POLL_INTERVAL", fallback=2),
+        )
+        self.zone_watcher.start()
+        if self.query_log is not None:
+            self.query_log.start()
+        metrics_server = self.start_metrics_server()
+        try:
+            if self.engine == "async":
+                self.start_async()
+            else:
+                self.start()
+        finally:
+            self.zone_watcher.stop()
+            if self.query_log is not None:
+                self.query_log.stop()
+            if metrics_server is not None:
+                metrics_server.stop()
+
+    def start_metrics_server(self):
+        """
+        Starts the Prometheus endpoint on METRICS_LISTEN, if set. Worker N
+        listens on the configured port + N.
+        """
+        if self.metrics is None:
+            return None
+        host, port = parse_forwarder(self.metrics_listen)
+        try:
+            metrics_server = MetricsServer(host, port + self.worker_index,
+                                           lambda: self.metrics.render(self.metric_families()))
+        except OSError as e:
+            self.logger.error(f"Cannot serve metrics on {host}:{port + self.worker_index}: {e}")
+            return None
+        metrics_server.start()
+        return metrics_server
+
+    def metric_families(self):
+        """
+        Returns the cache, forwarder, zone and query log metrics as
+        (name, type, help, [(labels, value)]) tuples for Metrics.render.
+        """
+        cache = self.response_cache.stats()
+        families = [
+            ("magicdns_cache_hits_total", "counter", "Response cache hits.", [("", cache["hits"])]),
+            ("magicdns_cache_misses_total", "counter", "Response cache misses.", [("", cache["misses"])]),
+            ("magicdns_cache_evictions_total", "counter", "Entries evicted to stay within the cache limits.",
+             [("", cache["evictions"])]),
+            ("magicdns_cache_expirations_total", "counter", "Entries dropped because their TTL ran out.",
+             [("", cache["expirations"])]),
+            ("magicdns_cache_entries", "gauge", "Responses in the cache.", [("", cache["entries"])]),
+            ("magicdns_cache_bytes", "gauge", "Bytes of cached responses.", [("", cache["bytes"])]),
+            ("magicdns_cache_prefetches_total", "counter", "Popular entries refreshed before they expired.",
+             [("", cache["prefetches"])]),
+            ("magicdns_cache_stale_answers_total", "counter", "Expired entries served because no forwarder answered.",
+             [("", cache["stale_answers"])]),
+            ("magicdns_forwarder_srtt_seconds", "gauge", "Smoothed round-trip time per forwarder.",
+             [(f'forwarder="{forwarder}"', state.srtt)
+              for forwarder, state in self.upstream_selector.states.items() if state.srtt is not None]),
+            ("magicdns_zones", "gauge", "Loaded zones.", [("", self.zone_index.zone_count)]),
+        ]
+        if self.engine == "async":
+            families.append(("magicdns_coalesced_total", "counter",
+                             "Forwarded queries answered by an identical upstream lookup already in flight.",
+                             [("", self.coalesced_queries)]))
+        if self.rate_limiter is not None:
+            limits = self.rate_limiter.stats()
+            families.append(("magicdns_rate_limited_total", "counter",
+                             "UDP queries over the per-client rate limit, by action.",
+                             [('action="slip"', limits["slipped"]), ('action="drop"', limits["dropped"])]))
+            families.append(("magicdns_rate_limit_evictions_total", "counter",
+                             "Active client buckets evicted from the full rate limit table.",
+                             [("", limits["evictions"])]))
+        if self.forward_transport != TRANSPORT_UDP:
+            connects = dict(copy_items(self.stream_pool.connects))
+            connects.update((upstream.address, upstream.connects) for _, upstream in copy_items(self.async_upstreams))
+            families.append(("magicdns_upstream_connections_total", "counter",
+                             "TCP/TLS connections opened to each forwarder.",
+                             [(f'forwarder="{address}"', count) for address, count in sorted(connects.items())]))
+        if self.query_log is not None:
+            families.append(("magicdns_query_log_dropped_total", "counter",
+                             "Query log records dropped because the queue was full.",
+                             [("", self.query_log.dropped)]))
+        return families
 
     def start(self):
         """
         Starts the DNS server.
         """
+        tcp_listener = None
         try:
-            self.sock.bind((self.listen_ip, self.listen_port))
+            self.bind_socket()
+            self.response_cache.prefetch = self.queue_prefetch
+            threading.Thread(target=self._prefetch_loop, name="prefetch", daemon=True).start()
+            if self.listen_tcp:
+                tcp_listener = TCPListener(self.bind_tcp_socket(), self.handle_tcp_query,
+                                           self.tcp_max_connections, self.tcp_idle_timeout)
+                tcp_listener.start()
             self.logger.info(f"DNS server started on {self.listen_ip}:{self.listen_port}")
             while True:
-                data, addr = self.sock.recvfrom(512)
+                data, addr = self.sock.recvfrom(65535)
                 self.handle_query(data, addr)
         except PermissionError:
             self.logger.error(f"Permission denied to bind to port {self.listen_port}. Try running as root or using a port > 1024.")
         except OSError as e:
             self.logger.error(f"Failed to start server: {e}")
         finally:
+            if tcp_listener is not None:
+                tcp_listener.stop()
+            if self.stream_pool is not None:
+                self.stream_pool.close()
             self.sock.close()
             self.logger.info("DNS server stopped.")
 
+    def forwarder_address(self, forwarder):
+        """
+        Returns (host, port) of a forwarder; port 853 is the default for TLS.
+        """
+        return parse_forwarder(forwarder, DOT_PORT if self.forward_transport == TRANSPORT_TLS else DNS_PORT)
+
+    def async_upstream(self, forwarder):
+        """
+        Returns the async engine's client for a forwarder on FORWARD_TRANSPORT.
+        """
+        host, port = self.forwarder_address(forwarder)
+        if self.forward_transport == TRANSPORT_UDP:
+            return AsyncUpstream(host, port)
+        upstream = AsyncStreamUpstream(host, port, self.forward_ssl_context, self.forward_tls_name,
+                                       self.forward_pool_size, self.forward_idle_timeout)
+        self.async_upstreams[forwarder] = upstream
+        return upstream
+
+    def queue_prefetch(self, key):
+        """
+        Hands a popular cache entry that is about to expire to the prefetch
+        thread (sync engine).
+        """
+        try:
+            self.prefetch_queue.put_nowait(key)
+        except queue.Full:
+            pass
+
+    def _prefetch_loop(self):
+        """
+        Refreshes queued cache entries. The forwarding runs outside
+        query_lock, so the receive loop keeps answering meanwhile.
+        """
+        while True:
+            key = self.prefetch_queue.get()
+            try:
+                request = prefetch_query(key)
+                response = self.forward_query(request)
+                if response is not None:
+                    with self.query_lock:
+                        self.cache_response(request, response.to_wire())
+            except Exception as e:
+                self.logger.error(f"Error prefetching {key[0]}: {e}")
+
+    def start_async(self):
+        """
+        Starts the DNS server on the asyncio engine, which keeps forwarded
+        queries in flight concurrently instead of blocking the receive loop.
+        """
+        try:
+            tcp_sock = self.bind_tcp_socket() if self.listen_tcp else None
+            asyncio.run(AsyncDNSServer(self).serve(sock=self.bind_socket(), tcp_sock=tcp_sock))
+        except PermissionError:
+            self.logger.error(f"Permission denied to bind to port {self.listen_port}. Try running as root or using a port > 1024.")
+        except OSError as e:
+            self.logger.error(f"Failed to start server: {e}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.logger.info("DNS server stopped.")
+
     def handle_query(self, data, addr):
         """
-        Handles an incoming DNS query.
+        Handles an incoming DNS query over UDP.
         """
+        started = time.monotonic()
         try:
+            if self.rate_limiter is not None and self.rate_limited(data, addr, started, self.sock.sendto):
+                return
+            with self.query_lock:
+                request, response_wire, source = self.resolve(data, addr, started)
+            if response_wire:
+                sending = time.monotonic()
+                self.sock.sendto(fit_udp(response_wire, request, self.max_udp_size), addr)
+                self.mark_stage("send", sending)
+            if source is not None:
+                self.query_done(addr, request, response_wire, source, started)
+
+        except Exception as e:
+            self.logger.error(f"Error handling query from {addr}: {e}")
+
+    def handle_tcp_query(self, data, addr, send):
+        """
+        Handles a DNS query received over TCP and passes the response (never
+        truncated) to send(response_wire). Errors sending it are left to the
+        caller, which closes the connection.
+        """
+        started = time.monotonic()
+        try:
+            with self.query_lock:
+                request, response_wire, source = self.resolve(data, addr, started)
+        except Exception as e:
+            self.logger.error(f"Error handling TCP query from {addr}: {e}")
+            return
+        if response_wire:
+            sending = time.monotonic()
+            send(response_wire)
+            self.mark_stage("send", sending)
+        if source is not None:
+            self.query_done(addr, request, response_wire, source, started)
+
+    def rate_limited(self, data, addr, now, send):
+        """
+        Charges a UDP query to its client's rate limit. Returns True if the
+        query is over the limit and must not be answered; if the limiter
+        slips it, the empty TC=1 reply has been passed to send(reply, addr).
+        """
+        action = self.rate_limiter.check(addr[0], now)
+        if action == RESPOND:
+            return False
+        if action == SLIP:
+            reply = truncated_reply(data)
+            if reply is not None:
+                send(reply, addr)
+        return True
+
+    def mark_stage(self, stage, since):
+        """
+        Records the time since `since` (time.monotonic()) for a per-query
+        stage in the metrics, and returns the current time for the next one.
+        """
+        now = time.monotonic()
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, now - since)
+        return now
+
+    def query_done(self, addr, request, response_wire, source, started):
+        """
+        Feeds an answered query into the metrics and the query log.
+        """
+        if self.metrics is not None:
+            self.metrics.observe_query(source, response_wire, time.monotonic() - started)
+        if self.query_log is not None:
+            self.query_log.record(addr, request, response_wire, source, started)
+
+    def resolve(self, data, addr, started):
+        """
+        Answers a query packet from the static zones, the response cache or
+        the forwarders.
+
+        Plain queries are first answered straight from the packet bytes;
+        only unusual packets and queries that have to be forwarded are parsed
+        with dnspython. Returns (request, response_wire, source) where request
+        is the wire.RawQuery or dns.message.Message the packet was read as and
+        source says where the answer came from (see query_log). A packet
+        without a question gets a FORMERR response (or none if it is not a
+        query) and None as source, as it has nothing to log.
+        """
+        query = parse_query(data)
+        if query is not None:
+            mark = self.mark_stage("parse", started)
+            response_wire, source = self.get_raw_wire(query)
+            mark = self.mark_stage("lookup", mark)
+            if response_wire:
+                return query, response_wire, source
+            request = message.from_wire(data)
+        else:
             request = message.from_wire(data)
-            qname = request.question[0].name.to_text()
-            qtype = request.question[0].rdtype
+            if not request.question:
+                return request, self.format_error_wire(request), None
+            mark = self.mark_stage("parse", started)
 
-            self.logger.info(f"Received query from {addr} for {qname} ({rdatatype.to_text(qtype)})")
+            response_wire = self.get_static_wire(request, data)
+            if response_wire:
+                self.mark_stage("lookup", mark)
+                return request, response_wire, SOURCE_STATIC
 
-            # Check static records first
-            response = self.get_static_response(request)
-            if response:
-                self.logger.info(f"Found static record for {qname}")
-                self.sock.sendto(response.to_wire(), addr)
-                self.logger.info(f"Sent static response to {addr}")
-                return
+            response_wire = self.get_cached_wire(request, data)
+            mark = self.mark_stage("lookup", mark)
+            if response_wire:
+                return request, response_wire, SOURCE_CACHE
+
+        # If not in static records or the cache, forward the query
+        self.logger.debug("Forwarding query from %s for %s", addr, request.question[0].name)
+        chain = self.external_chain(request)
+        if chain is None:
+            response_wire, source = self.forward_wire(request, data)
+        else:
+            # An alias leading out of the zones: forward its target instead
+            target_request = self.chain_target_request(request, chain)
+            target_data = target_request.to_wire()
+            target_wire, source = self.get_cached_wire(target_request, target_data), SOURCE_CACHE
+            if not target_wire:
+                target_wire, source = self.forward_wire(target_request, target_data)
+            response_wire = self.chain_response(request, data, chain, target_wire)
+        self.mark_stage("forward", mark)
+        return request, response_wire, source
+
+    def forward_wire(self, request, data):
+        """
+        Forwards a query and returns (response_wire, source): the reply, a
+        stale cached answer if no forwarder answered, or a SERVFAIL response.
+        """
+        response = self.forward_query(request)
+        if response is not None:
+            response_wire = response.to_wire()
+            self.cache_response(request, response_wire)
+            return response_wire, SOURCE_UPSTREAM
+        response_wire = self.get_stale_wire(request, data)
+        if response_wire is not None:
+            return response_wire, SOURCE_STALE
+        # If all forwarders fail and nothing stale is cached, return a SERVFAIL response
+        response_message = message.make_response(request)
+        response_message.set_rcode(rcode.SERVFAIL)
+        return response_message.to_wire(), SOURCE_UPSTREAM
+
+    @staticmethod
+    def format_error_wire(request):
+        """
+        Returns a FORMERR response to a parsed query that has no question, or
+        None if the packet is not a query.
+        """
+        if request.flags & FLAG_QR:
+            return None
+        response_message = message.make_response(request)
+        response_message.set_rcode(rcode.FORMERR)
+        return response_message.to_wire()
 
-            # If not in static records, forward the query
-            self.logger.info(f"No static record for {qname}, forwarding query")
-            response = self.forward_query(request)
-            if response:
-                self.sock.sendto(response.to_wire(), addr)
-                self.logger.info(f"Sent forwarded response to {addr}")
+    def compile_record(self, zone_name, owner, qtype_text, answer_data):
+        """
+        Compiles the records of one (owner, type) into a CompiledAnswer, so the
+        text parsing and wire rendering happen once at load time.
+        """
+        values = answer_data if isinstance(answer_data, list) else [answer_data]
+
+        # CNAME targets without a trailing dot are relative to the zone; the
+        # chains are flattened once all zones are loaded (see flatten_cname)
+        if qtype_text == 'CNAME':
+            values = [self._absolute_target(zone_name, value) for value in values]
 
+        try:
+            # Format answer_data for rrset.from_text based on qtype
+            formatted_values = [self._format_answer_data(qtype_text, value) for value in values]
+            return compile_answer(owner, qtype_text, formatted_values)
         except Exception as e:
-            self.logger.error(f"Error handling query from {addr}: {e}")
+            self.logger.error(f"Error compiling {qtype_text} record for {owner} in zone {zone_name}: {e}")
+            return None
 
-    def get_static_response(self, request):
-        """
-        Checks for a static record and returns a response if found.
-        """
-        qname = request.question[0].name.to_text()
-        qtype = request.question[0].rdtype
-        qtype_text = rdatatype.to_text(qtype)
-
-        # Normalize qname to ensure it ends with a dot
-        if not qname.endswith('.'):
-            qname += '.'
-
-        # Find the longest matching zone for the query
-        matched_zone_name = None
-        for zone_name in self.static_records.keys():
-            # Normalize zone_name to ensure it ends with a dot for comparison
-            normalized_zone_name = zone_name if zone_name.endswith('.') else zone_name + '.'
-
-            # Special handling for PTR records
-            if qtype_text == 'PTR' and qname.endswith('in-addr.arpa.'):
-                # For PTR, we need to check if the query is within the reverse zone
-                # e.g., query for 1.0.0.127.in-addr.arpa. should match 127.in-addr.arpa.
-                if normalized_zone_name.endswith('in-addr.arpa.') and qname.endswith(normalized_zone_name):
-                    if matched_zone_name is None or len(normalized_zone_name) > len(matched_zone_name):
-                        matched_zone_name = normalized_zone_name
-            elif qname.endswith(normalized_zone_name):
-                if matched_zone_name is None or len(normalized_zone_name) > len(matched_zone_name):
-                    matched_zone_name = normalized_zone_name
-
-        if matched_zone_name:
-            zone_data = self.static_records[matched_zone_name.rstrip('.')] # Get data using original key
-            subdomain = qname[:-len(matched_zone_name)].rstrip('.')
-            if qtype_text == 'PTR':
-                # For PTR, the subdomain is the reversed IP part
-                subdomain = qname[:len(qname) - len(matched_zone_name)].rstrip('.')
-            elif not subdomain: # apex domain
-                subdomain = "@"
-
-            if qtype_text in zone_data and subdomain in zone_data[qtype_text]:
-                response = message.make_response(request)
-                answer_data = zone_data[qtype_text][subdomain]
-
-                # Handle CNAMEs where the target is also in the zone
-                if qtype_text == 'CNAME':
-                    # Ensure CNAME target ends with a dot for consistency
-                    if not answer_data.endswith('.'):
-                        answer_data += '.'
-                    # If the CNAME target is an A record in the same zone, resolve it
-                    if answer_data.rstrip('.') in zone_data.get('A', {}):
-                        answer_data = zone_data['A'][answer_data.rstrip('.')]
-                        qtype_text = 'A' # Change type to A if we're returning an A record
-
-                # Format answer_data for rrset.from_text based on qtype
-                formatted_answer_data = self._format_answer_data(qtype_text, answer_data)
-
-                answer = rrset.from_text(
-                    qname, 300, 'IN', qtype_text, formatted_answer_data
-                )
-                response.answer.append(answer)
-                return response
+    @staticmethod
+    def _absolute_target(zone_name, target):
+        if target.endswith('.'):
+            return target
+        if target == '@':
+            return zone_name.rstrip('.') + '.'
+        return f"{target}.{zone_name.rstrip('.')}."
+
+    def lookup_static(self, qname, qtype):
+        """
+        Returns the compiled static answer for qname/qtype, or None. For an
+        alias this is its flattened CNAME chain, ending in the target's
+        records of that type when there are any.
+        """
+        matched_zone_name, zone_records = self.zone_index.lookup(qname)
+        if zone_records:
+            answer = zone_records.get(rdatatype.to_text(qtype))
+            if answer is None:
+                answer = zone_records.get(CHAIN_KEY)
+            return answer
+        return None
+
+    def get_static_wire(self, request, data):
+        """
+        Returns the static response for a parsed request in wire format, or
+        None. data is the raw query the request was parsed from.
+        """
+        question = request.question[0]
+        answer = self.lookup_static(question.name.to_text(), question.rdtype)
+        if answer and answer.chain_end != CHAIN_EXTERNAL:
+            return answer.render(request.id, request.flags, question_wire(data, question.name),
+                                 request.edns >= 0, self.max_udp_size)
+        return None
+
+    def get_raw_wire(self, query):
+        """
+        Returns (response_wire, source) with the static or cached response
+        for a wire.RawQuery, or (None, None). Nothing is parsed: the answer is
+        spliced together from the query's header and question bytes.
+        """
+        answer = self.lookup_static(query.qname, query.qtype)
+        if answer and answer.chain_end != CHAIN_EXTERNAL:
+            return (answer.render(query.id, query.flags, query.question, query.edns >= 0, self.max_udp_size),
+                    SOURCE_STATIC)
+        response_wire = self.response_cache.get(raw_cache_key(query), query.id, query.question)
+        return response_wire, SOURCE_CACHE if response_wire else None
+
+    def external_chain(self, request):
+        """
+        Returns the static CNAME chain answering the request if it leads to a
+        name outside the loaded zones, or None. Such queries are answered by
+        forwarding the chain's target (see chain_response).
+        """
+        question = request.question[0]
+        answer = self.lookup_static(question.name.to_text(), question.rdtype)
+        if answer and answer.chain_end == CHAIN_EXTERNAL:
+            return answer
         return None
 
+    @staticmethod
+    def chain_target_request(request, chain):
+        """
+        Returns the query to forward for the target of an external chain:
+        the request's type and class, with EDNS and the DO bit if it had them.
+        """
+        question = request.question[0]
+        do_bit = bool(request.ednsflags & flags.DO) if request.edns >= 0 else False
+        return message.make_query(chain_target(chain), question.rdtype, question.rdclass,
+                                  use_edns=0 if request.edns >= 0 else False, want_dnssec=do_bit)
+
+    def chain_response(self, request, data, chain, target_wire):
+        """
+        Returns the response to request made of the static CNAME chain
+        followed by the answer, authority and rcode of the response for its
+        target.
+        """
+        question = request.question[0]
+        response_message = message.from_wire(chain.render(request.id, request.flags,
+                                                          question_wire(data, question.name),
+                                                          request.edns >= 0, self.max_udp_size))
+        target_message = message.from_wire(target_wire)
+        response_message.set_rcode(target_message.rcode())
+        response_message.answer.extend(target_message.answer)
+        response_message.authority = target_message.authority
+        return response_message.to_wire()
+
+    def get_cached_wire(self, request, data):
+        """
+        Returns a cached forwarded response for the request in wire format,
+        rewritten for its query ID and question, or None.
+        """
+        question = request.question[0]
+        return self.response_cache.get(cache_key(request), request.id,
+                                       question_wire(data, question.name))
+
+    def get_stale_wire(self, request, data):
+        """
+        Returns an expired cached response for the request, for when no
+        forwarder answered (RFC 8767), or None.
+        """
+        question = request.question[0]
+        response_wire = self.response_cache.get_stale(cache_key(request), request.id,
+                                                      question_wire(data, question.name))
+        if response_wire is not None:
+            self.logger.debug("Answering %s with stale data", question.name)
+        return response_wire
+
+    def cache_response(self, request, response_wire):
+        """
+        Stores a forwarded response in the cache if it is cacheable.
+        """
+        self.response_cache.put(cache_key(request), response_wire)
+
     def _format_answer_data(self, qtype_text, answer_data):
         """
         Helper to format answer_data string for rrset.from_text based on record type.
@@ -207,9 +857,9 @@ class DNSResolver:
             return f"\"{answer_data}\""
         elif qtype_text == 'CAA':
             # CAA records are "flags tag value" e.g., "0 issue \"letsencrypt.org\""
-            # Value needs to be quoted
+            # Value needs to be quoted, unless the zone already quotes it
             parts = answer_data.split(' ', 2)
-            if len(parts) == 3:
+            if len(parts) == 3 and not parts[2].startswith('"'):
                 return f"{parts[0]} {parts[1]} \"{parts[2]}\""
             return answer_data
         elif qtype_text == 'LOC':
@@ -220,9 +870,9 @@ class DNSResolver:
             # SSHFP records are "algorithm_number fingerprint_type_number fingerprint"
             return answer_data
         elif qtype_text == 'URI':
-            # URI records are "priority weight target" where target is a URI and needs to be quoted
+            # URI records are "priority weight target" where target is a URI and needs to be quoted (if not already)
             parts = answer_data.split(' ', 2)
-            if len(parts) == 3:
+            if len(parts) == 3 and not parts[2].startswith('"'):
                 return f"{parts[0]} {parts[1]} \"{parts[2]}\""
             return answer_data
         # A, AAAA, CNAME (already handled for target dot), etc. can be used as is
@@ -230,26 +880,44 @@ class DNSResolver:
 
     def forward_query(self, request):
         """
-        Forwards a DNS query to the upstream resolver.
+        Forwards a DNS query to the upstream resolver, trying the forwarders
+        fastest first. Returns the response, or None if none of them answered.
         """
-        for forwarder in self.forwarders:
+        for forwarder in self.upstream_selector.ordered():
             try:
-                response = query.udp(request, forwarder, timeout=5)
+                host, port = self.forwarder_address(forwarder)
+                started = time.monotonic()
+                if self.stream_pool is not None:
+                    response = self.stream_pool.query(request, host, port, self.forward_timeout)
+                else:
+                    try:
+                        response = query.udp(request, host, timeout=self.forward_timeout, port=port,
+                                             raise_on_truncation=True)
+                    except message.Truncated:
+                        # Retried over TCP within what is left of the timeout
+                        remaining = self.forward_timeout - (time.monotonic() - started)
+                        response = query.tcp(request, host, timeout=remaining, port=port)
+                rtt = time.monotonic() - started
+                self.upstream_selector.record_success(forwarder, rtt)
+                if self.metrics is not None:
+                    self.metrics.observe_upstream(forwarder, rtt)
                 return response
             except Exception as e:
+                self.upstream_selector.record_failure(forwarder)
+                if self.metrics is not None:
+                    self.metrics.observe_upstream_failure(forwarder)
                 self.logger.error(f"Failed to forward query to {forwarder}: {e}")
-        
-        # If all forwarders fail, return a SERVFAIL response
-        response_message = message.make_response(request)
-        response_message.set_rcode(rcode.SERVFAIL)
-        return response_message
+        return None
 
 def main():
     """
     Main function to run the DNS server.
     """
     resolver_server = DNSResolver(CONFIG_FILE)
-    resolver_server.start()
+    if resolver_server.workers > 1:
+        run_workers(resolver_server, resolver_server.workers)
+    else:
+        resolver_server.serve()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,398 @@
+import asyncio
+import logging
+import time
+
+from dns import message, rcode
+
+from query_log import SOURCE_CACHE, SOURCE_STALE, SOURCE_STATIC, SOURCE_UPSTREAM
+from response_cache import cache_key, prefetch_query
+from static_answers import question_wire
+from upstream import rewrite_reply
+from wire import fit_udp, parse_query, tcp_frame
+
+logger = logging.getLogger(__name__)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    """
+    Listening endpoint; every datagram is handed to AsyncDNSServer.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+
+class AsyncDNSServer:
+    """
+    asyncio serving engine for a DNSResolver.
+
+    Static and cached answers are rendered and sent straight from the
+    datagram callback, read from the packet bytes without a full parse.
+    Queries that have to be forwarded run as tasks, so any number of upstream
+    lookups can be in flight without holding up the receive loop. Each
+    forwarded query has an overall deadline of QUERY_TIMEOUT seconds, and each
+    forwarder gets at most FORWARD_TIMEOUT of it.
+
+    Forwarders are raced: the query goes to the fastest one first, and if it
+    has not answered within its adaptive hedge delay (or fails) the next one
+    is asked as well. The first reply is relayed; later replies only update
+    the latency statistics.
+
+    Identical questions (same cache key) that arrive while one is already
+    being forwarded share that upstream lookup instead of starting another.
+
+    With a TCP socket the server also answers DNS over TCP. Queries pipelined
+    on one connection are answered concurrently, each reply as soon as it is
+    ready (RFC 7766); UDP replies that do not fit the client's buffer are
+    truncated so that it retries over TCP.
+
+    Popular cached names are refreshed in the background shortly before
+    they expire. If the forwarders have not answered a query after
+    STALE_ANSWER_TIMEOUT seconds, or all of them failed, an expired cache
+    entry is served instead when there is one (RFC 8767); the lookup keeps
+    running and refreshes the cache if it succeeds.
+
+    With RATE_LIMIT set, UDP queries are charged to their client's rate
+    limit before anything else is done with them.
+    """
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.transport = None
+        self.forward_timeout = resolver.forward_timeout
+        self.query_timeout = resolver.config.getfloat("DNS", "QUERY_TIMEOUT", fallback=10)
+        self.selector = resolver.upstream_selector
+        self.upstreams = {f: resolver.async_upstream(f) for f in resolver.forwarders}
+        self.tasks = set()
+        self.inflight = {}  # {cache key: future of the shared upstream lookup}
+        self.max_udp_size = resolver.max_udp_size
+        self.tcp_max_connections = resolver.tcp_max_connections
+        self.tcp_idle_timeout = resolver.tcp_idle_timeout
+        self.tcp_server = None
+        self.tcp_connections = 0
+        self.metrics = resolver.metrics
+        self.stale_answer_timeout = resolver.stale_answer_timeout
+
+    async def serve(self, sock=None, tcp_sock=None):
+        """
+        Binds the listening socket (or uses an already bound sock) and serves
+        until cancelled. If tcp_sock is a listening TCP socket, DNS over TCP
+        is served on it as well.
+        """
+        loop = asyncio.get_running_loop()
+        self.resolver.response_cache.prefetch = self.prefetch
+        if sock is not None:
+            await loop.create_datagram_endpoint(lambda: _ServerProtocol(self), sock=sock)
+        else:
+            await loop.create_datagram_endpoint(
+                lambda: _ServerProtocol(self),
+                local_addr=(self.resolver.listen_ip, self.resolver.listen_port)
+            )
+        if tcp_sock is not None:
+            self.tcp_server = await asyncio.start_server(self.handle_connection, sock=tcp_sock)
+        logger.info(f"Async DNS server started on {self.resolver.listen_ip}:{self.resolver.listen_port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.close()
+
+    def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        for upstream in self.upstreams.values():
+            upstream.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def handle_datagram(self, data, addr):
+        started = time.monotonic()
+        resolver = self.resolver
+        if resolver.rate_limiter is not None and resolver.rate_limited(data, addr, started, self.transport.sendto):
+            return
+        query = parse_query(data)
+        if query is not None:
+            mark = resolver.mark_stage("parse", started)
+            response_wire, source = resolver.get_raw_wire(query)
+            mark = resolver.mark_stage("lookup", mark)
+            if response_wire:
+                self._send_datagram(query, response_wire, source, addr, started)
+                return
+
+        try:
+            request = message.from_wire(data)
+        except Exception as e:
+            logger.error(f"Error parsing query from {addr}: {e}")
+            return
+        if not request.question:
+            response_wire = resolver.format_error_wire(request)
+            if response_wire is not None:
+                self.transport.sendto(response_wire, addr)
+            return
+
+        # A query the fast path could read has already missed the static records and the cache
+        if query is None:
+            mark = resolver.mark_stage("parse", started)
+            response_wire, source = self.answer_locally(request, data)
+            mark = resolver.mark_stage("lookup", mark)
+            if response_wire:
+                self._send_datagram(request, response_wire, source, addr, started)
+                return
+
+        self._spawn(self._forward_datagram(request, data, addr, started, mark))
+
+    def answer_locally(self, request, data):
+        """
+        Returns (response_wire, source) with the static or cached response
+        for a query, or (None, None).
+        """
+        response_wire = self.resolver.get_static_wire(request, data)
+        if response_wire is not None:
+            return response_wire, SOURCE_STATIC
+        response_wire = self.resolver.get_cached_wire(request, data)
+        return response_wire, SOURCE_CACHE if response_wire else None
+
+    def _send_datagram(self, request, response_wire, source, addr, started):
+        sending = time.monotonic()
+        self.transport.sendto(fit_udp(response_wire, request, self.max_udp_size), addr)
+        self.resolver.mark_stage("send", sending)
+        self.resolver.query_done(addr, request, response_wire, source, started)
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _forward_datagram(self, request, data, addr, started, mark):
+        response_wire, source = await self.resolve_forwarded(request, data)
+        self.resolver.mark_stage("forward", mark)
+        self._send_datagram(request, response_wire, source, addr, started)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serves one DNS over TCP connection until the client closes it or it
+        has been idle for TCP_IDLE_TIMEOUT seconds.
+        """
+        addr = writer.get_extra_info('peername')
+        if self.tcp_connections >= self.tcp_max_connections:
+            logger.warning(f"Too many TCP connections, closing connection from {addr}")
+            writer.close()
+            return
+
+        self.tcp_connections += 1
+        queries = set()
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(2), self.tcp_idle_timeout)
+                    data = await asyncio.wait_for(reader.readexactly(int.from_bytes(header, 'big')),
+                                                  self.tcp_idle_timeout)
+                except asyncio.TimeoutError:
+                    logger.debug(f"Closing idle TCP connection from {addr}")
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                query = self._spawn(self._answer_stream(data, addr, writer))
+                queries.add(query)
+                query.add_done_callback(queries.discard)
+            # Let pipelined queries that are still being forwarded reply first
+            if queries:
+                await asyncio.wait(queries, timeout=self.query_timeout)
+        finally:
+            self.tcp_connections -= 1
+            writer.close()
+
+    async def _answer_stream(self, data, addr, writer):
+        started = time.monotonic()
+        resolver = self.resolver
+        query = parse_query(data)
+        response_wire = source = None
+        if query is not None:
+            mark = resolver.mark_stage("parse", started)
+            response_wire, source = resolver.get_raw_wire(query)
+            mark = resolver.mark_stage("lookup", mark)
+            request = query
+
+        if response_wire is None:
+            try:
+                request = message.from_wire(data)
+            except Exception as e:
+                logger.error(f"Error parsing TCP query from {addr}: {e}")
+                return
+            if not request.question:
+                response_wire = resolver.format_error_wire(request)
+                if response_wire is not None and not writer.is_closing():
+                    writer.write(tcp_frame(response_wire))
+                return
+            if query is None:
+                mark = resolver.mark_stage("parse", started)
+                response_wire, source = self.answer_locally(request, data)
+                mark = resolver.mark_stage("lookup", mark)
+            if response_wire is None:
+                response_wire, source = await self.resolve_forwarded(request, data)
+                resolver.mark_stage("forward", mark)
+
+        if not writer.is_closing():
+            sending = time.monotonic()
+            writer.write(tcp_frame(response_wire))
+            resolver.mark_stage("send", sending)
+        resolver.query_done(addr, request, response_wire, source, started)
+
+    async def resolve_forwarded(self, request, data):
+        """
+        Answers a query that missed the static records and the cache by
+        forwarding it, or for an alias whose CNAME chain leads out of the
+        zones, by putting the chain in front of the response for its target.
+        Returns (response_wire, source).
+        """
+        resolver = self.resolver
+        chain = resolver.external_chain(request)
+        if chain is None:
+            return await self.forward(request, data)
+        target_request = resolver.chain_target_request(request, chain)
+        target_data = target_request.to_wire()
+        target_wire, source = resolver.get_cached_wire(target_request, target_data), SOURCE_CACHE
+        if not target_wire:
+            target_wire, source = await self.forward(target_request, target_data)
+        return resolver.chain_response(request, data, chain, target_wire), source
+
+    async def forward(self, request, data):
+        """
+        Forwards a query and returns (response_wire, source): the reply, a
+        stale cached answer if the forwarders are too slow or all failed, or
+        a SERVFAIL response.
+        """
+        lookup = self._shared_lookup(request, data)
+        # Shielded so that one waiter going away does not cancel the lookup for the others
+        if self.resolver.response_cache.serve_stale and self.stale_answer_timeout > 0:
+            try:
+                reply = await asyncio.wait_for(asyncio.shield(lookup), self.stale_answer_timeout)
+            except asyncio.TimeoutError:
+                stale = self.resolver.get_stale_wire(request, data)
+                if stale is not None:
+                    return stale, SOURCE_STALE
+                reply = await asyncio.shield(lookup)
+        else:
+            reply = await asyncio.shield(lookup)
+        if reply is not None:
+            # Each waiter gets its own query ID and question casing back
+            return rewrite_reply(reply, request.id, question_wire(data, request.question[0].name)), SOURCE_UPSTREAM
+
+        stale = self.resolver.get_stale_wire(request, data)
+        if stale is not None:
+            return stale, SOURCE_STALE
+
+        # If all forwarders fail, return a SERVFAIL response
+        response_message = message.make_response(request)
+        response_message.set_rcode(rcode.SERVFAIL)
+        return response_message.to_wire(), SOURCE_UPSTREAM
+
+    def _shared_lookup(self, request, data):
+        """
+        Returns the future of the upstream lookup for the request's question,
+        starting one unless an identical one is already in flight.
+        """
+        key = cache_key(request)
+        lookup = self.inflight.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self.query_upstreams(request, data))
+            self.inflight[key] = lookup
+            lookup.add_done_callback(lambda done: self._lookup_done(key, request, done))
+        else:
+            self.resolver.coalesced_queries += 1
+        return lookup
+
+    def prefetch(self, key):
+        """
+        Refreshes a popular cache entry that is about to expire; called by
+        the response cache on a hit.
+        """
+        if key in self.inflight:
+            return
+        request = prefetch_query(key)
+        # The lookup caches its reply when done, like any forwarded query
+        self._shared_lookup(request, request.to_wire())
+
+    def _lookup_done(self, key, request, lookup):
+        if self.inflight.get(key) is lookup:
+            del self.inflight[key]
+        if not lookup.cancelled() and lookup.exception() is None and lookup.result() is not None:
+            self.resolver.cache_response(request, lookup.result())
+
+    async def query_upstreams(self, request, data):
+        """
+        Races the forwarders for a reply to the query. Returns the reply in
+        wire format, or None if none of them answered before the deadline.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.query_timeout
+        candidates = self.selector.ordered()
+        pending = {}
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                if candidates:
+                    forwarder = candidates.pop(0)
+                    attempt = asyncio.ensure_future(
+                        self._attempt(forwarder, request, data, min(self.forward_timeout, remaining))
+                    )
+                    pending[attempt] = forwarder
+                    # Give this forwarder its hedge delay before asking the next one
+                    wait = self.selector.hedge_delay(forwarder) if candidates else remaining
+                elif pending:
+                    wait = remaining
+                else:
+                    return None
+
+                done, _ = await asyncio.wait(pending, timeout=min(wait, remaining),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    del pending[attempt]
+                    if attempt.exception() is None:
+                        return attempt.result()
+        finally:
+            # Attempts that lost the race are left to finish in the background
+            # so that their RTT or timeout still reaches the selector.
+            for attempt in pending:
+                self.tasks.add(attempt)
+                attempt.add_done_callback(self._discard_attempt)
+
+    def _discard_attempt(self, attempt):
+        self.tasks.discard(attempt)
+        if not attempt.cancelled():
+            attempt.exception()
+
+    async def _attempt(self, forwarder, request, data, timeout):
+        """
+        Queries one forwarder and feeds the outcome into the selector.
+        """
+        loop = asyncio.get_running_loop()
+        upstream = self.upstreams[forwarder]
+        started = loop.time()
+        try:
+            reply = await upstream.query(request, data, timeout)
+        except asyncio.TimeoutError:
+            self.selector.record_failure(forwarder)
+            if self.metrics is not None:
+                self.metrics.observe_upstream_failure(forwarder)
+            logger.error(f"Timed out forwarding query to {upstream.address}")
+            raise
+        except Exception as e:
+            self.selector.record_failure(forwarder)
+            if self.metrics is not None:
+                self.metrics.observe_upstream_failure(forwarder)
+            logger.error(f"Failed to forward query to {upstream.address}: {e}")
+            raise
+        rtt = loop.time() - started
+        self.selector.record_success(forwarder, rtt)
+        if self.metrics is not None:
+            self.metrics.observe_upstream(forwarder, rtt)
+        return reply
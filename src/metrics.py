@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dns import rcode
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; in-process stages take microseconds, upstream
+# round trips milliseconds to seconds.
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+UPSTREAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Per-query stages: reading the packet, static/cache lookup, forwarding
+# (including the full parse of a query the fast path could not answer), and
+# handing the reply to the socket.
+STAGES = ("parse", "lookup", "forward", "send")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def copy_items(counts):
+    """
+    Returns a list of the items of a dict that the serving thread may add
+    keys to while render() reads it on the HTTP thread. The copy is a single
+    C call under the GIL; if it still sees the dict change size, it retries.
+    """
+    while True:
+        try:
+            return list(counts.items())
+        except RuntimeError:
+            continue
+
+
+class Histogram:
+    """
+    Cumulative-bucket latency histogram in the Prometheus style. observe() is
+    one bisect and two additions.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels=""):
+        """
+        Yields the exposition lines for this histogram.
+        """
+        separator = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}'
+        braces = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{braces} {self.sum}"
+        yield f"{name}_count{braces} {self.count}"
+
+
+class Metrics:
+    """
+    In-process counters and histograms for one server process.
+
+    Recording is plain integer and float arithmetic on the serving thread;
+    all formatting happens in render(), when the metrics are scraped. Rates
+    such as QPS come from the counters (e.g. rate(magicdns_queries_total[1m])).
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.queries = {}    # {source: count}
+        self.responses = {}  # {rcode value: count}
+        self.stages = {stage: Histogram(STAGE_BUCKETS) for stage in STAGES}
+        self.latency = Histogram(STAGE_BUCKETS)
+        self.upstream_rtt = {}       # {forwarder: Histogram}
+        self.upstream_failures = {}  # {forwarder: count}
+
+    def observe_stage(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def observe_query(self, source, response_wire, seconds):
+        """
+        Counts an answered query by source and response code, and its total
+        time in the server.
+        """
+        self.queries[source] = self.queries.get(source, 0) + 1
+        if response_wire:
+            response_rcode = response_wire[3] & 0x0F
+            self.responses[response_rcode] = self.responses.get(response_rcode, 0) + 1
+        self.latency.observe(seconds)
+
+    def observe_upstream(self, forwarder, seconds):
+        histogram = self.upstream_rtt.get(forwarder)
+        if histogram is None:
+            histogram = self.upstream_rtt[forwarder] = Histogram(UPSTREAM_BUCKETS)
+        histogram.observe(seconds)
+
+    def observe_upstream_failure(self, forwarder):
+        self.upstream_failures[forwarder] = self.upstream_failures.get(forwarder, 0) + 1
+
+    def render(self, families=()):
+        """
+        Returns all metrics in the Prometheus text exposition format. families
+        are extra (name, type, help, [(labels, value)]) metrics supplied by
+        the server, such as the cache counters.
+        """
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("magicdns_queries_total", "counter", "Answered queries by answer source.")
+        for source, count in sorted(copy_items(self.queries)):
+            lines.append(f'magicdns_queries_total{{source="{source}"}} {count}')
+
+        family("magicdns_responses_total", "counter", "Responses by rcode.")
+        for response_rcode, count in sorted(copy_items(self.responses)):
+            lines.append(f'magicdns_responses_total{{rcode="{rcode.to_text(response_rcode)}"}} {count}')
+
+        family("magicdns_query_duration_seconds", "histogram", "Time from receiving a query to sending the reply.")
+        lines.extend(self.latency.samples("magicdns_query_duration_seconds"))
+
+        family("magicdns_stage_duration_seconds", "histogram", "Time spent per query in each stage.")
+        for stage, histogram in self.stages.items():
+            lines.extend(histogram.samples("magicdns_stage_duration_seconds", f'stage="{stage}"'))
+
+        family("magicdns_upstream_rtt_seconds", "histogram", "Round-trip time of answered forwarded queries.")
+        for forwarder, histogram in sorted(copy_items(self.upstream_rtt)):
+            lines.extend(histogram.samples("magicdns_upstream_rtt_seconds", f'forwarder="{forwarder}"'))
+
+        family("magicdns_upstream_failures_total", "counter", "Forwarded queries that timed out or failed.")
+        for forwarder, count in sorted(copy_items(self.upstream_failures)):
+            lines.append(f'magicdns_upstream_failures_total{{forwarder="{forwarder}"}} {count}')
+
+        for name, kind, help_text, values in families:
+            family(name, kind, help_text)
+            for labels, value in values:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        family("magicdns_uptime_seconds", "gauge", "Seconds since the server process started.")
+        lines.append(f"magicdns_uptime_seconds {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics over HTTP from a background thread. render is called
+    for every scrape and returns the exposition text.
+    """
+    def __init__(self, host, port, render):
+        self.render = render
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        logger.info(f"Metrics available at http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/metrics")
+
+    def stop(self):
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread = None
+        self.httpd.server_close()
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from dns import rcode, rdatatype
+
+logger = logging.getLogger(__name__)
+
+# Where an answer came from, as written to the query log
+SOURCE_STATIC = "static"
+SOURCE_CACHE = "cache"
+SOURCE_UPSTREAM = "upstream"
+# Expired cache entry served because no forwarder answered (RFC 8767)
+SOURCE_STALE = "stale"
+
+
+class QueryLog:
+    """
+    Structured query log written off the request path.
+
+    record() only samples and puts a small tuple on a bounded queue; it never
+    formats, blocks or touches the disk. A background thread takes the records
+    in batches, turns them into JSON lines and appends each batch to the log
+    file with a single write. When the queue is full new records are dropped
+    and counted, so a slow disk costs log lines rather than query latency.
+
+    The file is opened with O_APPEND, so worker processes can share one log.
+    """
+    def __init__(self, path, sample_rate=1.0, queue_size=10000, batch_size=512, flush_interval=1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.running = False
+        self.dropped = 0
+
+    def start(self):
+        """
+        Starts the writer thread. Called in the serving process, after any fork.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._write_loop, name="query-log", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes out the queued records and stops the writer thread.
+        """
+        if self.thread is None:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+
+    def record(self, client, request, response_wire, source, started):
+        """
+        Queues a log record for an answered query. request is the wire.RawQuery
+        or dns.message.Message of the query, started its time.monotonic()
+        arrival time.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        latency = time.monotonic() - started
+        try:
+            self.queue.put_nowait((time.time(), client, request, response_wire, source, latency))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while self.running or not self.queue.empty():
+                batch = self._next_batch()
+                if batch:
+                    self._write(fd, ''.join(self._format(entry) for entry in batch).encode())
+        finally:
+            os.close(fd)
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, fd, data):
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        except OSError as e:
+            logger.error(f"Failed to write query log {self.path}: {e}")
+
+    @staticmethod
+    def _format(entry):
+        timestamp, client, request, response_wire, source, latency = entry
+        if hasattr(request, "qname"):
+            qname, qtype = request.qname, request.qtype
+        else:
+            question = request.question[0]
+            qname, qtype = question.name.to_text(), question.rdtype
+        response_rcode = rcode.to_text(response_wire[3] & 0x0F) if response_wire else None
+        return json.dumps({
+            "ts": round(timestamp, 6),
+            "client": client[0],
+            "port": client[1],
+            "qname": qname,
+            "qtype": rdatatype.to_text(qtype),
+            "source": source,
+            "rcode": response_rcode,
+            "latency_ms": round(latency * 1000, 3),
+        }, separators=(',', ':')) + '\n'
@@ -0,0 +1,112 @@
+import random
+import socket
+from array import array
+
+# What to do with a query, as returned by RateLimiter.check
+RESPOND = "respond"
+SLIP = "slip"
+DROP = "drop"
+
+# IPv4 keys live in the ffff:ffff::/32 range of the 64-bit key space, which
+# only IPv6 multicast prefixes (never a query source) could share.
+_IPV4_TAG = 0xFFFFFFFF00000000
+_GOLDEN = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+MAX_TABLE_BITS = 30
+
+
+class RateLimiter:
+    """
+    Per-client response rate limiting for UDP queries.
+
+    Clients are grouped by address prefix (ipv4_prefix / ipv6_prefix bits)
+    and every group gets a token bucket of burst responses, refilled at rate
+    responses per second. A bucket is stored as the single time at which it
+    will be full again (GCRA), so a bucket that has refilled is the same as
+    no bucket at all and needs no cleanup.
+
+    The buckets live in a fixed table of two flat arrays, 16 bytes per slot,
+    so memory stays the same no matter how many sources send queries. A
+    prefix can sit in one of two slots chosen by a salted hash; a new prefix
+    takes the one that has been idle longest, evicting whoever held it.
+
+    Of the queries over the rate, every slip-th is answered with an empty
+    TC=1 reply, so a real client retries over TCP while the victim of a
+    spoofed flood gets only a small packet; the rest are dropped. slip=0 drops
+    all of them, slip=1 truncates all of them.
+    """
+    def __init__(self, rate, burst=0, slip=2, ipv4_prefix=32, ipv6_prefix=64, table_size=262144):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if not 0 <= ipv4_prefix <= 32 or not 0 <= ipv6_prefix <= 64:
+            raise ValueError("prefix lengths must be at most 32 (IPv4) and 64 (IPv6)")
+        self.interval = 1.0 / rate
+        self.tolerance = max(burst or rate, 1) * self.interval
+        self.slip = max(slip, 0)
+        self.ipv4_mask = ((1 << ipv4_prefix) - 1) << (32 - ipv4_prefix)
+        self.ipv6_mask = ((1 << ipv6_prefix) - 1) << (64 - ipv6_prefix)
+
+        bits = min(max(table_size - 1, 1).bit_length(), MAX_TABLE_BITS)
+        self.size = 1 << bits
+        self.shift = 64 - bits
+        self.second_shift = 64 - 2 * bits if 2 * bits <= 64 else 0
+        self.mask = self.size - 1
+        self.keys = array('Q', bytes(8 * self.size))
+        self.full_at = array('d', bytes(8 * self.size))
+        self.salt = random.getrandbits(64)
+
+        self.limited = 0
+        self.slipped = 0
+        self.dropped = 0
+        self.evictions = 0
+
+    def client_key(self, address):
+        """
+        Returns the 64-bit table key for a client address: its prefix.
+        """
+        if ':' in address:
+            packed = socket.inet_pton(socket.AF_INET6, address.split('%', 1)[0])
+            return int.from_bytes(packed[:8], 'big') & self.ipv6_mask
+        return _IPV4_TAG | (int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big') & self.ipv4_mask)
+
+    def check(self, address, now):
+        """
+        Charges one response to the client at address and returns RESPOND,
+        SLIP or DROP. now is time.monotonic().
+        """
+        key = self.client_key(address)
+        mixed = ((key ^ self.salt) * _GOLDEN) & _MASK64
+        keys = self.keys
+        full_at = self.full_at
+        slot = mixed >> self.shift
+        if keys[slot] != key:
+            other = (mixed >> self.second_shift) & self.mask
+            if keys[other] == key:
+                slot = other
+            else:
+                if full_at[other] < full_at[slot]:
+                    slot = other
+                if full_at[slot] > now:
+                    self.evictions += 1
+                keys[slot] = key
+                full_at[slot] = 0.0
+
+        full = max(full_at[slot], now) + self.interval
+        if full - now <= self.tolerance:
+            full_at[slot] = full
+            return RESPOND
+
+        self.limited += 1
+        if self.slip and self.limited % self.slip == 0:
+            self.slipped += 1
+            return SLIP
+        self.dropped += 1
+        return DROP
+
+    def stats(self):
+        return {
+            "slipped": self.slipped,
+            "dropped": self.dropped,
+            "evictions": self.evictions,
+            "table_size": self.size,
+        }
@@ -0,0 +1,268 @@
+import struct
+import time
+from collections import OrderedDict
+
+from dns import flags, message, name, rcode, rdatatype
+
+from wire import skip_name
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR_FIXED = struct.Struct('!HHIH')
+_TTL = struct.Struct('!I')
+
+# TTL of stale answers, and how long after serving one the upstream is left
+# alone for that name (RFC 8767, section 4 and 5)
+STALE_ANSWER_TTL = 30
+
+
+def cache_key(request):
+    """
+    Returns the cache key for a parsed request: (qname, qtype, qclass, EDNS,
+    DO bit). Queries with and without EDNS are cached apart, since a reply
+    must carry an OPT record exactly when the query did (RFC 6891).
+    """
+    question = request.question[0]
+    edns = request.edns >= 0
+    do_bit = bool(request.ednsflags & flags.DO) if edns else False
+    return question.name.to_text().lower(), question.rdtype, question.rdclass, edns, do_bit
+
+
+def raw_cache_key(query):
+    """
+    Returns the same cache key as cache_key for a wire.RawQuery.
+    """
+    edns = query.edns >= 0
+    do_bit = bool(query.ednsflags & flags.DO) if edns else False
+    return query.qname, query.qtype, query.qclass, edns, do_bit
+
+
+def prefetch_query(key):
+    """
+    Returns a query (dns.message) for a cache key, so its reply can replace
+    the cached one.
+    """
+    qname, qtype, qclass, edns, do_bit = key
+    return message.make_query(name.from_text(qname), qtype, qclass,
+                              use_edns=0 if edns else False, want_dnssec=do_bit)
+
+
+def scan_response(wire):
+    """
+    Walks a response in wire format without building a dns.message.
+
+    Returns (rcode, answer_count, ttl_offsets, soa_negative_ttl) where
+    ttl_offsets lists (offset, ttl) for every record except OPT and
+    soa_negative_ttl is min(SOA TTL, SOA minimum) of an SOA in the authority
+    section, or None.
+    """
+    _, msg_flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(wire)
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(wire, offset) + 4
+
+    ttl_offsets = []
+    soa_negative_ttl = None
+    for index in range(ancount + nscount + arcount):
+        offset = skip_name(wire, offset)
+        rdtype, _, ttl, rdlength = _RR_FIXED.unpack_from(wire, offset)
+        if rdtype != rdatatype.OPT:
+            ttl_offsets.append((offset + 4, ttl))
+        offset += _RR_FIXED.size
+        if rdtype == rdatatype.SOA and ancount <= index < ancount + nscount:
+            minimum = _TTL.unpack_from(wire, offset + rdlength - 4)[0]
+            soa_negative_ttl = min(ttl, minimum)
+        offset += rdlength
+    if offset > len(wire):
+        raise ValueError("truncated response")
+    return msg_flags & 0x000F, ancount, ttl_offsets, soa_negative_ttl
+
+
+class _Entry:
+    __slots__ = ("wire", "stored_at", "expires_at", "ttl_offsets", "question_length",
+                 "hits", "prefetching", "stale_until")
+
+    def __init__(self, wire, stored_at, expires_at, ttl_offsets, question_length):
+        self.wire = wire
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.ttl_offsets = ttl_offsets
+        self.question_length = question_length
+        self.hits = 0
+        self.prefetching = False
+        self.stale_until = 0.0
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of forwarded responses in wire format.
+
+    Positive answers are kept for the smallest TTL in the response, negative
+    answers (NXDOMAIN and NODATA) for the SOA minimum as described in
+    RFC 2308. On a hit the record TTLs are aged in place and the client's query
+    ID and question are written over the stored ones, so the reply looks
+    exactly like a fresh upstream answer.
+
+    Popular entries are refreshed before they expire: once an entry has had
+    prefetch_hits hits and less than prefetch_window (a fraction) of its TTL
+    is left, the next hit calls prefetch(key) once, which is expected
+    to forward the query again and put() the new reply.
+
+    With serve_stale set, expired entries are kept that many more seconds
+    so that get_stale() can answer from them when no forwarder responds
+    (RFC 8767). After a stale answer, get() keeps answering the name stale
+    for STALE_ANSWER_TTL seconds instead of trying the forwarders again.
+    """
+    def __init__(self, max_entries=10000, max_bytes=0, max_ttl=86400, negative_max_ttl=3600,
+                 serve_stale=0, prefetch_hits=0, prefetch_window=0.1, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.negative_max_ttl = negative_max_ttl
+        self.serve_stale = serve_stale
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_window = prefetch_window
+        self.prefetch = None
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.prefetches = 0
+        self.stale_answers = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key, query_id, question):
+        """
+        Returns the cached response for key rewritten for the given query ID
+        and question section (wire format), or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        now = self.clock()
+        if now >= entry.expires_at:
+            if now < entry.stale_until:
+                self.entries.move_to_end(key)
+                self.stale_answers += 1
+                return self._render(entry, query_id, question, now, STALE_ANSWER_TTL)
+            if now >= entry.expires_at + self.serve_stale:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        if (self.prefetch is not None and self.prefetch_hits and entry.hits >= self.prefetch_hits
+                and not entry.prefetching
+                and entry.expires_at - now <= (entry.expires_at - entry.stored_at) * self.prefetch_window):
+            entry.prefetching = True
+            self.prefetches += 1
+            self.prefetch(key)
+        return self._render(entry, query_id, question, now)
+
+    def get_stale(self, key, query_id, question):
+        """
+        Returns an expired response for key that is still within serve_stale
+        seconds of its expiry, with every TTL set to STALE_ANSWER_TTL, or
+        None. Meant for when no forwarder could answer.
+        """
+        entry = self.entries.get(key)
+        if entry is None or not self.serve_stale:
+            return None
+        now = self.clock()
+        if now < entry.expires_at:
+            # Refreshed in the meantime
+            return self._render(entry, query_id, question, now)
+        if now >= entry.expires_at + self.serve_stale:
+            return None
+        entry.stale_until = min(now + STALE_ANSWER_TTL, entry.expires_at + self.serve_stale)
+        self.entries.move_to_end(key)
+        self.stale_answers += 1
+        return self._render(entry, query_id, question, now, STALE_ANSWER_TTL)
+
+    def _render(self, entry, query_id, question, now, stale_ttl=None):
+        response = bytearray(entry.wire)
+        struct.pack_into('!H', response, 0, query_id)
+        if len(question) == entry.question_length:
+            response[12:12 + entry.question_length] = question
+        if stale_ttl is not None:
+            for offset, ttl in entry.ttl_offsets:
+                _TTL.pack_into(response, offset, min(ttl, stale_ttl))
+            return bytes(response)
+        elapsed = int(now - entry.stored_at)
+        if elapsed:
+            for offset, ttl in entry.ttl_offsets:
+                _TTL.pack_into(response, offset, max(ttl - elapsed, 0))
+        return bytes(response)
+
+    def put(self, key, wire):
+        """
+        Stores a response if it is cacheable. Returns True if it was stored.
+        """
+        if not self.enabled:
+            return False
+        try:
+            response_rcode, answer_count, ttl_offsets, soa_negative_ttl = scan_response(wire)
+        except (IndexError, struct.error, ValueError):
+            return False
+        if _HEADER.unpack_from(wire)[1] & flags.TC:
+            return False
+
+        if response_rcode == rcode.NOERROR and answer_count:
+            ttl = min((t for _, t in ttl_offsets), default=0)
+            ttl = min(ttl, self.max_ttl)
+        elif response_rcode in (rcode.NOERROR, rcode.NXDOMAIN) and soa_negative_ttl is not None:
+            ttl = min(soa_negative_ttl, self.negative_max_ttl)
+        else:
+            # SERVFAIL, REFUSED, or a negative answer without an SOA
+            return False
+        if ttl <= 0:
+            return False
+
+        if key in self.entries:
+            self._remove(key)
+        now = self.clock()
+        question_length = skip_name(wire, 12) + 4 - 12
+        self.entries[key] = _Entry(bytes(wire), now, now + ttl, ttl_offsets, question_length)
+        self.size_bytes += len(wire)
+        self._evict()
+        return True
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size_bytes -= len(entry.wire)
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes and self.size_bytes > self.max_bytes)):
+            _, entry = self.entries.popitem(last=False)
+            self.size_bytes -= len(entry.wire)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the cache counters as a dict.
+        """
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "prefetches": self.prefetches,
+            "stale_answers": self.stale_answers,
+        }
@@ -0,0 +1,233 @@
+import logging
+import struct
+
+from dns import rdatatype, rrset
+
+logger = logging.getLogger(__name__)
+
+# Answer records point their owner name at the question name, which always
+# starts right after the 12 byte header.
+QUESTION_POINTER = b'\xc0\x0c'
+DEFAULT_TTL = 300
+# UDP payload size advertised in the OPT record (the DNS Flag Day 2020 value)
+EDNS_PAYLOAD = 1232
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR_FIXED = struct.Struct('!HHIH')
+
+
+def opt_record(payload):
+    """
+    Returns an OPT record advertising the given UDP payload size: root
+    owner, class = payload size (never below 512), TTL 0 (no extended
+    flags), no options.
+    """
+    return b'\x00' + _RR_FIXED.pack(rdatatype.OPT, max(payload, 512), 0, 0)
+
+
+OPT_RECORD = opt_record(EDNS_PAYLOAD)
+
+FLAG_QR = 0x8000
+# Opcode and RD are copied from the query, as message.make_response does
+QUERY_FLAGS_COPIED = 0x7900
+RCODE_SERVFAIL = 2
+
+# How the CNAME chain of an answer ends: in the loaded zones (or there is no
+# chain), at a name outside them that has to be forwarded, or in a loop or
+# past MAX_CHAIN_LENGTH, which is answered with SERVFAIL.
+CHAIN_COMPLETE = 0
+CHAIN_EXTERNAL = 1
+CHAIN_BROKEN = 2
+
+
+class CompiledAnswer:
+    """
+    A static answer compiled at zone load time.
+
+    Holds the answer section pre-rendered in wire format, so that answering
+    a query only needs a new header and the question copied from the
+    request. The same bytes are what zone snapshots store on disk.
+
+    chain_end says how a flattened CNAME chain ends (CHAIN_COMPLETE etc.). A
+    CHAIN_EXTERNAL answer is only the chain: the query is answered by
+    forwarding its last target. A CHAIN_BROKEN answer renders as SERVFAIL.
+    """
+    __slots__ = ("rdtype", "count", "wire", "chain_end")
+
+    def __init__(self, rdtype, count, wire, chain_end=CHAIN_COMPLETE):
+        self.rdtype = rdtype
+        self.count = count
+        self.wire = wire
+        self.chain_end = chain_end
+
+    @classmethod
+    def from_rrset(cls, answer_rrset):
+        parts = []
+        for rdata in answer_rrset:
+            rdata_wire = rdata.to_wire()
+            parts.append(QUESTION_POINTER)
+            parts.append(_RR_FIXED.pack(answer_rrset.rdtype, answer_rrset.rdclass,
+                                        answer_rrset.ttl, len(rdata_wire)))
+            parts.append(rdata_wire)
+        return cls(answer_rrset.rdtype, len(answer_rrset), b''.join(parts))
+
+    def render(self, query_id, query_flags, question_wire, edns=False, payload=EDNS_PAYLOAD):
+        """
+        Builds a complete response for a query with the given ID, flags and
+        question section (copied verbatim from the request, preserving case).
+        With edns the response advertises payload as our UDP payload size.
+        """
+        flags = FLAG_QR | (query_flags & QUERY_FLAGS_COPIED)
+        if self.chain_end == CHAIN_BROKEN:
+            flags |= RCODE_SERVFAIL
+        if edns:
+            header = _HEADER.pack(query_id, flags, 1, self.count, 0, 1)
+            opt = OPT_RECORD if payload == EDNS_PAYLOAD else opt_record(payload)
+            return header + question_wire + self.wire + opt
+        header = _HEADER.pack(query_id, flags, 1, self.count, 0, 0)
+        return header + question_wire + self.wire
+
+
+def compile_answer(owner, record_type, formatted_values, ttl=DEFAULT_TTL):
+    """
+    Parses the formatted record values once and returns a CompiledAnswer.
+    """
+    answer_rrset = rrset.from_text_list(owner, ttl, 'IN', record_type, formatted_values)
+    return CompiledAnswer.from_rrset(answer_rrset)
+
+
+def question_wire(data, qname):
+    """
+    Returns the question section of a query packet: the name as sent by the
+    client plus the type and class.
+    """
+    end = 12 + len(qname.to_wire()) + 4
+    return data[12:end]
+
+
+# Record key of an alias's flattened CNAME chain on its own: the answer for
+# every query type the chain does not end in (NODATA, a target outside the
+# loaded zones, or a broken chain; see chain_end).
+CHAIN_KEY = '*'
+# Longer CNAME chains are cut off, like a loop
+MAX_CHAIN_LENGTH = 16
+
+
+def name_wire(name):
+    """
+    Returns an absolute domain name ("www.example.com." or without the dot)
+    in uncompressed wire format, lowercased.
+    """
+    labels = name.rstrip('.').lower().split('.') if name.strip('.') else []
+    return b''.join(bytes([len(label)]) + label.encode() for label in labels) + b'\x00'
+
+
+def _read_name(wire, offset):
+    """
+    Returns the uncompressed name at offset as lowercase text with the
+    trailing dot.
+    """
+    labels = []
+    while wire[offset]:
+        length = wire[offset]
+        labels.append(bytes(wire[offset + 1:offset + 1 + length]).decode('ascii', 'replace').lower())
+        offset += length + 1
+    return '.'.join(labels) + '.'
+
+
+def _rdata_offset(wire, offset):
+    """
+    Returns the offset of the rdata of the record at offset in an answer
+    section built here: owned by the question pointer or by an
+    uncompressed name.
+    """
+    if wire[offset] & 0xC0 == 0xC0:
+        offset += len(QUESTION_POINTER)
+    else:
+        while wire[offset]:
+            offset += wire[offset] + 1
+        offset += 1
+    return offset + _RR_FIXED.size
+
+
+def cname_target(answer):
+    """
+    Returns the target of a compiled CNAME answer as lowercase text with the
+    trailing dot.
+    """
+    return _read_name(answer.wire, len(QUESTION_POINTER) + _RR_FIXED.size)
+
+
+def chain_target(answer):
+    """
+    Returns the name the last record of a flattened CNAME chain points to,
+    as lowercase text with the trailing dot.
+    """
+    wire = answer.wire
+    offset = 0
+    while True:
+        rdata = _rdata_offset(wire, offset)
+        end = rdata + _RR_FIXED.unpack_from(wire, rdata - _RR_FIXED.size)[3]
+        if end >= len(wire):
+            return _read_name(wire, rdata)
+        offset = end
+
+
+def _with_owner(wire, owner):
+    """
+    Returns answer records as built by CompiledAnswer.from_rrset with the
+    question pointer of every record replaced by the owner name (wire format).
+    """
+    parts = []
+    offset = 0
+    while offset < len(wire):
+        rdlength = _RR_FIXED.unpack_from(wire, offset + len(QUESTION_POINTER))[3]
+        end = offset + len(QUESTION_POINTER) + _RR_FIXED.size + rdlength
+        parts.append(owner)
+        parts.append(wire[offset + len(QUESTION_POINTER):end])
+        offset = end
+    return b''.join(parts)
+
+
+def flatten_cname(lookup, owner, records):
+    """
+    Follows the CNAME chain of an alias through lookup (ZoneIndex.lookup)
+    and returns the answers to add to its records: for every type the chain
+    ends in, the whole chain followed by the target's records, and under
+    CHAIN_KEY the chain alone. The alias's own CNAME record is owned by the
+    question name, so wildcard aliases work the same way.
+
+    A chain that leaves the loaded zones is marked CHAIN_EXTERNAL, so that
+    its target is forwarded at query time. A loop or a chain longer than
+    MAX_CHAIN_LENGTH is marked CHAIN_BROKEN.
+    """
+    chain = [records['CNAME'].wire]
+    count = records['CNAME'].count
+    seen = {owner.lower().rstrip('.') + '.'}
+    target = cname_target(records['CNAME'])
+    while True:
+        if target in seen or len(chain) >= MAX_CHAIN_LENGTH:
+            logger.warning(f"CNAME chain from {owner} loops or is too long at {target}, answering SERVFAIL")
+            return {CHAIN_KEY: CompiledAnswer(rdatatype.CNAME, 0, b'', CHAIN_BROKEN)}
+        seen.add(target)
+        _, target_records = lookup(target)
+        if not target_records:
+            # The target is outside the loaded zones (or not in them, which
+            # the server forwards too): it is forwarded at query time
+            return {CHAIN_KEY: CompiledAnswer(rdatatype.CNAME, count, b''.join(chain), CHAIN_EXTERNAL)}
+        cname = target_records.get('CNAME')
+        if cname is None:
+            break
+        chain.append(_with_owner(cname.wire, name_wire(target)))
+        count += cname.count
+        target = cname_target(cname)
+
+    chain_wire = b''.join(chain)
+    flattened = {CHAIN_KEY: CompiledAnswer(rdatatype.CNAME, count, chain_wire)}
+    target_owner = name_wire(target)
+    for record_type, answer in target_records.items():
+        if record_type == CHAIN_KEY:
+            continue
+        flattened[record_type] = CompiledAnswer(answer.rdtype, count + answer.count,
+                                                chain_wire + _with_owner(answer.wire, target_owner))
+    return flattened
@@ -0,0 +1,93 @@
+import logging
+import socket
+import struct
+import threading
+
+from wire import tcp_frame
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('!H')
+
+
+def _read_exactly(conn, size):
+    """
+    Reads size bytes from conn, or returns None if the peer closed the
+    connection first.
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class TCPListener:
+    """
+    DNS over TCP (RFC 7766) for the sync engine.
+
+    Every connection is served by its own thread, which reads length-prefixed
+    queries one after another, so a client can pipeline several queries on
+    one connection; they are answered in the order they were sent. A
+    connection is closed after idle_timeout seconds without a query, and at
+    most max_connections are served at once; further connections are closed
+    right away.
+
+    handle_query(data, addr, send) answers a query and passes the reply to
+    send(response_wire), which frames it and writes it to the connection.
+    """
+    def __init__(self, sock, handle_query, max_connections=100, idle_timeout=10.0):
+        self.sock = sock
+        self.handle_query = handle_query
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop, name="dns-tcp", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                if self.running:
+                    logger.error("TCP listener stopped accepting connections")
+                return
+            if not self.slots.acquire(blocking=False):
+                logger.warning(f"Too many TCP connections, closing connection from {addr}")
+                conn.close()
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn, addr), daemon=True).start()
+
+    def _serve_connection(self, conn, addr):
+        try:
+            conn.settimeout(self.idle_timeout)
+            while self.running:
+                header = _read_exactly(conn, _LENGTH.size)
+                if header is None:
+                    break
+                data = _read_exactly(conn, _LENGTH.unpack(header)[0])
+                if data is None:
+                    break
+                self.handle_query(data, addr, lambda response_wire: conn.sendall(tcp_frame(response_wire)))
+        except socket.timeout:
+            logger.debug(f"Closing idle TCP connection from {addr}")
+        except OSError as e:
+            logger.debug(f"TCP connection from {addr} failed: {e}")
+        finally:
+            conn.close()
+            self.slots.release()
@@ -0,0 +1,607 @@
+import asyncio
+import logging
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+
+from dns import message, query
+
+from wire import FLAG_TC, tcp_frame
+
+DNS_PORT = 53
+DOT_PORT = 853
+
+# FORWARD_TRANSPORT values
+TRANSPORT_UDP = "udp"
+TRANSPORT_TCP = "tcp"
+TRANSPORT_TLS = "tls"
+
+logger = logging.getLogger(__name__)
+
+# Query IDs and source ports must not be predictable from earlier queries
+_system_random = random.SystemRandom()
+
+
+def parse_forwarder(text, default_port=DNS_PORT):
+    """
+    Parses a FORWARDERS entry ("8.8.8.8" or "127.0.0.1:5300") into (host, port).
+    """
+    text = text.strip()
+    if text.count(':') == 1:
+        host, port = text.split(':')
+        return host, int(port)
+    return text, default_port
+
+
+def tls_context(ca_file=None, cert_file=None, key_file=None):
+    """
+    Returns the client SSL context for DNS over TLS forwarders: verified
+    against ca_file (a local CA or self-signed certificate), or the system
+    CAs if it is not set, with an optional client certificate.
+    """
+    context = ssl.create_default_context(cafile=ca_file or None)
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file or None)
+    return context
+
+
+def _enable_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+def question_key(msg):
+    """
+    Returns the (qname, qtype, qclass) key used to match responses to queries.
+    """
+    question = msg.question[0]
+    return question.name.to_text().lower(), question.rdtype, question.rdclass
+
+
+def rewrite_reply(wire, query_id, question):
+    """
+    Returns a reply with the given query ID and question section (wire
+    format) written over its own. The question is only replaced when it is
+    the same name, differing at most in letter case.
+    """
+    reply = bytearray(wire)
+    struct.pack_into('!H', reply, 0, query_id)
+    end = 12 + len(question)
+    if len(reply) >= end and reply[12:end].lower() == question.lower():
+        reply[12:end] = question
+    return bytes(reply)
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint for one socket of a forwarder, handing replies back to
+    AsyncUpstream.
+    """
+    def __init__(self, upstream, port):
+        self.upstream = upstream
+        self.port = port
+
+    def datagram_received(self, data, addr):
+        self.upstream.response_received(data, self.port)
+
+    def error_received(self, exc):
+        # ICMP errors cannot be tied to a query; the query deadline covers them
+        logger.debug(f"Upstream {self.upstream.address} reported error: {exc}")
+
+
+class _SourcePort:
+    """
+    One connected UDP socket of an AsyncUpstream, on a random local port.
+    """
+    __slots__ = ("transport", "opened", "sent", "pending", "retired")
+
+    def __init__(self):
+        self.transport = None
+        self.opened = None  # task opening the socket
+        self.sent = 0
+        self.pending = 0
+        self.retired = False
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+def _unused_id(pending):
+    """
+    Returns an unpredictable query ID that is not in pending.
+    """
+    while True:
+        query_id = _system_random.getrandbits(16)
+        if query_id not in pending:
+            return query_id
+
+
+class AsyncUpstream:
+    """
+    Asynchronous UDP client for a single forwarder.
+
+    Truncated (TC) replies are retried over TCP. Many queries can be in
+    flight at once. Each outgoing query gets an unpredictable ID and leaves
+    from one of ports sockets picked at random, each bound to a random local
+    port by the kernel and replaced after port_queries queries, so a spoofed
+    reply has to guess the source port as well as the ID (RFC 5452). Replies
+    are matched on the ID, the socket and the question and anything else is
+    dropped, so a late or spoofed reply can never be delivered to the wrong
+    client.
+    """
+    def __init__(self, host, port=DNS_PORT, ports=4, port_queries=100):
+        self.host = host
+        self.port = port
+        self.address = f"{host}:{port}"
+        self.sockets = [None] * max(ports, 1)
+        self.port_queries = port_queries
+        self.pending = {}  # {query_id: (future, question_key, _SourcePort)}
+
+    async def _open(self, port):
+        loop = asyncio.get_running_loop()
+        port.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UpstreamProtocol(self, port), remote_addr=(self.host, self.port)
+        )
+        if port.retired and not port.pending:
+            port.close()
+
+    def _retire(self, port):
+        port.retired = True
+        if not port.pending:
+            port.close()
+
+    async def _source_port(self):
+        """
+        Returns a random socket for the next query, opening a new one in
+        place of a socket that has sent its share of queries.
+        """
+        index = _system_random.randrange(len(self.sockets))
+        port = self.sockets[index]
+        if port is None or port.sent >= self.port_queries:
+            if port is not None:
+                self._retire(port)
+            port = self.sockets[index] = _SourcePort()
+            port.opened = asyncio.ensure_future(self._open(port))
+            # Retrieved here too, in case nobody is waiting for it any more
+            port.opened.add_done_callback(lambda opened: opened.cancelled() or opened.exception())
+        port.sent += 1
+        port.pending += 1
+        try:
+            await asyncio.shield(port.opened)
+        except BaseException:
+            self._release(port)
+            if self.sockets[index] is port and port.opened.done() and port.transport is None:
+                self.sockets[index] = None
+            raise
+        return port
+
+    def _release(self, port):
+        port.pending -= 1
+        if port.retired and not port.pending:
+            port.close()
+
+    def close(self):
+        for index, port in enumerate(self.sockets):
+            if port is not None:
+                if not port.opened.done():
+                    port.opened.cancel()
+                port.close()
+                self.sockets[index] = None
+        for future, _, _ in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    async def query(self, request, data, timeout):
+        """
+        Sends the query and waits up to timeout seconds for the matching reply.
+
+        data is the query in wire format; the reply is returned in wire format
+        with the ID of the original request. Raises asyncio.TimeoutError.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        port = await asyncio.wait_for(self._source_port(), timeout)
+        query_id = _unused_id(self.pending)
+        future = loop.create_future()
+        self.pending[query_id] = (future, question_key(request), port)
+        try:
+            port.transport.sendto(struct.pack('!H', query_id) + data[2:])
+            reply = await asyncio.wait_for(future, deadline - loop.time())
+        finally:
+            self.pending.pop(query_id, None)
+            self._release(port)
+        if struct.unpack_from('!H', reply, 2)[0] & FLAG_TC:
+            # The TCP retry only gets what is left of the timeout
+            reply = await asyncio.wait_for(self.query_tcp(query_id, data), deadline - loop.time())
+        return struct.pack('!H', request.id) + reply[2:]
+
+    async def query_tcp(self, query_id, data):
+        """
+        Sends the query over a new TCP connection and returns the reply.
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(tcp_frame(struct.pack('!H', query_id) + data[2:]))
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            reply = await reader.readexactly(length)
+        finally:
+            writer.close()
+        if len(reply) < 12 or struct.unpack_from('!H', reply)[0] != query_id:
+            raise ValueError(f"Mismatched TCP reply from {self.address}")
+        return reply
+
+    def response_received(self, data, port):
+        if len(data) < 12:
+            return
+        query_id = struct.unpack_from('!H', data)[0]
+        entry = self.pending.get(query_id)
+        if entry is None or entry[2] is not port:
+            logger.debug(f"Dropping unexpected reply from {self.address}")
+            return
+        future, key, _ = entry
+        try:
+            response = message.from_wire(data)
+        except Exception as e:
+            logger.debug(f"Dropping malformed reply from {self.address}: {e}")
+            return
+        if not response.question or question_key(response) != key:
+            logger.debug(f"Dropping reply from {self.address} with mismatched question")
+            return
+        if not future.done():
+            future.set_result(data)
+
+
+class _StreamConnection:
+    """
+    One open connection of an AsyncStreamUpstream and the IDs of the
+    queries waiting for a reply on it.
+    """
+    __slots__ = ("reader", "writer", "pending", "task", "idle_timer", "queries")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = set()
+        self.task = None
+        self.idle_timer = None
+        self.queries = 0
+
+
+class AsyncStreamUpstream:
+    """
+    Asynchronous DNS over TCP, or TLS (RFC 7858) with an ssl_context, for a
+    single forwarder, over a pool of persistent connections.
+
+    Every connection carries many queries at once (pipelining, RFC 7766). A
+    query goes to the open connection with the fewest queries in flight;
+    while all of them are busy another one is opened in the background, up
+    to pool_size. Replies are matched on a fresh unpredictable ID and the question,
+    as over UDP. Connections use TCP keepalive and are closed after
+    idle_timeout seconds without a query. If a connection is closed before
+    a reply arrives (a server closing idle connections, for instance), a
+    query that was sent on a reused connection is retried once on a new one.
+    """
+    def __init__(self, host, port=DNS_PORT, ssl_context=None, server_hostname=None,
+                 pool_size=2, idle_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.address = f"{host}:{port}"
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname or (host if ssl_context else None)
+        self.pool_size = max(pool_size, 1)
+        self.idle_timeout = idle_timeout
+        self.connections = []
+        self.opening = None  # future of the connection being opened
+        self.pending = {}  # {query_id: (future, question_key)}
+        self.connects = 0
+
+    async def _open(self):
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl_context, server_hostname=self.server_hostname
+            )
+        finally:
+            self.opening = None
+        _enable_keepalive(writer.get_extra_info('socket'))
+        connection = _StreamConnection(reader, writer)
+        connection.task = asyncio.ensure_future(self._read_replies(connection))
+        self.connections.append(connection)
+        self.connects += 1
+        logger.debug(f"Opened {'TLS' if self.ssl_context else 'TCP'} connection to {self.address}")
+        return connection
+
+    def _start_opening(self):
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self._open())
+            # Retrieved here too, in case nobody is waiting for it any more
+            self.opening.add_done_callback(lambda opening: opening.cancelled() or opening.exception())
+        return self.opening
+
+    async def _connection(self):
+        """
+        Returns the connection for the next query, opening one if needed.
+        """
+        best = min(self.connections, key=lambda connection: len(connection.pending), default=None)
+        if best is None:
+            return await asyncio.shield(self._start_opening())
+        if best.pending and len(self.connections) < self.pool_size:
+            self._start_opening()
+        return best
+
+    async def _read_replies(self, connection):
+        try:
+            while True:
+                length = int.from_bytes(await connection.reader.readexactly(2), 'big')
+                self._reply_received(connection, await connection.reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, ssl.SSLError) as e:
+            logger.debug(f"Connection to {self.address} closed: {e!r}")
+        finally:
+            self._drop(connection)
+
+    def _reply_received(self, connection, data):
+        if len(data) < 12:
+            return
+        query_id = struct.unpack_from('!H', data)[0]
+        entry = self.pending.get(query_id)
+        if entry is None or query_id not in connection.pending:
+            logger.debug(f"Dropping unexpected reply from {self.address}")
+            return
+        future, key = entry
+        try:
+            response = message.from_wire(data)
+        except Exception as e:
+            logger.debug(f"Dropping malformed reply from {self.address}: {e}")
+            return
+        if not response.question or question_key(response) != key:
+            logger.debug(f"Dropping reply from {self.address} with mismatched question")
+            return
+        if not future.done():
+            future.set_result(data)
+
+    def _drop(self, connection):
+        """
+        Forgets a closed connection and fails the queries still waiting on it.
+        """
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if connection.idle_timer is not None:
+            connection.idle_timer.cancel()
+        connection.writer.close()
+        for query_id in connection.pending:
+            entry = self.pending.get(query_id)
+            if entry is not None and not entry[0].done():
+                entry[0].set_exception(ConnectionResetError(f"connection to {self.address} closed"))
+
+    def _close_idle(self, connection):
+        connection.idle_timer = None
+        if not connection.pending:
+            connection.task.cancel()
+
+    def close(self):
+        if self.opening is not None:
+            self.opening.cancel()
+        for connection in list(self.connections):
+            connection.task.cancel()
+            self._drop(connection)
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    async def query(self, request, data, timeout):
+        """
+        Sends the query and waits up to timeout seconds for the matching reply.
+
+        data is the query in wire format; the reply is returned in wire format
+        with the ID of the original request. Raises asyncio.TimeoutError.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for attempt in range(2):
+            connection = await asyncio.wait_for(self._connection(), deadline - loop.time())
+            reused = connection.queries > 0
+            connection.queries += 1
+            if connection.idle_timer is not None:
+                connection.idle_timer.cancel()
+                connection.idle_timer = None
+
+            query_id = _unused_id(self.pending)
+            future = loop.create_future()
+            self.pending[query_id] = (future, question_key(request))
+            connection.pending.add(query_id)
+            try:
+                connection.writer.write(tcp_frame(struct.pack('!H', query_id) + data[2:]))
+                reply = await asyncio.wait_for(future, deadline - loop.time())
+            except ConnectionResetError:
+                if attempt or not reused:
+                    raise
+                continue
+            finally:
+                self.pending.pop(query_id, None)
+                connection.pending.discard(query_id)
+                if not connection.pending and connection in self.connections:
+                    connection.idle_timer = loop.call_later(self.idle_timeout, self._close_idle, connection)
+            return struct.pack('!H', request.id) + reply[2:]
+
+
+class StreamPool:
+    """
+    Persistent TCP or TLS connections to the forwarders for the sync engine.
+
+    Each query borrows an idle connection to its forwarder, or opens a new
+    one, and hands it back afterwards; up to pool_size idle connections per
+    forwarder are kept for idle_timeout seconds. A reused connection that
+    fails (typically closed by the server in the meantime) is replaced by a
+    new one and the query sent again once.
+    """
+    def __init__(self, ssl_context=None, server_hostname=None, pool_size=2, idle_timeout=30.0):
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.pool_size = max(pool_size, 1)
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # {(host, port): [(socket, released at)]}
+        self.lock = threading.Lock()
+        self.connects = {}  # {"host:port": connections opened}
+
+    def _borrow(self, host, port, timeout):
+        """
+        Returns (socket, reused).
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get((host, port), [])
+            while idle:
+                sock, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    return sock, True
+                sock.close()
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            _enable_keepalive(sock)
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.server_hostname or host)
+        except Exception:
+            sock.close()
+            raise
+        address = f"{host}:{port}"
+        with self.lock:
+            self.connects[address] = self.connects.get(address, 0) + 1
+        return sock, False
+
+    def _release(self, host, port, sock):
+        with self.lock:
+            idle = self.idle.setdefault((host, port), [])
+            if len(idle) < self.pool_size:
+                idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def query(self, request, host, port, timeout):
+        """
+        Sends request (a dns.message) to host:port and returns the response.
+        """
+        for attempt in range(2):
+            sock, reused = self._borrow(host, port, timeout)
+            try:
+                response = query.tcp(request, host, timeout, port, sock=sock)
+            except Exception:
+                sock.close()
+                if attempt or not reused:
+                    raise
+                continue
+            self._release(host, port, sock)
+            return response
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for sock, _ in idle:
+                    sock.close()
+            self.idle.clear()
+
+
+class ForwarderState:
+    """
+    Smoothed RTT and failure tracking for one forwarder, in the style of the
+    TCP retransmission timer (RFC 6298).
+    """
+    __slots__ = ("srtt", "rttvar", "failures", "held_until", "failed_at")
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.failures = 0
+        self.held_until = 0.0
+        self.failed_at = 0.0
+
+    def record_success(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.failures = 0
+        self.held_until = 0.0
+
+    def record_failure(self, now, threshold, holddown):
+        """
+        Counts a timeout or error. After threshold consecutive failures the
+        forwarder is held back for an exponentially growing time, capped at
+        holddown seconds.
+        """
+        self.failures += 1
+        self.failed_at = now
+        if self.failures >= threshold:
+            backoff = min(2 ** (self.failures - threshold), holddown)
+            self.held_until = now + backoff
+
+    def forget_failures(self, now, holddown):
+        """
+        Clears the failures once holddown seconds have passed without
+        another one, so that a forwarder ranked behind faster ones is not
+        penalised forever for failures nobody has re-checked.
+        """
+        if self.failures and now - self.failed_at >= holddown:
+            self.failures = 0
+            self.held_until = 0.0
+
+
+class UpstreamSelector:
+    """
+    Orders the forwarders for each query by observed latency.
+
+    Forwarders that have not answered yet are assumed to be as fast as
+    initial_rtt so that they get tried, and every recent failure counts as
+    one more RTT. Forwarders in hold-down go to the back of the list, where
+    they are still used if nothing else answers. Failures are forgotten
+    after holddown seconds without a new one: the forwarder is then ranked
+    by its RTT again, and probed by the next query if that puts it first.
+    """
+    def __init__(self, forwarders, initial_rtt=0.05, failure_threshold=3, holddown=60.0,
+                 hedge_min_delay=0.02, hedge_max_delay=1.0, clock=time.monotonic):
+        self.states = {forwarder: ForwarderState() for forwarder in forwarders}
+        self.initial_rtt = initial_rtt
+        self.failure_threshold = failure_threshold
+        self.holddown = holddown
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.clock = clock
+
+    def _sort_key(self, forwarder, now):
+        state = self.states[forwarder]
+        if state.held_until > now:
+            return 1, state.held_until
+        rtt = self.initial_rtt if state.srtt is None else state.srtt
+        return 0, rtt * (1 + state.failures)
+
+    def ordered(self):
+        """
+        Returns the forwarders, best first.
+        """
+        now = self.clock()
+        for state in self.states.values():
+            state.forget_failures(now, self.holddown)
+        return sorted(self.states, key=lambda forwarder: self._sort_key(forwarder, now))
+
+    def hedge_delay(self, forwarder):
+        """
+        How long to wait for forwarder before also asking the next one.
+        """
+        state = self.states[forwarder]
+        if state.srtt is None:
+            delay = 2 * self.initial_rtt
+        else:
+            delay = state.srtt + 4 * state.rttvar
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    def record_success(self, forwarder, rtt):
+        self.states[forwarder].record_success(rtt)
+
+    def record_failure(self, forwarder):
+        self.states[forwarder].record_failure(self.clock(), self.failure_threshold, self.holddown)
@@ -0,0 +1,175 @@
+import struct
+
+from dns import rdatatype
+
+from static_answers import EDNS_PAYLOAD, OPT_RECORD, opt_record
+
+# Largest response to a UDP query without EDNS (RFC 1035)
+CLASSIC_UDP_SIZE = 512
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+# Query flags echoed in a reply: opcode, RD and CD
+_ECHOED_FLAGS = 0x7910
+
+_HEADER = struct.Struct('!HHHHHH')
+_LENGTH = struct.Struct('!H')
+
+
+def skip_name(wire, offset):
+    """
+    Returns the offset just past the (possibly compressed) name at offset.
+    """
+    while True:
+        length = wire[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def udp_limit(request, max_udp_size):
+    """
+    Returns the largest UDP response the client can take: its EDNS buffer
+    size (never below 512), capped at our own max_udp_size.
+    """
+    if request.edns < 0:
+        return CLASSIC_UDP_SIZE
+    return min(max(request.payload, CLASSIC_UDP_SIZE), max(max_udp_size, CLASSIC_UDP_SIZE))
+
+
+def truncate(wire, edns=False, payload=EDNS_PAYLOAD):
+    """
+    Returns a TC=1 version of a response: header and question only, plus an
+    OPT record advertising payload if the query used EDNS, telling the
+    client to retry over TCP.
+    """
+    query_id, flags, qdcount, _, _, _ = _HEADER.unpack_from(wire)
+    end = 12
+    for _ in range(qdcount):
+        end = skip_name(wire, end) + 4
+    header = _HEADER.pack(query_id, flags | FLAG_TC, qdcount, 0, 0, 1 if edns else 0)
+    if not edns:
+        return header + wire[12:end]
+    return header + wire[12:end] + (OPT_RECORD if payload == EDNS_PAYLOAD else opt_record(payload))
+
+
+def fit_udp(wire, request, max_udp_size):
+    """
+    Returns the response as is if it fits in a UDP reply to request,
+    otherwise the truncated version.
+    """
+    if len(wire) <= udp_limit(request, max_udp_size):
+        return wire
+    return truncate(wire, request.edns >= 0, max_udp_size)
+
+
+def truncated_reply(data):
+    """
+    Returns an empty TC=1 reply (header and question only) to a query
+    packet, or None if the packet is not a query with one question.
+    """
+    if len(data) < 12:
+        return None
+    query_id, flags, qdcount, _, _, _ = _HEADER.unpack_from(data)
+    if flags & FLAG_QR or qdcount != 1:
+        return None
+    try:
+        end = skip_name(data, 12) + 4
+    except IndexError:
+        return None
+    if end > len(data):
+        return None
+    return _HEADER.pack(query_id, flags & _ECHOED_FLAGS | FLAG_QR | FLAG_TC, 1, 0, 0, 0) + data[12:end]
+
+
+def tcp_frame(wire):
+    """
+    Prefixes a message with its two byte length for DNS over TCP.
+    """
+    return _LENGTH.pack(len(wire)) + wire
+
+
+class RawQuery:
+    """
+    The header and question of a query read straight from the packet.
+
+    id, flags, edns, payload and ednsflags mean the same as on a
+    dns.message.Message, so a RawQuery can be passed wherever only those are
+    needed (e.g. fit_udp). qname is the lowercase name in text form with the
+    trailing dot, qtype and qclass are integers and question is the question
+    section exactly as sent.
+    """
+    __slots__ = ("id", "flags", "edns", "payload", "ednsflags", "qname", "qtype", "qclass", "question")
+
+    def __init__(self, query_id, flags, edns, payload, ednsflags, qname, qtype, qclass, question):
+        self.id = query_id
+        self.flags = flags
+        self.edns = edns
+        self.payload = payload
+        self.ednsflags = ednsflags
+        self.qname = qname
+        self.qtype = qtype
+        self.qclass = qclass
+        self.question = question
+
+
+_QUESTION_FIXED = struct.Struct('!HH')
+_OPT_FIXED = struct.Struct('!BHHBBHH')
+# Label bytes whose text form is the same in dnspython; names with anything
+# else (escapes, dots inside labels) take the full parsing path.
+_PLAIN_LABEL_BYTES = b"-_*0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_QR_OPCODE_MASK = 0xF800
+
+
+def parse_query(data):
+    """
+    Reads a plain query without building a dns.message: a standard query
+    (QR=0, opcode QUERY) with one uncompressed question, no answer or
+    authority records and at most an EDNS0 OPT record.
+
+    Returns a RawQuery, or None if the packet is anything else and has to
+    be parsed in full.
+    """
+    if len(data) < 12:
+        return None
+    query_id, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(data)
+    if flags & _QR_OPCODE_MASK or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+
+    offset = 12
+    labels = []
+    try:
+        while True:
+            length = data[offset]
+            if length == 0:
+                break
+            if length > 63:
+                return None
+            label = data[offset + 1:offset + 1 + length]
+            if len(label) != length or label.translate(None, _PLAIN_LABEL_BYTES):
+                return None
+            labels.append(label)
+            offset += length + 1
+        end = offset + 1 + _QUESTION_FIXED.size
+        qtype, qclass = _QUESTION_FIXED.unpack_from(data, offset + 1)
+    except (IndexError, struct.error):
+        return None
+
+    edns = -1
+    payload = 0
+    ednsflags = 0
+    if arcount:
+        # Root owner name, type OPT, EDNS version 0, options (if any) skipped
+        try:
+            owner, rdtype, payload, _, version, ednsflags, rdlength = _OPT_FIXED.unpack_from(data, end)
+        except struct.error:
+            return None
+        if owner != 0 or rdtype != rdatatype.OPT or version != 0 or end + _OPT_FIXED.size + rdlength != len(data):
+            return None
+        edns = 0
+    elif end != len(data):
+        return None
+
+    qname = b'.'.join(labels).lower().decode('ascii') + '.'
+    return RawQuery(query_id, flags, edns, payload, ednsflags, qname, qtype, qclass, data[12:end])
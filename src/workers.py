@@ -0,0 +1,97 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after being started (e.g. because it
+# cannot bind) is not restarted, so a configuration error cannot become a fork loop.
+MIN_WORKER_LIFETIME = 1.0
+
+
+def _run_worker(resolver, index):
+    """
+    Body of a forked worker process. Never returns.
+    """
+    resolver.worker_index = index
+    # The parent handles Ctrl-C and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # The socket created by the parent is shared by every fork; each worker
+    # needs its own to bind with SO_REUSEPORT.
+    resolver.sock.close()
+    resolver.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    status = 0
+    try:
+        resolver.serve()
+    except Exception as e:
+        logger.error(f"Worker {os.getpid()} failed: {e}")
+        status = 1
+    finally:
+        logging.shutdown()
+        os._exit(status)
+
+
+def run_workers(resolver, count):
+    """
+    Forks count worker processes that each serve on their own SO_REUSEPORT
+    socket bound to LISTEN_IP:LISTEN_PORT.
+
+    The zones are loaded and compiled by the parent before forking, so all
+    workers share one copy of them copy-on-write; gc.freeze() keeps the
+    collector from touching (and so copying) those objects in the children.
+    Each worker keeps its own response cache and metrics. The parent restarts workers
+    that die and stops all of them on SIGINT or SIGTERM.
+    """
+    gc.freeze()
+    children = {}  # {pid: (start time, worker index)}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(resolver, index)
+        children[pid] = (time.monotonic(), index)
+        logger.info(f"Started worker {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(count):
+        spawn(index)
+    logger.info(f"DNS server running with {count} workers on {resolver.listen_ip}:{resolver.listen_port}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        started, index = child
+        if os.WIFSIGNALED(status):
+            logger.error(f"Worker {pid} was killed by signal {os.WTERMSIG(status)}")
+        else:
+            logger.error(f"Worker {pid} exited with status {os.WEXITSTATUS(status)}")
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            logger.error(f"Worker {pid} died right after starting, not restarting it")
+            continue
+        spawn(index)
+
+    resolver.sock.close()
+    logger.info("DNS server stopped.")
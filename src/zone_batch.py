@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+class FileResult:
+    """
+    Outcome of converting or exporting one file in a batch. error is None
+    on success, otherwise a one-line description of what went wrong.
+    """
+    def __init__(self, source, output, records=0, error=None, seconds=0.0):
+        self.source = source
+        self.output = output
+        self.records = records
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _run_one(function, source, output, kwargs, describe_error):
+    started = time.monotonic()
+    try:
+        records = function(source, output, **kwargs)
+    except Exception as e:
+        return FileResult(source, output, error=describe_error(source, e), seconds=time.monotonic() - started)
+    return FileResult(source, output, records, seconds=time.monotonic() - started)
+
+
+def run_batch(function, tasks, describe_error, jobs=None):
+    """
+    Runs function(source, output, **kwargs) for every (source, output,
+    kwargs) in tasks across a pool of jobs processes (default: one per CPU)
+    and returns a FileResult per task, in the order of tasks. A failing file
+    does not stop the others; function returns the number of records written
+    and describe_error(source, exception) turns a failure into its message.
+    """
+    tasks = list(tasks)
+    jobs = min(jobs or os.cpu_count() or 1, max(len(tasks), 1))
+    if jobs == 1:
+        return [_run_one(function, source, output, kwargs, describe_error) for source, output, kwargs in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_run_one, function, source, output, kwargs, describe_error)
+                   for source, output, kwargs in tasks]
+        return [future.result() for future in futures]
+
+
+def directory_tasks(input_dir, output_dir, output_name):
+    """
+    Yields (source, output) for every regular file in input_dir, with the
+    output path in output_dir named by output_name(filename), or skipped
+    if that returns None.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in sorted(os.listdir(input_dir)):
+        source = os.path.join(input_dir, filename)
+        if not os.path.isfile(source):
+            continue
+        name = output_name(filename)
+        if name is not None:
+            yield source, os.path.join(output_dir, name)
+
+
+def report(results, verb):
+    """
+    Prints one line per file and a summary. Returns the exit status: 0 if
+    every file succeeded, 1 otherwise.
+    """
+    failed = 0
+    for result in results:
+        if result.ok:
+            print(f"{verb} '{result.source}' -> '{result.output}' ({result.records} records, {result.seconds:.2f}s)")
+        else:
+            failed += 1
+            print(f"FAILED '{result.source}': {result.error}", file=sys.stderr)
+    print(f"{len(results) - failed} of {len(results)} files {verb.lower()}, {failed} failed")
+    return 1 if failed else 0
@@ -1,83 +1,254 @@
+import dns.exception
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.tokenizer
+import dns.transaction
 import dns.zone
+import dns.zonefile
 import json
+import sqlite3
 import sys
 import os
+from itertools import groupby
+from operator import itemgetter
 
-def convert_zone_to_json(zone_file_path, output_json_path):
+from zone_batch import directory_tasks, report, run_batch
+
+# Records handed to the spool per INSERT batch
+SPOOL_BATCH = 10000
+ZONE_FILE_SUFFIXES = (".zone", ".db", ".txt")
+
+
+class _RecordSink(dns.transaction.Transaction):
+    """
+    Transaction for dns.zonefile.Reader that passes every record it reads to
+    emit(name, rdtype, rdata) instead of building a zone in memory.
+    """
+    def __init__(self, manager, emit):
+        super().__init__(manager, replacement=True)
+        self.emit = emit
+
+    def _get_rdataset(self, name, rdtype, covers):
+        return None
+
+    def _get_node(self, name):
+        return None
+
+    def _put_rdataset(self, name, rdataset):
+        for rdata in rdataset:
+            self.emit(name, rdataset.rdtype, rdata)
+
+    def _delete_name(self, name):
+        pass
+
+    def _delete_rdataset(self, name, rdtype, covers):
+        pass
+
+    def _name_exists(self, name):
+        return False
+
+    def _changed(self):
+        return True
+
+    def _end_transaction(self, commit):
+        pass
+
+    def _set_origin(self, origin):
+        # The first $ORIGIN becomes the zone origin if none was given
+        if self.manager.origin is None:
+            self.manager.origin = origin
+
+    def _iterate_rdatasets(self):
+        return iter(())
+
+    def _iterate_names(self):
+        return iter(())
+
+
+def format_rdata(record_type, rdata):
+    """
+    Returns the magicDNS JSON value of one record.
+    """
+    # Special handling for MX records to include preference
+    if record_type == 'MX':
+        return f"{rdata.preference} {rdata.exchange}"
+    # Special handling for SRV records to include weight, priority, port
+    elif record_type == 'SRV':
+        return f"{rdata.priority} {rdata.weight} {rdata.port} {rdata.target}"
+    # Special handling for SOA records
+    elif record_type == 'SOA':
+        return f"{rdata.mname} {rdata.rname} {rdata.serial} {rdata.refresh} {rdata.retry} {rdata.expire} {rdata.minimum}"
+    # Special handling for CAA records
+    elif record_type == 'CAA':
+        return f"{rdata.flags} {rdata.tag.decode()} \"{rdata.value.decode()}\""
+    # Special handling for SSHFP records
+    elif record_type == 'SSHFP':
+        return f"{rdata.algorithm} {rdata.fp_type} {rdata.fingerprint.hex()}"
+    # Special handling for URI records
+    elif record_type == 'URI':
+        return f"{rdata.priority} {rdata.weight} \"{rdata.target.decode()}\""
+    return str(rdata)
+
+
+def relative_name(name, origin):
+    """
+    Returns the owner name as written in the JSON zone: relative to the
+    origin without a trailing dot, or '@' for the origin itself.
+    """
+    relative = str(name.relativize(origin)) if origin else str(name)
+    if relative in ('@', '@.'):  # Handle the origin itself
+        return '@'
+    if relative.endswith('.'):  # Remove trailing dot for other records
+        return relative[:-1]
+    return relative
+
+
+def _write_json(rows, f):
+    """
+    Writes (record_type, name, value) rows, sorted by type and name, as the
+    JSON zone object, formatted like json.dump(indent=2). Only the values of
+    one name are held at a time; several values for a name become a list.
+    """
+    f.write('{')
+    separator = '\n'
+    for record_type, type_rows in groupby(rows, key=itemgetter(0)):
+        f.write(f'{separator}  {json.dumps(record_type)}: {{')
+        name_separator = '\n'
+        for name, name_rows in groupby(type_rows, key=itemgetter(1)):
+            values = [value for _, _, value in name_rows]
+            text = json.dumps(values[0] if len(values) == 1 else values, indent=2).replace('\n', '\n    ')
+            f.write(f'{name_separator}    {json.dumps(name)}: {text}')
+            name_separator = ',\n'
+        f.write('\n  }')
+        separator = ',\n'
+    f.write('\n}' if separator != '\n' else '}')
+
+
+def convert_zone_to_json(zone_file_path, output_json_path, origin=None):
+    """
+    Converts a standard zone file to a magicDNS JSON zone and returns the
+    number of records written.
+
+    The zone file is read record by record and the records are spooled to a
+    temporary on-disk SQLite database, which sorts them by type and name, so
+    memory stays flat however large the zone is. origin is used for relative
+    names until the file sets its own with $ORIGIN. Errors are raised; the
+    output file is only replaced once the conversion succeeded.
+    """
+    if isinstance(origin, str):
+        origin = dns.name.from_text(origin)
+    manager = dns.zonefile.RRSetsReaderManager(origin, False, dns.rdataclass.IN)
+    spool = sqlite3.connect("")
     try:
+        spool.execute("PRAGMA journal_mode = OFF")
+        spool.execute("PRAGMA synchronous = OFF")
+        spool.execute("CREATE TABLE records (type TEXT, name TEXT, value TEXT)")
+        batch = []
+        count = 0
+
+        def emit(name, rdtype, rdata):
+            nonlocal count
+            record_type = dns.rdatatype.to_text(rdtype)
+            batch.append((record_type, relative_name(name, manager.origin), format_rdata(record_type, rdata)))
+            count += 1
+            if len(batch) >= SPOOL_BATCH:
+                spool.executemany("INSERT INTO records VALUES (?, ?, ?)", batch)
+                batch.clear()
+
         # Read the zone file
-        zone = dns.zone.from_file(zone_file_path, origin=None, relativize=False)
-        
-        json_output = {}
-
-        # Iterate over all RdataSets in the zone
-        for name, node in zone.nodes.items():
-            for rdataset in node.rdatasets:
-                record_type = rdataset.rdtype.to_text()
-                
-                if record_type not in json_output:
-                    json_output[record_type] = {}
-                
-                # Get the relative name for the record
-                relative_name = str(name.relativize(zone.origin)) if zone.origin else str(name)
-                if relative_name == '@.': # Handle the origin itself
-                    relative_name = '@'
-                elif relative_name.endswith('.'): # Remove trailing dot for other records
-                    relative_name = relative_name[:-1]
-
-                # Process each record in the rdataset
-                for rdata in rdataset:
-                    # Special handling for MX records to include preference
-                    if record_type == 'MX':
-                        record_value = f"{rdata.preference} {rdata.exchange}"
-                    # Special handling for SRV records to include weight, priority, port
-                    elif record_type == 'SRV':
-                        record_value = f"{rdata.priority} {rdata.weight} {rdata.port} {rdata.target}"
-                    # Special handling for SOA records
-                    elif record_type == 'SOA':
-                        record_value = f"{rdata.mname} {rdata.rname} {rdata.serial} {rdata.refresh} {rdata.retry} {rdata.expire} {rdata.minimum}"
-                    # Special handling for CAA records
-                    elif record_type == 'CAA':
-                        record_value = f"{rdata.flags} {rdata.tag} "{rdata.value.decode()}""
-                    # Special handling for SSHFP records
-                    elif record_type == 'SSHFP':
-                        record_value = f"{rdata.algorithm} {rdata.fp_type} {rdata.fingerprint}"
-                    # Special handling for URI records
-                    elif record_type == 'URI':
-                        record_value = f"{rdata.priority} {rdata.weight} "{rdata.target.decode()}""
-                    else:
-                        record_value = str(rdata)
-                    
-                    # Append to list if multiple records of same type for same name
-                    if relative_name in json_output[record_type]:
-                        if not isinstance(json_output[record_type][relative_name], list):
-                            json_output[record_type][relative_name] = [json_output[record_type][relative_name]]
-                        json_output[record_type][relative_name].append(record_value)
-                    else:
-                        json_output[record_type][relative_name] = record_value
-
-        # Write the JSON output to a file
-        with open(output_json_path, 'w') as f:
-            json.dump(json_output, f, indent=2)
-        
-        print(f"Successfully converted '{zone_file_path}' to '{output_json_path}'")
-
-    except dns.zone.BadZone as e:
-        print(f"Error parsing zone file '{zone_file_path}': {e}", file=sys.stderr)
-        sys.exit(1)
-    except FileNotFoundError:
-        print(f"Error: Zone file not found at '{zone_file_path}'", file=sys.stderr)
-        sys.exit(1)
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}", file=sys.stderr)
+        with open(zone_file_path) as f:
+            tok = dns.tokenizer.Tokenizer(f, filename=zone_file_path)
+            reader = dns.zonefile.Reader(tok, dns.rdataclass.IN, _RecordSink(manager, emit), allow_include=True)
+            reader.read()
+        spool.executemany("INSERT INTO records VALUES (?, ?, ?)", batch)
+
+        # Write the JSON output, SOA first, then by type and name
+        partial_path = output_json_path + ".partial"
+        rows = spool.execute("SELECT type, name, value FROM records ORDER BY type != 'SOA', type, name, rowid")
+        try:
+            with open(partial_path, 'w') as f:
+                _write_json(rows, f)
+            os.replace(partial_path, output_json_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        return count
+    finally:
+        spool.close()
+
+
+def describe_error(zone_file_path, e):
+    """
+    Returns the message for a failed conversion.
+    """
+    if isinstance(e, (dns.zone.BadZone, dns.exception.SyntaxError)):
+        return f"Error parsing zone file '{zone_file_path}': {e}"
+    if isinstance(e, FileNotFoundError):
+        return f"Error: Zone file not found at '{zone_file_path}'"
+    return f"An unexpected error occurred: {e}"
+
+
+def zone_name_of(filename):
+    """
+    Returns the zone name for a zone file name: the name without a .zone,
+    .db or .txt suffix.
+    """
+    for suffix in ZONE_FILE_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def convert_directory(input_dir, output_dir, jobs=None):
+    """
+    Converts every zone file in input_dir to <zone>.json in output_dir,
+    using a pool of jobs processes. The zone name (from the file name) is
+    the origin unless the file sets one. Returns a FileResult per file.
+    """
+    tasks = [(source, output, {"origin": zone_name_of(os.path.basename(source)).rstrip('.') + '.'})
+             for source, output in directory_tasks(input_dir, output_dir,
+                                                   lambda filename: zone_name_of(filename) + ".json")]
+    return run_batch(convert_zone_to_json, tasks, describe_error, jobs)
+
+def build_zone_snapshot(config_file):
+    """
+    Compiles the zones of a magicDNS configuration into its ZONES_SNAPSHOT
+    file, so the server can start from the snapshot without compiling.
+    """
+    # Only needed here, so converting does not load the whole server
+    from app import DNSResolver
+    resolver = DNSResolver(config_file)
+    if not resolver.zones_snapshot:
+        print(f"Error: ZONES_SNAPSHOT is not set in '{config_file}'", file=sys.stderr)
         sys.exit(1)
+    # Loading the zones writes the snapshot, unless it is already current
+    resolver.sock.close()
+    print(f"Zone snapshot '{resolver.zones_snapshot}' is up to date "
+          f"({resolver.zone_index.zone_count} zones from '{resolver.zones_dir}')")
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--snapshot":
+        build_zone_snapshot(sys.argv[2])
+        sys.exit(0)
+
+    if len(sys.argv) in (4, 5) and sys.argv[1] == "--batch":
+        jobs = int(sys.argv[4]) if len(sys.argv) == 5 else None
+        sys.exit(report(convert_directory(sys.argv[2], sys.argv[3], jobs), "Converted"))
+
     if len(sys.argv) != 3:
         print("Usage: python3 zone_converter.py <zone_file_path> <output_json_path>", file=sys.stderr)
+        print("       python3 zone_converter.py --batch <zone_dir> <output_dir> [jobs]", file=sys.stderr)
+        print("       python3 zone_converter.py --snapshot <config_file>", file=sys.stderr)
         sys.exit(1)
-    
+
     zone_file = sys.argv[1]
     output_json = sys.argv[2]
-    
-    convert_zone_to_json(zone_file, output_json)
+
+    try:
+        convert_zone_to_json(zone_file, output_json)
+    except Exception as e:
+        print(describe_error(zone_file, e), file=sys.stderr)
+        sys.exit(1)
+    print(f"Successfully converted '{zone_file}' to '{output_json}'")
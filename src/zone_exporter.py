@@ -1,81 +1,195 @@
 import json
+import os
+import shutil
 import sys
-import dns.rdata
-import dns.rdtypes.IN.A
-import dns.rdtypes.IN.AAAA
-import dns.rdtypes.IN.MX
-import dns.rdtypes.IN.TXT
-import dns.rdtypes.IN.SRV
-import dns.rdtypes.IN.NS
-import dns.rdtypes.IN.SOA
-import dns.rdtypes.IN.HINFO
-import dns.rdtypes.IN.CAA
-import dns.rdtypes.IN.LOC
-import dns.rdtypes.IN.SSHFP
-import dns.rdtypes.IN.URI
-import dns.rdtypes.IN.CNAME
-from dns.rdataclass import IN
-from dns.rdatatype import *
-
-def export_json_to_zone(json_file_path, output_zone_path, default_ttl=3600):
-    try:
-        with open(json_file_path, 'r') as f:
-            json_data = json.load(f)
-
-        zone_lines = []
-        
-        # Add default TTL
-        zone_lines.append(f"$TTL {default_ttl}")
-
-        # Process SOA record first if it exists, to get origin and other details
-        soa_data = json_data.get("SOA", {}).get("@")
-        if soa_data:
-            # Assuming soa_data is a string like "mname rname serial refresh retry expire minimum"
-            parts = soa_data.split()
-            if len(parts) == 7:
-                mname, rname, serial, refresh, retry, expire, minimum = parts
-                # The origin for the zone file is typically the domain itself, derived from the file name or mname
-                # For simplicity, we'll assume the origin is derived from the JSON file name or needs to be passed.
-                # For now, let's just write the SOA record as is.
-                zone_lines.append(f"@ IN SOA {mname} {rname} (")
-                zone_lines.append(f"\t\t\t{serial} ; serial")
-                zone_lines.append(f"\t\t\t{refresh} ; refresh")
-                zone_lines.append(f"\t\t\t{retry} ; retry")
-                zone_lines.append(f"\t\t\t{expire} ; expire")
-                zone_lines.append(f"\t\t\t{minimum} ) ; minimum")
-            else:
-                print(f"Warning: Malformed SOA record for @: {soa_data}", file=sys.stderr)
-            
-            # Remove SOA from json_data to avoid re-processing
-            json_data.pop("SOA", None)
-
-        for record_type, records in json_data.items():
-            for name, value in records.items():
-                # Handle multiple records for the same name/type
-                if isinstance(value, list):
-                    for item in value:
-                        zone_lines.append(format_record(record_type, name, item))
-                else:
-                    zone_lines.append(format_record(record_type, name, value))
-
-        with open(output_zone_path, 'w') as f:
-            f.write("\n".join(zone_lines))
-        
-        print(f"Successfully exported '{json_file_path}' to '{output_zone_path}'")
-
-    except FileNotFoundError:
-        print(f"Error: JSON file not found at '{json_file_path}'", file=sys.stderr)
-        sys.exit(1)
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in '{json_file_path}'", file=sys.stderr)
-        sys.exit(1)
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}", file=sys.stderr)
-        sys.exit(1)
+import tempfile
+
+from zone_batch import directory_tasks, report, run_batch
+
+# Characters of the JSON zone read at a time
+READ_CHUNK = 1 << 16
+
+
+class _JSONStream:
+    """
+    Reads the JSON zone object ({"TYPE": {"name": value, ...}, ...}) from a
+    file piece by piece, so only the current value is held in memory.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character ('' at the end).
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _members(self):
+        """
+        Yields the keys of the object at the current position, leaving the
+        position at each key's value.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name", self.buffer, self.pos)
+            self._expect(':')
+            yield key
+            if self._peek() == ',':
+                self.pos += 1
+                continue
+            self._expect('}')
+            return
+
+    def records(self):
+        """
+        Yields (record_type, name, value) for every entry of the zone.
+        """
+        for record_type in self._members():
+            for name in self._members():
+                yield record_type, name, self._value()
+        if self._peek() != "":
+            raise json.JSONDecodeError("Extra data", self.buffer, self.pos)
+
+
+def export_json_to_zone(json_file_path, output_zone_path, default_ttl=3600, origin=None):
+    """
+    Exports a magicDNS JSON zone to a standard zone file and returns the
+    number of records written.
+
+    The JSON is read and the zone file written one record at a time, so
+    memory stays flat however large the zone is. The SOA record goes to the
+    top of the file wherever it appears in the JSON: the other records are
+    written to a temporary file first and appended after it. With origin,
+    an $ORIGIN line is written. Errors are raised; the output file is only
+    replaced once the export succeeded.
+    """
+    count = 0
+    output_dir = os.path.dirname(os.path.abspath(output_zone_path))
+    with open(json_file_path, 'r') as f, tempfile.TemporaryFile('w+', dir=output_dir) as records:
+        soa_lines = []
+        for record_type, name, value in _JSONStream(f).records():
+            # Process the SOA record first, to get origin and other details
+            if record_type == "SOA":
+                if name == "@":
+                    soa_lines = format_soa(value)
+                continue
+            # Handle multiple records for the same name/type
+            for item in value if isinstance(value, list) else [value]:
+                line = format_record(record_type, name, item)
+                if line:
+                    records.write(line + "\n")
+                    count += 1
+
+        partial_path = output_zone_path + ".partial"
+        try:
+            with open(partial_path, 'w') as out:
+                # Add default TTL
+                out.write(f"$TTL {default_ttl}\n")
+                if origin:
+                    out.write(f"$ORIGIN {origin.rstrip('.')}.\n")
+                for line in soa_lines:
+                    out.write(line + "\n")
+                records.seek(0)
+                shutil.copyfileobj(records, out)
+            os.replace(partial_path, output_zone_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+    return count + (1 if soa_lines else 0)
+
+
+def format_soa(soa_data):
+    """
+    Returns the zone file lines of the SOA record at the origin.
+    """
+    # Assuming soa_data is a string like "mname rname serial refresh retry expire minimum"
+    parts = soa_data.split()
+    if len(parts) != 7:
+        print(f"Warning: Malformed SOA record for @: {soa_data}", file=sys.stderr)
+        return []
+    mname, rname, serial, refresh, retry, expire, minimum = parts
+    return [
+        f"@ IN SOA {mname} {rname} (",
+        f"\t\t\t{serial} ; serial",
+        f"\t\t\t{refresh} ; refresh",
+        f"\t\t\t{retry} ; retry",
+        f"\t\t\t{expire} ; expire",
+        f"\t\t\t{minimum} ) ; minimum",
+    ]
+
+
+def describe_error(json_file_path, e):
+    """
+    Returns the message for a failed export.
+    """
+    if isinstance(e, FileNotFoundError):
+        return f"Error: JSON file not found at '{json_file_path}'"
+    if isinstance(e, json.JSONDecodeError):
+        return f"Error: Invalid JSON format in '{json_file_path}': {e}"
+    return f"An unexpected error occurred: {e}"
+
+
+def export_directory(input_dir, output_dir, jobs=None, default_ttl=3600):
+    """
+    Exports every <zone>.json in input_dir to <zone>.zone in output_dir,
+    with $ORIGIN set to the zone name, using a pool of jobs processes.
+    Returns a FileResult per file.
+    """
+    tasks = [(source, output, {"default_ttl": default_ttl, "origin": os.path.basename(source)[:-5]})
+             for source, output in directory_tasks(
+                 input_dir, output_dir,
+                 lambda filename: filename[:-5] + ".zone" if filename.endswith(".json") else None)]
+    return run_batch(export_json_to_zone, tasks, describe_error, jobs)
 
 def format_record(record_type, name, value):
-    # Replace '@' with empty string for origin
-    formatted_name = name if name != '@' else ''
+    # '@' stays: an empty owner would mean the previous record's name
+    formatted_name = name
     
     # Handle specific record types
     if record_type == 'MX':
@@ -97,7 +211,9 @@ def format_record(record_type, name, value):
             print(f"Warning: Malformed SRV record for {name}: {value}", file=sys.stderr)
             return ""
     elif record_type == 'TXT':
-        # TXT records need to be quoted
+        # TXT records need to be quoted, unless the converter already did
+        if value.startswith('"'):
+            return f"{formatted_name}\tIN\tTXT\t{value}"
         return f"{formatted_name}\tIN\tTXT\t\"{value}\""
     elif record_type == 'CAA':
         # Value is "flags tag \"value\""
@@ -135,11 +251,21 @@ def format_record(record_type, name, value):
         return f"{formatted_name}\tIN\t{record_type}\t{value}"
 
 if __name__ == "__main__":
+    if len(sys.argv) in (4, 5) and sys.argv[1] == "--batch":
+        jobs = int(sys.argv[4]) if len(sys.argv) == 5 else None
+        sys.exit(report(export_directory(sys.argv[2], sys.argv[3], jobs), "Exported"))
+
     if len(sys.argv) != 3:
         print("Usage: python3 zone_exporter.py <json_file_path> <output_zone_path>", file=sys.stderr)
+        print("       python3 zone_exporter.py --batch <json_dir> <output_dir> [jobs]", file=sys.stderr)
         sys.exit(1)
-    
+
     json_file = sys.argv[1]
     output_zone = sys.argv[2]
-    
-    export_json_to_zone(json_file, output_zone)
+
+    try:
+        export_json_to_zone(json_file, output_zone)
+    except Exception as e:
+        print(describe_error(json_file, e), file=sys.stderr)
+        sys.exit(1)
+    print(f"Successfully exported '{json_file}' to '{output_zone}'")
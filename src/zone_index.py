@@ -0,0 +1,189 @@
+class _Node:
+    """
+    A single label in the reversed-label trie.
+    """
+    __slots__ = ("children", "apex", "records")
+
+    def __init__(self):
+        self.children = {}
+        self.apex = None     # zone name if a zone is rooted at this node
+        self.records = None  # {zone_name: {record_type: data}} for this owner name
+
+
+def split_labels(name):
+    """
+    Splits a domain name into lowercase labels, ignoring the trailing dot.
+    """
+    name = name.rstrip('.').lower()
+    if not name:
+        return []
+    return name.split('.')
+
+
+class ZoneIndex:
+    """
+    Label-reversed trie over all loaded zones.
+
+    Zones and their owner names are inserted label by label starting from the
+    TLD (e.g. "www.openlab.dk" becomes dk -> openlab -> www), so finding the
+    longest matching zone and the record node for a query name costs one dict
+    lookup per label, independent of how many zones are loaded. Forward zones
+    and in-addr.arpa/ip6.arpa reverse zones go through the same path.
+
+    If a compile callable is given, it is called as
+    compile(zone_name, owner, record_type, data) for every record
+    and its return value is stored instead of the raw data; records for which
+    it returns None are left out of the index.
+
+    Owner names with a CNAME record are aliases. Once all zones are in, a
+    flatten callable is called as flatten(lookup, owner, records) for each of
+    them, and the records it returns are added to what a lookup of the alias
+    finds, so chains across zones are resolved at load time.
+
+    A "*" label is a wildcard (RFC 4592): a name that does not exist in its
+    zone is answered from "*.<closest encloser>", found in the same walk down
+    the trie.
+    """
+    def __init__(self, zones=None, compile=None, flatten=None):
+        self.root = _Node()
+        self.compile = compile
+        self.flatten = flatten
+        self.zones = {}  # {zone_name: {subdomain: {record_type: data}}}
+        self.aliases = []  # [(zone_name, subdomain, owner, node)] of owners with a CNAME
+        self.flattened = {}  # {zone_name: {subdomain: records with the flattened chains}}
+        for zone_name, zone_data in (zones or {}).items():
+            self.add_zone(zone_name, zone_data)
+        self.flatten_aliases()
+
+    @property
+    def zone_count(self):
+        return len(self.zones)
+
+    def _node_for(self, labels):
+        node = self.root
+        for label in reversed(labels):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        return node
+
+    def compile_zone(self, zone_name, zone_data):
+        """
+        Compiles the records of a zone into {subdomain: {record_type: data}}.
+        """
+        compiled = {}
+        for record_type, records in zone_data.items():
+            if not isinstance(records, dict):
+                continue
+            for subdomain, data in records.items():
+                if self.compile is not None:
+                    owner = zone_name if subdomain == '@' else f"{subdomain}.{zone_name}"
+                    data = self.compile(zone_name, owner.rstrip('.') + '.', record_type, data)
+                    if data is None:
+                        continue
+                compiled.setdefault(subdomain, {})[record_type] = data
+        return compiled
+
+    def insert_zone(self, zone_name, compiled):
+        """
+        Inserts a zone compiled by compile_zone and all of its owner names
+        into the trie.
+        """
+        zone_labels = split_labels(zone_name)
+        apex = self._node_for(zone_labels)
+        apex.apex = zone_name
+        self.zones[zone_name] = compiled
+
+        for subdomain, records in compiled.items():
+            if subdomain == '@':
+                owner_labels = zone_labels
+                node = apex
+            else:
+                owner_labels = split_labels(subdomain) + zone_labels
+                node = self._node_for(owner_labels)
+            # Records are kept per zone so that a name which is also
+            # covered by a more specific zone is answered from that zone.
+            if node.records is None:
+                node.records = {}
+            node.records[zone_name] = records
+            if 'CNAME' in records:
+                self.aliases.append((zone_name, subdomain, '.'.join(owner_labels) + '.', node))
+
+    def add_zone(self, zone_name, zone_data):
+        """
+        Compiles a zone and inserts it into the trie.
+        """
+        self.insert_zone(zone_name, self.compile_zone(zone_name, zone_data))
+
+    def flatten_aliases(self):
+        """
+        Resolves the CNAME chains of all aliases with the flatten callable.
+        Called once every zone is inserted, since a chain can lead into any
+        of them.
+        """
+        self.flattened = {}
+        if self.flatten is None:
+            return
+        for zone_name, subdomain, owner, node in self.aliases:
+            records = self.zones[zone_name][subdomain]
+            # Records given explicitly win over ones reached through the chain
+            resolved = {**self.flatten(self.lookup, owner, records), **records}
+            self.flattened.setdefault(zone_name, {})[subdomain] = resolved
+        for zone_name, subdomain, owner, node in self.aliases:
+            node.records[zone_name] = self.flattened[zone_name][subdomain]
+
+    def zone_records(self, zone_name):
+        """
+        Yields (subdomain, records) for every owner name in a zone, with the
+        flattened CNAME chains included.
+        """
+        flattened = self.flattened.get(zone_name, {})
+        for subdomain, records in self.zones[zone_name].items():
+            yield subdomain, flattened.get(subdomain, records)
+
+    def updated(self, changed=None, removed=()):
+        """
+        Returns a new ZoneIndex with the zones in changed ({zone_name:
+        zone_data}) compiled and added or replaced, and the zones in removed
+        left out. Every other zone reuses its already compiled records, so only
+        the changed zones are compiled again. This index is left untouched.
+        """
+        changed = changed or {}
+        index = ZoneIndex(compile=self.compile, flatten=self.flatten)
+        for zone_name, compiled in self.zones.items():
+            if zone_name not in changed and zone_name not in removed:
+                index.insert_zone(zone_name, compiled)
+        for zone_name, zone_data in changed.items():
+            index.add_zone(zone_name, zone_data)
+        # Chains can cross zones, so all of them are flattened again
+        index.flatten_aliases()
+        return index
+
+    def lookup(self, qname):
+        """
+        Finds the longest zone matching qname.
+
+        Returns a (zone_name, records) tuple where records is the
+        {record_type: data} dict for qname inside that zone (or of the
+        wildcard matching it), or None if the zone has no records for it.
+        zone_name is None if no zone matches.
+        """
+        node = self.root
+        zone_name = None
+        for label in reversed(split_labels(qname)):
+            child = node.children.get(label)
+            if child is None:
+                # qname does not exist, so node is its closest encloser
+                if zone_name is not None:
+                    wildcard = node.children.get('*')
+                    if wildcard is not None and wildcard.records is not None:
+                        return zone_name, wildcard.records.get(zone_name)
+                return zone_name, None
+            node = child
+            if node.apex is not None:
+                zone_name = node.apex
+
+        if zone_name is not None and node.records is not None:
+            return zone_name, node.records.get(zone_name)
+        return zone_name, None
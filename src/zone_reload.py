@@ -0,0 +1,97 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# After an inotify event, wait this long for more so a burst of writes
+# (e.g. a deployment copying many zones) leads to a single reload.
+DEBOUNCE = 0.2
+
+
+def _inotify_fd(path):
+    """
+    Returns an inotify file descriptor watching path, or None if inotify is
+    not available (non-Linux, or the libc lacks it).
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class ZoneWatcher:
+    """
+    Background thread that calls reload() when the zones directory changes.
+
+    mode is "inotify", "poll", "auto" (inotify, falling back to polling every
+    interval seconds) or "off". With inotify the directory is still polled
+    every interval seconds as a safety net, e.g. for network file systems.
+    """
+    def __init__(self, reload, zones_dir, mode="auto", interval=2.0):
+        self.reload = reload
+        self.zones_dir = zones_dir
+        self.mode = mode
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.fd = None
+
+    def start(self):
+        if self.mode == "off":
+            return
+        if self.mode in ("auto", "inotify"):
+            self.fd = _inotify_fd(self.zones_dir)
+            if self.fd is None:
+                logger.warning(f"inotify not available for {self.zones_dir}, polling every {self.interval}s")
+        self.thread = threading.Thread(target=self._run, name="zone-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 1)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.fd is not None:
+                readable, _, _ = select.select([self.fd], [], [], self.interval)
+                if readable:
+                    self.stopped.wait(DEBOUNCE)
+                    self._drain()
+            else:
+                self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                break
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Zone reload failed: {e}")
@@ -0,0 +1,253 @@
+"""
+Compiled binary zone snapshots.
+
+A snapshot holds every compiled answer of a ZoneIndex in sorted,
+offset-indexed tables, so the server can mmap it at startup and answer from
+it without parsing or compiling the JSON zones. Only the pages that queries
+touch are ever read, which keeps startup time and memory nearly flat as the
+number of records grows.
+
+Layout (all integers big-endian):
+
+    header    magic, zone count/offset, record count/offset, name count/offset,
+              metadata offset/length
+    zones     sorted fixed-size entries (key offset, key length)
+    records   sorted fixed-size entries (key offset, key length, answer offset,
+              answer length, record count, record type, chain end)
+    names     sorted fixed-size entries (key offset, key length)
+    blob      keys and pre-rendered answer sections referenced by the tables
+    metadata  JSON: zone names, zones with wildcards and the zone file stamps
+              the snapshot was built from
+
+Zone keys are lowercase zone names; record keys are
+"owner NUL zone NUL TYPE" with lowercase owner and zone names. Flattened
+CNAME chains are stored like any other answer. For zones with wildcards the
+names table lists every existing name ("name NUL zone", including empty
+non-terminals), which is what finding the closest encloser needs.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from static_answers import CompiledAnswer
+from zone_index import split_labels
+
+MAGIC = b"MDNSSNP3"
+_HEADER = struct.Struct('!8sIIIIIIII')
+_ZONE_ENTRY = struct.Struct('!IH')
+_RECORD_ENTRY = struct.Struct('!IHIIHHB')
+
+
+def _record_key(owner, zone_name, record_type):
+    return f"{owner}\0{zone_name}\0{record_type}".encode()
+
+
+def _name_key(name, zone_name):
+    return f"{name}\0{zone_name}".encode()
+
+
+def write_snapshot(path, zone_index, stamps):
+    """
+    Writes the compiled answers of zone_index to path. stamps are the zone
+    file stamps the index was built from, used to tell if it is still current.
+    The file is replaced atomically.
+    """
+    zone_entries = []
+    record_entries = []
+    name_entries = set()
+    zone_names = {}
+    wildcard_zones = []
+
+    for zone_name in zone_index.zones:
+        zone_labels = split_labels(zone_name)
+        zone_key = '.'.join(zone_labels)
+        zone_names[zone_key] = zone_name
+        zone_entries.append(zone_key.encode())
+        owners = []
+        for subdomain, records in zone_index.zone_records(zone_name):
+            owner_labels = zone_labels if subdomain == '@' else split_labels(subdomain) + zone_labels
+            owners.append(owner_labels)
+            owner = '.'.join(owner_labels)
+            for record_type, answer in records.items():
+                record_entries.append((_record_key(owner, zone_key, record_type), answer))
+        if any('*' in labels for labels in owners):
+            wildcard_zones.append(zone_key)
+            for labels in owners:
+                # The owner and every name between it and the apex exist
+                for start in range(len(labels) - len(zone_labels) + 1):
+                    name_entries.add(_name_key('.'.join(labels[start:]), zone_key))
+
+    zone_entries.sort()
+    record_entries.sort(key=lambda entry: entry[0])
+    name_entries = sorted(name_entries)
+
+    # The tables have fixed-size entries, so the blob offset is known up front
+    zone_offset = _HEADER.size
+    record_offset = zone_offset + len(zone_entries) * _ZONE_ENTRY.size
+    name_offset = record_offset + len(record_entries) * _RECORD_ENTRY.size
+    blob_offset = name_offset + len(name_entries) * _ZONE_ENTRY.size
+
+    blob = bytearray()
+    zone_table = bytearray()
+    for key in zone_entries:
+        zone_table += _ZONE_ENTRY.pack(blob_offset + len(blob), len(key))
+        blob += key
+
+    record_table = bytearray()
+    for key, answer in record_entries:
+        key_offset = blob_offset + len(blob)
+        blob += key
+        record_table += _RECORD_ENTRY.pack(key_offset, len(key), blob_offset + len(blob),
+                                           len(answer.wire), answer.count, answer.rdtype, answer.chain_end)
+        blob += answer.wire
+
+    name_table = bytearray()
+    for key in name_entries:
+        name_table += _ZONE_ENTRY.pack(blob_offset + len(blob), len(key))
+        blob += key
+
+    metadata = json.dumps({"zones": zone_names, "wildcard_zones": wildcard_zones, "stamps": stamps}).encode()
+    header = _HEADER.pack(MAGIC, len(zone_entries), zone_offset, len(record_entries), record_offset,
+                          len(name_entries), name_offset, blob_offset + len(blob), len(metadata))
+
+    # A temporary file of its own, since every worker process writes the
+    # snapshot after a reload
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(zone_table)
+            f.write(record_table)
+            f.write(name_table)
+            f.write(blob)
+            f.write(metadata)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class _SnapshotRecords:
+    """
+    The {record_type: CompiledAnswer} view of one owner name in a snapshot,
+    looked up on demand.
+    """
+    __slots__ = ("snapshot", "prefix")
+
+    def __init__(self, snapshot, prefix):
+        self.snapshot = snapshot
+        self.prefix = prefix
+
+    def get(self, record_type, default=None):
+        answer = self.snapshot.find_record(self.prefix + record_type.encode())
+        return default if answer is None else answer
+
+
+class ZoneSnapshot:
+    """
+    A memory-mapped zone snapshot with the same lookup() interface as
+    ZoneIndex. Lookups binary-search the sorted tables in place.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.zone_count, self.zone_offset, self.record_count, self.record_offset,
+         self.name_count, self.name_offset, meta_offset, meta_length) = _HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{path} is not a zone snapshot")
+        metadata = json.loads(self.mm[meta_offset:meta_offset + meta_length])
+        self.zone_names = metadata["zones"]
+        self.wildcard_zones = set(metadata["wildcard_zones"])
+        # Stored as lists by JSON; compare as tuples like _zone_file_stamps
+        self.stamps = {name: tuple(stamp) for name, stamp in metadata["stamps"].items()}
+
+    def close(self):
+        self.mm.close()
+
+    def _table_key(self, table_offset, index):
+        key_offset, key_length = _ZONE_ENTRY.unpack_from(self.mm, table_offset + index * _ZONE_ENTRY.size)
+        return self.mm[key_offset:key_offset + key_length]
+
+    def _table_contains(self, table_offset, count, key):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._table_key(table_offset, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low < count and self._table_key(table_offset, low) == key
+
+    def _record_entry(self, index):
+        return _RECORD_ENTRY.unpack_from(self.mm, self.record_offset + index * _RECORD_ENTRY.size)
+
+    def has_zone(self, zone_key):
+        return self._table_contains(self.zone_offset, self.zone_count, zone_key)
+
+    def has_name(self, name, zone_key):
+        """
+        Tells if name exists in a zone with wildcards.
+        """
+        return self._table_contains(self.name_offset, self.name_count, _name_key(name, zone_key))
+
+    def find_record(self, key):
+        """
+        Returns the CompiledAnswer stored under a record key, or None.
+        """
+        low, high = 0, self.record_count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, _, _, _, _, _ = self._record_entry(middle)
+            if self.mm[key_offset:key_offset + key_length] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.record_count:
+            return None
+        key_offset, key_length, wire_offset, wire_length, count, rdtype, chain_end = self._record_entry(low)
+        if self.mm[key_offset:key_offset + key_length] != key:
+            return None
+        return CompiledAnswer(rdtype, count, self.mm[wire_offset:wire_offset + wire_length], chain_end)
+
+    def all_zone_records(self):
+        """
+        Returns {zone_name: {subdomain: records}} for every zone, with the
+        flattened CNAME chains included like ZoneIndex.zone_records. Reads
+        the whole record table, so it is meant for rebuilding a ZoneIndex on
+        reload, not for answering queries.
+        """
+        zones = {}
+        for index in range(self.record_count):
+            key_offset, key_length, wire_offset, wire_length, count, rdtype, chain_end = self._record_entry(index)
+            owner, zone_key, record_type = self.mm[key_offset:key_offset + key_length].decode().split('\0')
+            subdomain = '@' if owner == zone_key else owner[:-len(zone_key) - 1]
+            owners = zones.setdefault(self.zone_names[zone_key], {})
+            owners.setdefault(subdomain, {})[record_type] = CompiledAnswer(
+                rdtype, count, self.mm[wire_offset:wire_offset + wire_length], chain_end)
+        return zones
+
+    def lookup(self, qname):
+        """
+        Finds the longest zone matching qname, like ZoneIndex.lookup,
+        including wildcard matches.
+        """
+        labels = split_labels(qname)
+        owner = '.'.join(labels)
+        for start in range(len(labels)):
+            zone_key = '.'.join(labels[start:])
+            if self.has_zone(zone_key.encode()):
+                if zone_key in self.wildcard_zones and not self.has_name(owner, zone_key):
+                    # Answer from the wildcard at the closest existing ancestor
+                    for encloser in range(1, start + 1):
+                        name = '.'.join(labels[encloser:])
+                        if self.has_name(name, zone_key):
+                            owner = f"*.{name}"
+                            break
+                prefix = f"{owner}\0{zone_key}\0".encode()
+                return self.zone_names[zone_key], _SnapshotRecords(self, prefix)
+        return None, None